@@ -0,0 +1,61 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# What is cached of a user, in the model's field order as from_db() takes
+# them; never the password hash. The other fields are left deferred, so
+# saving the user rebuilt from the cache doesn't clear them.
+USER_FIELDS = [
+    "id",
+    "is_superuser",
+    "username",
+    "first_name",
+    "last_name",
+    "email",
+    "is_staff",
+    "is_active",
+]
+
+
+def token_cache_key(key):
+    # Hash the key so raw tokens never end up in the cache
+    return "auth-user:" + hashlib.sha256(key.encode()).hexdigest()
+
+
+def evict_token(key):
+    """Drop a token from the authentication cache"""
+    if key:
+        cache.delete(token_cache_key(key))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that keeps recent token -> user lookups in the shared
+    cache for AUTH_TOKEN_CACHE_TIMEOUT seconds, so authenticated requests
+    don't each run a Token/User join.
+
+    Entries are evicted when a token is deleted or replaced and whenever its
+    user is saved (e.g. deactivated); see authentication.signals.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        cached = cache.get(cache_key)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+            cached = [getattr(user, name) for name in USER_FIELDS]
+            cache.set(cache_key, cached, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+            return user, token
+
+        user = get_user_model().from_db(None, USER_FIELDS, cached)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+        token = Token.from_db(None, ["key", "user_id"], [key, user.pk])
+        token.user = user
+        return user, token
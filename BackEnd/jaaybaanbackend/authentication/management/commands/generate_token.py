@@ -8,11 +8,19 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("username", type=str, help="Username to generate token for")
+        parser.add_argument(
+            "--regenerate",
+            action="store_true",
+            help="Replace the existing token, signing out every client using it",
+        )
 
     def handle(self, *args, **options):
         username = options["username"]
         try:
             user = User.objects.get(username=username)
+            if options["regenerate"]:
+                # Deleting the token also evicts it from the authentication cache
+                Token.objects.filter(user=user).delete()
             token, created = Token.objects.get_or_create(user=user)
             if created:
                 self.stdout.write(
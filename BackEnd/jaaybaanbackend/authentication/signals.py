@@ -1,10 +1,27 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 
+from .authentication import evict_token
+
 
 @receiver(post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def evict_user_tokens(sender, instance=None, created=False, **kwargs):
+    # The cached token carries a snapshot of the user; drop it so deactivation
+    # (and any other change) takes effect on the next request
+    if not created:
+        for key in Token.objects.filter(user=instance).values_list("key", flat=True):
+            evict_token(key)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def evict_cached_token(sender, instance=None, **kwargs):
+    evict_token(instance.key)
@@ -1,9 +1,15 @@
+import io
+
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from rest_framework import status
 
+from .authentication import token_cache_key
+
 
 class AuthenticationTestCase(TestCase):
     def setUp(self):
@@ -45,3 +51,50 @@ class AuthenticationTestCase(TestCase):
         new_user = User.objects.create_user(username="newuser", password="newpass123")
 
         self.assertTrue(Token.objects.filter(user=new_user).exists())
+
+
+class CachedTokenAuthenticationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        self.token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    def test_warm_cache_skips_auth_queries(self):
+        """Test that a cached token authenticates without database queries"""
+        self.client.get("/api/v1/locations/statistics/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/v1/locations/statistics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Only a snapshot of the user is cached, without the password hash
+        cached = cache.get(token_cache_key(self.token.key))
+        self.assertNotIn(self.user.password, cached)
+        self.assertIn(self.user.username, cached)
+
+    def test_logout_evicts_cached_token(self):
+        """Test that a logged out token is rejected even when it was cached"""
+        self.client.get("/api/v1/locations/statistics/")
+        response = self.client.post("/api/v1/auth/logout/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get("/api/v1/locations/statistics/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivation_and_regeneration_evict_cached_token(self):
+        """Test that user deactivation and token regeneration take effect"""
+        self.client.get("/api/v1/locations/statistics/")
+        call_command("generate_token", "testuser", "--regenerate", stdout=io.StringIO())
+        response = self.client.get("/api/v1/locations/statistics/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        self.client.get("/api/v1/locations/statistics/")
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get("/api/v1/locations/statistics/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
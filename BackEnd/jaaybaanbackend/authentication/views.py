@@ -24,6 +24,7 @@ class CustomAuthToken(ObtainAuthToken):
 def logout_view(request):
     """Token logout endpoint"""
     try:
+        # Deleting the token also evicts it from the authentication cache
         request.user.auth_token.delete()
         return Response(
             {"message": "Successfully logged out"}, status=status.HTTP_200_OK
@@ -0,0 +1,186 @@
+"""
+Negotiated compression of API responses.
+
+Like django.middleware.gzip.GZipMiddleware, but it also offers zstd and
+Brotli when the zstandard / brotli packages are installed, only compresses
+the content types in COMPRESSION_CONTENT_TYPES above COMPRESSION_MIN_SIZE
+bytes, and uses the levels in COMPRESSION_LEVELS. Streaming responses are
+compressed chunk by chunk, and every chunk is flushed, so NDJSON lines still
+reach the client as they are produced.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+
+def available_codings():
+    """The enabled content codings, most preferred first"""
+    return [coding for coding in settings.COMPRESSION_LEVELS if coding in COMPRESSORS]
+
+
+def negotiate(accept_encoding, codings):
+    """
+    The coding of ``codings`` (in preference order) that the Accept-Encoding
+    header gives the highest q-value, or None.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(coding, data, level=None):
+    if level is None:
+        level = settings.COMPRESSION_LEVELS[coding]
+    compressor = COMPRESSORS[coding](level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(coding, level, chunks):
+    compressor = COMPRESSORS[coding](level)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def acompress_stream(coding, level, chunks):
+    compressor = COMPRESSORS[coding](level)
+    async for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress responses with the best content coding the client accepts.
+
+    HTML is left alone by default: compressing pages that embed a CSRF token
+    next to user input exposes the token to the BREACH attack.
+    """
+
+    def process_response(self, request, response):
+        if response.has_header("Content-Encoding"):
+            return response
+        if not response.streaming and (
+            len(response.content) < settings.COMPRESSION_MIN_SIZE
+        ):
+            return response
+        content_type = response.get("Content-Type", "").partition(";")[0]
+        if content_type.strip().lower() not in settings.COMPRESSION_CONTENT_TYPES:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        coding = negotiate(
+            request.META.get("HTTP_ACCEPT_ENCODING", ""), available_codings()
+        )
+        if coding is None:
+            return response
+        level = settings.COMPRESSION_LEVELS[coding]
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = acompress_stream(
+                    coding, level, response.streaming_content
+                )
+            else:
+                response.streaming_content = compress_stream(
+                    coding, level, response.streaming_content
+                )
+            # The length changes with compression
+            del response.headers["Content-Length"]
+        else:
+            compressed = compress(coding, response.content, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers["Content-Length"] = str(len(compressed))
+
+        # The compressed body is a different representation, so a strong
+        # ETag no longer applies to it (see locations.conditional)
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+
+        response.headers["Content-Encoding"] = coding
+        return response
@@ -0,0 +1,86 @@
+"""
+JSON renderer backed by orjson, when it is installed.
+
+Tree and export responses can be tens of MB, and stdlib ``json`` spends most
+of the request rendering them. orjson renders the same output several times
+faster. Values orjson doesn't handle natively (Decimal, lazy strings,
+querysets) and datetimes go through DRF's encoder, and data orjson rejects,
+such as dicts with non-string keys, is rendered by JSONRenderer. The output
+matches JSONRenderer except for floats: orjson doesn't pad exponents to
+two digits (1e-7 rather than 1e-07), and writes NaN and infinities as null
+where JSONRenderer fails. Without orjson, this is JSONRenderer.
+"""
+
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            # orjson only writes compact, unescaped UTF-8
+            or self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                # DRF formats datetimes with millisecond precision
+                option=orjson.OPT_PASSTHROUGH_DATETIME,
+            )
+        except TypeError:
+            # Such as non-string keys, which json converts or rejects itself
+            return super().render(data, accepted_media_type, renderer_context)
+        # Like JSONRenderer, escape the line separators that JavaScript
+        # doesn't accept in string literals
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
+
+
+class NDJSONRenderer(FastJSONRenderer):
+    """
+    Newline-delimited JSON, one item per line. Views stream it themselves
+    (see locations.views.location_export); this renders the other responses
+    of those views, such as errors, as a single line.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return self.render_lines([data])
+
+    def render_lines(self, items):
+        render = super().render
+        return b"".join(render(item) + b"\n" for item in items)
+
+
+class ZipRenderer(FastJSONRenderer):
+    """
+    ZIP archives, which views stream themselves (see
+    locations.views.location_export); this renders the other responses of
+    those views, such as errors, as JSON.
+    """
+
+    media_type = "application/zip"
+    format = "zip"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get("response")
+        if response is not None:
+            # Not an archive, so don't label it as one
+            response["Content-Type"] = JSONRenderer.media_type
+        return super().render(data, accepted_media_type, renderer_context)
@@ -36,6 +36,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "jaaybaanbackend.middleware.CompressionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -101,15 +102,72 @@ STATIC_URL = "static/"
 # Media files (uploads)
 MEDIA_URL = "/media/"
 
+# Chunked image uploads
+CHUNKED_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRATION = 24 * 60 * 60  # seconds of inactivity
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Cache timeout (seconds) for tree, statistics and breadcrumb responses. The
+# entries are keyed by the tree version, so writes never make them stale.
+LOCATIONS_CACHE_TIMEOUT = 60 * 60
+
+# How often (seconds) time-dependent values such as needs_cleaning are
+# recomputed in cached responses
+LOCATIONS_CLEANING_STATUS_TTL = 5 * 60
+
+# Directory for the file locks that coalesce cache fills across worker
+# processes; None coalesces only the threads of each worker
+LOCATIONS_SINGLEFLIGHT_LOCK_DIR = None
+
+# How siblings are ordered (see locations.models.TreeOrder): "sorted" keeps
+# them in name order in the tree paths, "append" keeps the paths in insertion
+# order and sorts by sort_name when reading, so inserts don't rewrite paths
+LOCATIONS_TREE_MODE = config("TREE_MODE", default="sorted")
+
+# How tree paths are keyed: characters per level and the digits of each step,
+# in sort order. Changing them needs the paths re-keyed first (see
+# locations/rekey.py and the tree_capacity command).
+LOCATIONS_TREE_STEPLEN = config("TREE_STEPLEN", default=4, cast=int)
+LOCATIONS_TREE_ALPHABET = config(
+    "TREE_ALPHABET", default="0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+)
+
+# How long (seconds) a token -> user lookup is served from the cache. Logout,
+# token regeneration and user changes evict entries immediately.
+AUTH_TOKEN_CACHE_TIMEOUT = 5 * 60
+
+# Response compression (see jaaybaanbackend/middleware.py): content codings
+# in order of preference, with their levels. zstd and br are only offered
+# when the zstandard / brotli packages are installed.
+COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+COMPRESSION_MIN_SIZE = 1024  # bytes
+COMPRESSION_CONTENT_TYPES = ["application/json", "application/x-ndjson"]
+
+# Batch requests (see locations/batch.py): maximum operations per batch, and
+# how long (seconds) responses are kept for Idempotency-Key retries
+BATCH_MAX_OPERATIONS = 50
+BATCH_IDEMPOTENCY_KEY_EXPIRATION = 24 * 60 * 60
+
+# Serve the reads of the list, detail, search, tree and statistics endpoints
+# with the async views (see locations/async_views.py); for the ASGI server
+LOCATIONS_ASYNC_VIEWS = config("ASYNC_VIEWS", default=False, cast=bool)
+
+# Live change events (see locations/events.py): seconds between keep-alive
+# comments on idle streams, events queued for a slow client before it is
+# told to resync, and most changes replayed to a client that reconnects
+EVENTS_HEARTBEAT_INTERVAL = 15
+EVENTS_QUEUE_SIZE = 1000
+EVENTS_REPLAY_LIMIT = 1000
+
 # REST Framework Configuration
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "authentication.authentication.CachedTokenAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -120,6 +178,11 @@ REST_FRAMEWORK = {
         "django_filters.rest_framework.DjangoFilterBackend",
     ],
     "DEFAULT_RENDERER_CLASSES": [
-        "rest_framework.renderers.JSONRenderer",
+        "jaaybaanbackend.renderers.FastJSONRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "jaaybaanbackend.parsers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
     ],
 }
@@ -25,6 +25,13 @@ STATIC_ROOT = BASE_DIR / "static"
 
 # Media files
 MEDIA_ROOT = BASE_DIR / "media"
+CHUNKED_UPLOAD_DIR = MEDIA_ROOT / "chunked_uploads"
+
+# Offline SQLite snapshots, one per tree version (see locations/snapshot.py)
+LOCATIONS_SNAPSHOT_DIR = BASE_DIR / "cache" / "snapshots"
+
+# Backups written by backup_inventory (see locations/backup.py)
+LOCATIONS_BACKUP_DIR = BASE_DIR / "backups"
 
 # CORS settings for frontend communication
 CORS_ALLOWED_ORIGINS = [
@@ -39,6 +39,7 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 # Media files configuration
 MEDIA_URL = "/media/"
 MEDIA_ROOT = "/app/media"
+CHUNKED_UPLOAD_DIR = "/app/media/chunked_uploads"
 
 
 CORS_ALLOW_ALL_ORIGINS = False
@@ -121,18 +122,29 @@ LOGGING = {
 }
 
 # Cache configuration
+# A single SQLite file shared by all gunicorn workers, so cached responses and
+# invalidations (the tree version) are seen by every worker.
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "unique-snowflake",
+        "BACKEND": "jaaybaanbackend.sqlite_cache.SQLiteCache",
+        "LOCATION": config("CACHE_LOCATION", default="/app/cache/cache.sqlite3"),
         "TIMEOUT": 300,
         "OPTIONS": {
-            "MAX_ENTRIES": 1000,
+            "MAX_ENTRIES": 10000,
             "CULL_FREQUENCY": 3,
         },
     }
 }
 
+# Coalesce identical cache fills across workers, not only across threads
+LOCATIONS_SINGLEFLIGHT_LOCK_DIR = "/app/cache/locks"
+
+# Offline SQLite snapshots, one per tree version (see locations/snapshot.py)
+LOCATIONS_SNAPSHOT_DIR = "/app/cache/snapshots"
+
+# Backups written by backup_inventory (see locations/backup.py)
+LOCATIONS_BACKUP_DIR = "/app/backups"
+
 SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
 SESSION_CACHE_ALIAS = "default"
 
@@ -140,7 +152,12 @@ SESSION_CACHE_ALIAS = "default"
 REST_FRAMEWORK.update(
     {
         "DEFAULT_RENDERER_CLASSES": [
-            "rest_framework.renderers.JSONRenderer",
+            "jaaybaanbackend.renderers.FastJSONRenderer",
+        ],
+        "DEFAULT_PARSER_CLASSES": [
+            "jaaybaanbackend.parsers.FastJSONParser",
+            "rest_framework.parsers.FormParser",
+            "rest_framework.parsers.MultiPartParser",
         ],
         "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
         "PAGE_SIZE": 50,
@@ -0,0 +1,219 @@
+"""
+SQLite-backed Django cache.
+
+LocMemCache is private to each gunicorn worker, so workers can't share hits
+or see each other's invalidations. This backend keeps the cache in a single
+SQLite file (WAL mode) that every worker process opens, giving a shared,
+persistent cache without running a separate cache service.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_entries_expires ON cache_entries (expires);
+"""
+
+
+class SQLiteCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    # Check the number of entries every N writes per connection rather than
+    # on every write
+    cull_check_interval = 100
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location
+        self._local = threading.local()
+        options = params.get("OPTIONS", {})
+        self._busy_timeout = options.get("BUSY_TIMEOUT", 5)
+
+    def _connection(self):
+        # Connections must not be shared across threads, nor survive a fork
+        # (gunicorn forks workers after the settings are loaded).
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            connection = sqlite3.connect(
+                self._path, timeout=self._busy_timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.writes = 0
+        return connection
+
+    def _expired(self, expires):
+        return expires is not None and expires <= time.time()
+
+    def _dumps(self, value):
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._connection()
+            .execute("SELECT value, expires FROM cache_entries WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None or self._expired(row[1]):
+            return default
+        return pickle.loads(row[0])
+
+    def get_many(self, keys, version=None):
+        key_map = {
+            self.make_and_validate_key(key, version=version): key for key in keys
+        }
+        if not key_map:
+            return {}
+        placeholders = ", ".join("?" * len(key_map))
+        rows = self._connection().execute(
+            f"SELECT key, value, expires FROM cache_entries WHERE key IN ({placeholders})",
+            list(key_map),
+        )
+        return {
+            key_map[key]: pickle.loads(value)
+            for key, value, expires in rows
+            if not self._expired(expires)
+        }
+
+    def _write(self, sql, params):
+        connection = self._connection()
+        cursor = connection.execute(sql, params)
+        self._local.writes += 1
+        if self._local.writes % self.cull_check_interval == 0:
+            self._cull(connection)
+        return cursor
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._write(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)",
+            (key, self._dumps(value), self.get_backend_timeout(timeout)),
+        )
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        rows = [
+            (
+                self.make_and_validate_key(key, version=version),
+                self._dumps(value),
+                expires,
+            )
+            for key, value in data.items()
+        ]
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)",
+                rows,
+            )
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._write(
+            "INSERT INTO cache_entries (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+            "expires = excluded.expires WHERE cache_entries.expires <= ?",
+            (key, self._dumps(value), self.get_backend_timeout(timeout), time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._write(
+            "UPDATE cache_entries SET expires = ? "
+            "WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (self.get_backend_timeout(timeout), key, time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent
+        # increments from other workers serialize instead of losing updates.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT value, expires FROM cache_entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or self._expired(row[1]):
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            connection.execute(
+                "UPDATE cache_entries SET value = ? WHERE key = ?",
+                (self._dumps(value), key),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return value
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute(
+            "DELETE FROM cache_entries WHERE key = ?", (key,)
+        )
+        return cursor.rowcount > 0
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        if keys:
+            placeholders = ", ".join("?" * len(keys))
+            self._connection().execute(
+                f"DELETE FROM cache_entries WHERE key IN ({placeholders})", keys
+            )
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._connection()
+            .execute(
+                "SELECT 1 FROM cache_entries WHERE key = ? "
+                "AND (expires IS NULL OR expires > ?)",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache_entries")
+
+    def _cull(self, connection):
+        connection.execute(
+            "DELETE FROM cache_entries WHERE expires <= ?", (time.time(),)
+        )
+        (count,) = connection.execute("SELECT COUNT(*) FROM cache_entries").fetchone()
+        if count <= self._max_entries:
+            return
+        # Drop the entries closest to expiring, like the database backend
+        cull_count = count // self._cull_frequency if self._cull_frequency else count
+        connection.execute(
+            "DELETE FROM cache_entries WHERE key IN ("
+            "SELECT key FROM cache_entries WHERE expires IS NOT NULL "
+            "ORDER BY expires LIMIT ?)",
+            (cull_count,),
+        )
+
+    def close(self, **kwargs):
+        # Connections are reused for the life of the thread; Django calls
+        # close() after every request.
+        pass
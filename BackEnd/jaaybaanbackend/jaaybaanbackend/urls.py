@@ -19,6 +19,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from locations.views import location_batch
 from .health import health_check
 
 urlpatterns = [
@@ -31,6 +32,7 @@ urlpatterns = [
             [
                 path("auth/", include("authentication.urls")),
                 path("locations/", include("locations.urls")),
+                path("batch/", location_batch, name="batch"),
                 # Future endpoints can be easily added here:
             ]
         ),
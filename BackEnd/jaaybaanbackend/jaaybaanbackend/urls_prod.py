@@ -11,6 +11,7 @@ from django.views.generic import TemplateView
 from django.http import JsonResponse
 from django.views.decorators.cache import cache_page
 from django.views.static import serve
+from locations.views import location_batch
 
 
 def health_check(request):
@@ -24,6 +25,7 @@ def health_check(request):
 api_patterns = [
     path("auth/", include("authentication.urls")),
     path("locations/", include("locations.urls")),
+    path("batch/", location_batch, name="batch"),
 ]
 
 urlpatterns = [
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django import forms
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 from treebeard.admin import TreeAdmin
+from . import changes
 from .models import Location, LocationImage
 
 
@@ -28,6 +31,15 @@ class LocationAdminForm(forms.ModelForm):
             if parent:
                 self.fields["_ref_node_id"].initial = parent.pk
 
+        # Only the location's own images can be its primary image; the
+        # change is saved through LocationImage.set_primary()
+        if "primary_image" in self.fields:
+            self.fields["primary_image"].queryset = (
+                self.instance.images.all()
+                if self.instance.pk
+                else LocationImage.objects.none()
+            )
+
         # Filter parent choices to only show containers
         self.fields["_ref_node_id"].queryset = Location.objects.filter(
             is_container=True
@@ -47,6 +59,24 @@ class LocationAdminForm(forms.ModelForm):
         return cleaned_data
 
 
+class PrimaryImageFilter(admin.SimpleListFilter):
+    """is_primary, which is derived from Location.primary_image"""
+
+    title = "primary"
+    parameter_name = "is_primary"
+
+    def lookups(self, request, model_admin):
+        return (("1", "Yes"), ("0", "No"))
+
+    def queryset(self, request, queryset):
+        primary = Exists(Location.objects.filter(primary_image=OuterRef("pk")))
+        if self.value() == "1":
+            return queryset.filter(primary)
+        if self.value() == "0":
+            return queryset.exclude(primary)
+        return queryset
+
+
 class LocationImageInline(admin.TabularInline):
     model = LocationImage
     extra = 1
@@ -198,5 +228,11 @@ class LocationAdmin(TreeAdmin):
 @admin.register(LocationImage)
 class LocationImageAdmin(admin.ModelAdmin):
     list_display = ("location", "description", "is_primary", "created_at", "updated_at")
-    list_filter = ("is_primary", "created_at", "updated_at")
+    list_filter = (PrimaryImageFilter, "created_at", "updated_at")
+    list_select_related = ("location",)
     readonly_fields = ("created_at", "updated_at")
+
+    def delete_queryset(self, request, queryset):
+        # The images' locations are updated before the change log
+        with transaction.atomic(), changes.deferred():
+            super().delete_queryset(request, queryset)
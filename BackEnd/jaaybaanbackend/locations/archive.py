@@ -0,0 +1,223 @@
+"""
+Inventory archives: the locations and images with their image files in one
+ZIP, for moving an inventory to another install.
+
+An archive is written while it is streamed, without a temporary file: the
+ZIP goes to an unseekable output that is drained after every write, so only
+a block of data and the central directory (a small record per entry) are
+held in memory, however large the inventory and its images are. Entries are
+followed by data descriptors instead of having their sizes written back,
+and ZIP64 records are used once the archive grows past 4 GiB.
+
+The archive holds the rows of the backups (see locations.backup), which
+unlike the export lines keep the tree paths, and is imported by the same
+bulk insert. Locations and images are each read by a single query, but not
+in the same snapshot: images whose location was deleted in between are
+left out on import, as are primary images deleted in between, and image
+files deleted in between are listed in the manifest as missing.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+from datetime import UTC, datetime
+from itertools import batched
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from . import backup, changes, rekey
+from .models import Location, LocationImage
+
+FORMAT_VERSION = 1
+
+CONTENT_TYPE = "application/zip"
+
+MANIFEST = "manifest.json"
+
+MEDIA_DIR = "media"
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Table files, in import order
+TABLES = {"locations": Location, "images": LocationImage}
+
+
+class Output(io.RawIOBase):
+    """An unseekable file keeping what is written to it until drained"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# Export
+
+
+def stream_archive(batch_size=backup.BATCH_SIZE):
+    """The archive of the inventory, in chunks"""
+    output = Output()
+    archive = zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED)
+    now = datetime.now(UTC)
+    manifest = {
+        "format": FORMAT_VERSION,
+        "created_at": now.isoformat(),
+        # Read before the data, so syncing from it can only repeat changes
+        "change_seq": changes.current_seq(),
+        "keying": rekey.current_keying(),
+        "files": {},
+    }
+    for name, model in TABLES.items():
+        manifest["files"][name] = yield from write_table(
+            archive, output, name, model, batch_size
+        )
+    manifest["media"] = yield from write_media(archive, output, batch_size)
+    archive.writestr(
+        zipfile.ZipInfo(MANIFEST, time.localtime()[:6]),
+        json.dumps(manifest, indent=2),
+    )
+    archive.close()
+    yield output.drain()
+
+
+def write_table(archive, output, name, model, batch_size):
+    """
+    Write the rows of ``model`` as in backups, yielding the output as it is
+    written, and return their stats for the manifest
+    """
+    names = backup.columns(model)
+    rows = model.objects.order_by("pk").values_list(*names)
+    digest = hashlib.sha256()
+    count = 0
+    info = zipfile.ZipInfo(f"{name}.ndjson", time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    # The size isn't known up front
+    with archive.open(info, "w", force_zip64=True) as out:
+        for batch in batched(rows.iterator(chunk_size=batch_size), batch_size):
+            data = backup.encode_rows(batch)
+            digest.update(data)
+            out.write(data)
+            count += len(batch)
+            yield output.drain()
+    yield output.drain()
+    return {"columns": names, "rows": count, "sha256": digest.hexdigest()}
+
+
+def write_media(archive, output, batch_size):
+    """Write the image files, yielding the output block by block"""
+    stored, missing = 0, []
+    names = LocationImage.objects.order_by("pk").values_list("image", flat=True)
+    for name in names.iterator(chunk_size=batch_size):
+        try:
+            file = open(os.path.join(settings.MEDIA_ROOT, name), "rb")
+        except FileNotFoundError:
+            # Deleted since the images were read, or lost
+            missing.append(name)
+            continue
+        with file:
+            stat = os.fstat(file.fileno())
+            info = zipfile.ZipInfo(
+                f"{MEDIA_DIR}/{name}", time.localtime(stat.st_mtime)[:6]
+            )
+            info.file_size = stat.st_size
+            # Images are compressed already
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, "w") as out:
+                while block := file.read(READ_BLOCK_SIZE):
+                    out.write(block)
+                    yield output.drain()
+        yield output.drain()
+        stored += 1
+    return {"files": stored, "missing": missing}
+
+
+# Import
+
+
+def read_manifest(archive):
+    try:
+        manifest = json.loads(archive.read(MANIFEST))
+    except KeyError:
+        raise backup.BackupError(f"{archive.filename} is not a complete archive")
+    if manifest.get("format") != FORMAT_VERSION:
+        raise backup.BackupError(f"{archive.filename} has an unknown archive format")
+    backup.check_keying(manifest, archive.filename)
+    return manifest
+
+
+def table_rows(archive, manifest, name):
+    with archive.open(f"{name}.ndjson") as fh:
+        yield from backup.decode_rows(fh, manifest["files"][name], name)
+
+
+def import_archive(path, replace=False, media=True):
+    """
+    Import the archive at ``path``, replacing the locations and images.
+    Refuses to replace an inventory that isn't empty unless ``replace``.
+    Returns the manifest and the number of locations and images imported.
+    """
+    with zipfile.ZipFile(path) as archive:
+        manifest = read_manifest(archive)
+        if not replace and (
+            Location.objects.exists() or LocationImage.objects.exists()
+        ):
+            raise backup.BackupError(
+                "The inventory isn't empty; use replace to overwrite it"
+            )
+        if media:
+            extract_media(archive)
+
+        location_ids = set()
+
+        def locations():
+            for row in table_rows(archive, manifest, "locations"):
+                location_ids.add(row["id"])
+                yield row
+
+        # Read once the locations are inserted
+        images = (
+            row
+            for row in table_rows(archive, manifest, "images")
+            if row["location_id"] in location_ids
+        )
+        with transaction.atomic():
+            inserted = backup.replace_inventory(locations(), images)
+            # Primary images deleted between reading the two tables
+            Location.objects.filter(primary_image__isnull=False).exclude(
+                Exists(LocationImage.objects.filter(pk=OuterRef("primary_image_id")))
+            ).update(primary_image=None)
+    return manifest, {name: len(inserted[model]) for name, model in TABLES.items()}
+
+
+def extract_media(archive):
+    """Put the image files of the archive into MEDIA_ROOT"""
+    prefix = f"{MEDIA_DIR}/"
+    for info in archive.infolist():
+        name = info.filename.removeprefix(prefix)
+        if name == info.filename or info.is_dir():
+            continue
+        if os.path.isabs(name) or ".." in name.split("/"):
+            raise backup.BackupError(f"{info.filename} is outside the media files")
+        target = os.path.join(settings.MEDIA_ROOT, name)
+        if os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with archive.open(info) as source, open(target, "wb") as out:
+            shutil.copyfileobj(source, out, READ_BLOCK_SIZE)
@@ -0,0 +1,361 @@
+"""
+Async views for the read-heavy locations endpoints, served under ASGI.
+
+Under the gthread WSGI server every request holds one of a few threads until
+its response is sent, so a handful of slow exports or slow clients starve
+everything else. These views give the same responses as their DRF
+counterparts in views.py, with queries going through the async ORM and rows
+through the fast_serializers build step; a request only holds a thread while
+one of its queries runs. With LOCATIONS_ASYNC_VIEWS, urls.py serves GET and
+HEAD with them and hands the other methods to the DRF views.
+
+DRF views can't be async, so authentication, pagination and error responses
+are done here with DRF's own classes. Responses are always JSON.
+"""
+
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework.views import exception_handler
+
+from jaaybaanbackend.renderers import FastJSONRenderer
+from . import changes, events, fast_serializers
+from .cache import aget_tree_version, cleaning_epoch, get_or_compute
+from .conditional import atree_etag, location_row_etag, not_modified, set_etag
+from .models import Location
+from .serializers import (
+    LocationEventsSerializer,
+    LocationSearchSerializer,
+    LocationSerializer,
+)
+from .views import LocationPagination, build_tree, compute_statistics
+
+SEARCH_COLUMNS = [
+    "id",
+    "path",
+    "name",
+    "description",
+    "barcode",
+    "cleaned_time",
+    "cleaned_duration",
+]
+
+
+def render(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(
+        FastJSONRenderer().render(data),
+        status=status_code,
+        content_type=FastJSONRenderer.media_type,
+    )
+
+
+def api_error(request, exc):
+    """The response DRF's exception handler gives ``exc``, rendered as JSON"""
+    if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+        # As APIView.handle_exception() does
+        authenticators = request.authenticators
+        header = (
+            authenticators[0].authenticate_header(request) if authenticators else None
+        )
+        if header:
+            exc.auth_header = header
+        else:
+            exc.status_code = status.HTTP_403_FORBIDDEN
+
+    response = exception_handler(exc, {"request": request, "view": None})
+    if response is None:
+        raise exc
+    error = render(response.data, response.status_code)
+    for name in ("WWW-Authenticate", "Retry-After"):
+        if name in response:
+            error[name] = response[name]
+    return error
+
+
+def async_api_view(view):
+    """
+    @api_view with IsAuthenticated, for async views: ``view`` gets the DRF
+    Request of an authenticated user, and API errors become JSON responses.
+    """
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request = Request(
+            request,
+            authenticators=[
+                auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+            ],
+        )
+        try:
+            # Authentication may query the database
+            user = await sync_to_async(lambda: request.user)()
+            if not user.is_authenticated:
+                raise exceptions.NotAuthenticated()
+            return await view(request, *args, **kwargs)
+        except Exception as exc:
+            return api_error(request, exc)
+
+    return wrapper
+
+
+def with_async_reads(read_view, view):
+    """Serve GET and HEAD with the async ``read_view``, the rest with ``view``"""
+
+    async def dispatch(request, *args, **kwargs):
+        if request.method in ("GET", "HEAD"):
+            return await read_view(request, *args, **kwargs)
+        return await sync_to_async(view)(request, *args, **kwargs)
+
+    # Like the DRF views, which do their own CSRF checks
+    dispatch.csrf_exempt = True
+    # For callers in a sync view, such as batch requests
+    dispatch.sync_view = view
+    return dispatch
+
+
+async def paginate(request, queryset):
+    """
+    LocationPagination.paginate_queryset() and get_paginated_response() with
+    the async ORM: the rows of the requested page, and a function building
+    the paginated response data from their output.
+    """
+    pagination = LocationPagination()
+    page_size = pagination.get_page_size(request)
+    paginator = Paginator(queryset, page_size)
+    paginator.count = await queryset.acount()
+    try:
+        number = paginator.validate_number(
+            request.query_params.get(pagination.page_query_param) or 1
+        )
+    except InvalidPage as exc:
+        raise exceptions.NotFound(
+            pagination.invalid_page_message.format(
+                page_number=request.query_params.get(pagination.page_query_param),
+                message=str(exc),
+            )
+        )
+
+    bottom = (number - 1) * page_size
+    rows = [row async for row in queryset[bottom : bottom + page_size]]
+
+    url = request.build_absolute_uri()
+    query_param = pagination.page_query_param
+    next_url = previous_url = None
+    if number < paginator.num_pages:
+        next_url = replace_query_param(url, query_param, number + 1)
+    if number == 2:
+        previous_url = remove_query_param(url, query_param)
+    elif number > 2:
+        previous_url = replace_query_param(url, query_param, number - 1)
+
+    def response_data(results):
+        return {
+            "count": paginator.count,
+            "next": next_url,
+            "previous": previous_url,
+            "results": results,
+        }
+
+    return rows, response_data
+
+
+async def paginated_locations(request, queryset, fields, context=None):
+    """A paginated LocationSerializer(fields=fields) response of a queryset"""
+    queryset = fast_serializers.location_rows(
+        queryset, fast_serializers.location_columns(fields)
+    )
+    rows, response_data = await paginate(request, queryset)
+    data = fast_serializers.build_locations(
+        rows,
+        fields=fields,
+        context=context,
+        **await fast_serializers.afetch_locations(rows, fields),
+    )
+    return render(response_data(data))
+
+
+@async_api_view
+async def location_list(request):
+    """GET of views.LocationListCreateView"""
+    fields = LocationSerializer.select_fields(request.query_params)
+    queryset = Location.objects.all()
+    order = ["path"]
+    parent_id = request.query_params.get("parent_id")
+    location_type = request.query_params.get("location_type")
+
+    if parent_id:
+        order = Location.sibling_order()
+        if parent_id == "root":
+            queryset = Location.get_root_nodes()
+        else:
+            parent = await aget_object_or_404(Location, id=parent_id)
+            queryset = parent.get_children()
+
+    if location_type:
+        queryset = queryset.filter(location_type=location_type)
+
+    return await paginated_locations(
+        request, queryset.order_by(*order), fields, {"request": request}
+    )
+
+
+@async_api_view
+async def location_detail(request, pk):
+    """GET of views.LocationDetailView"""
+    fields = LocationSerializer.select_fields(request.query_params)
+    version = await aget_tree_version()
+    columns = fast_serializers.location_columns(fields)
+    row = await aget_object_or_404(Location.objects.values(*columns), pk=pk)
+    etag = location_row_etag(row, version)
+    response = not_modified(request, etag)
+    if response is None:
+        [data] = fast_serializers.build_locations(
+            [row],
+            fields=fields,
+            context={"request": request},
+            **await fast_serializers.afetch_locations([row], fields),
+        )
+        response = render(data)
+    return set_etag(response, etag)
+
+
+def search_matches(row, query, names):
+    """The text search of views.location_search, on a row"""
+    return (
+        query in row["name"].lower()
+        or (row["description"] and query in row["description"].lower())
+        or (row["barcode"] and query in row["barcode"].lower())
+        or query in fast_serializers.breadcrumb(row["path"], row["name"], names).lower()
+    )
+
+
+@async_api_view
+async def location_search(request):
+    """
+    views.location_search. The text and cleaning filters run on rows instead
+    of model instances, after the database filters, with the breadcrumbs
+    built from one query for the names of all ancestors.
+    """
+    fields = LocationSerializer.select_fields(request.query_params)
+    serializer = LocationSearchSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return render(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+    query = serializer.validated_data.get("query")
+    location_type = serializer.validated_data.get("location_type")
+    needs_cleaning = serializer.validated_data.get("needs_cleaning")
+    has_barcode = serializer.validated_data.get("has_barcode")
+    parent_id = serializer.validated_data.get("parent_id")
+
+    queryset = Location.objects.all()
+    if location_type:
+        queryset = queryset.filter(location_type=location_type)
+    if has_barcode is not None:
+        if has_barcode:
+            queryset = queryset.exclude(barcode__isnull=True).exclude(barcode="")
+        else:
+            queryset = queryset.filter(Q(barcode__isnull=True) | Q(barcode=""))
+    if parent_id:
+        parent = await aget_object_or_404(Location, id=parent_id)
+        queryset = queryset.filter(id__in=parent.get_descendants())
+
+    if query or needs_cleaning is not None:
+        rows = [row async for row in queryset.values(*SEARCH_COLUMNS)]
+        if query:
+            query = query.lower()
+            names = await fast_serializers.afetch_names(rows)
+            rows = [row for row in rows if search_matches(row, query, names)]
+        if needs_cleaning is not None:
+            now = timezone.now()
+            rows = [
+                row
+                for row in rows
+                if fast_serializers.needs_cleaning(row, now) == needs_cleaning
+            ]
+        queryset = Location.objects.filter(id__in=[row["id"] for row in rows])
+
+    return await paginated_locations(request, queryset, fields)
+
+
+@async_api_view
+async def location_tree(request):
+    """
+    views.location_tree. The tree is cached and its fills coalesced by the
+    thread-based single-flight, so a miss is computed in a thread.
+    """
+    parent_id = request.query_params.get("parent_id")
+    etag = await atree_etag("tree", parent_id or "root")
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    data = await sync_to_async(get_or_compute)(
+        "tree", lambda: build_tree(parent_id), parent_id or "root"
+    )
+    return set_etag(render(data), etag)
+
+
+@async_api_view
+async def location_statistics(request):
+    """views.location_statistics; cached like the tree"""
+    epoch = cleaning_epoch()
+    etag = await atree_etag("statistics", epoch)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    stats = await sync_to_async(get_or_compute)("statistics", compute_statistics, epoch)
+    return set_etag(render(stats), etag)
+
+
+@require_GET
+@async_api_view
+async def location_events(request):
+    """
+    Stream change events as server-sent events. Only served under ASGI: an
+    open stream costs a queue there, not a thread.
+    """
+    if not isinstance(request._request, ASGIRequest):
+        return render(
+            {"detail": "Live events are only served by the ASGI server."},
+            status.HTTP_501_NOT_IMPLEMENTED,
+        )
+
+    data = {}
+    since = request.headers.get("Last-Event-ID", request.query_params.get("since"))
+    if since is not None:
+        data["since"] = since
+    serializer = LocationEventsSerializer(data=data)
+    if not serializer.is_valid():
+        return render(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+    # Subscribe before reading the replay, so no change falls in between
+    subscription = events.broadcaster.subscribe()
+    replayed = []
+    if "since" in serializer.validated_data:
+        try:
+            replayed = await sync_to_async(changes.change_events)(
+                serializer.validated_data["since"], settings.EVENTS_REPLAY_LIMIT
+            )
+        except BaseException:
+            events.broadcaster.unsubscribe(subscription)
+            raise
+
+    response = StreamingHttpResponse(
+        events.stream(subscription, replayed), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Don't let nginx buffer the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,551 @@
+"""
+Logical backups of the inventory: users, tokens, locations and images, with
+the image files.
+
+A backup is a directory with one gzipped NDJSON file per table, the media
+files and a manifest recording, for every file, its columns, row count and
+SHA-256. Every table is read in one snapshot of the database: on PostgreSQL
+a REPEATABLE READ transaction exports its snapshot with pg_export_snapshot()
+and the tables are dumped in parallel by threads that import it, so the
+files agree with each other without locking out writers.
+
+An incremental backup only holds the locations and images changed since
+its base backup, found in the change log, plus the id of every location and
+image (and the tree columns of every location, which moves rewrite without
+logging the descendants), so deletions and moves carry over. Restoring one
+loads its full base backup and applies the chain of incremental backups on
+top, in a single pass of bulk inserts. Group and permission memberships of
+users aren't backed up.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, date, datetime
+from decimal import Decimal
+from itertools import batched
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from rest_framework.authtoken.models import Token
+
+from authentication.authentication import evict_token
+from . import changes, rekey
+from .cache import schedule_tree_version_bump
+from .models import Location, LocationChange, LocationImage, sort_key
+
+FORMAT_VERSION = 1
+
+MANIFEST = "manifest.json"
+
+COMPRESS_LEVEL = 6
+
+BATCH_SIZE = 1000
+
+MEDIA_DIR = "media"
+MEDIA_TAR = "media.tar"
+
+# Table files, in restore order
+MODELS = {
+    "users": User,
+    "tokens": Token,
+    "locations": Location,
+    "images": LocationImage,
+}
+
+# The tables that incremental backups only hold the changed rows of, with
+# the file listing the ids (and tree columns) of all rows
+INCREMENTAL_FILES = {"locations": "tree", "images": "image_ids"}
+TREE_COLUMNS = ["id", "path", "depth", "numchild"]
+
+
+class BackupError(Exception):
+    """
+    Raised when a backup (or archive, see locations.archive) can't be
+    written, or can't be restored as is
+    """
+
+
+def columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def backup_name(when):
+    return when.astimezone(UTC).strftime("backup-%Y%m%dT%H%M%S%fZ")
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        raise BackupError(f"{path} is not a complete backup")
+    if manifest.get("format") != FORMAT_VERSION:
+        raise BackupError(f"{path} has an unknown backup format")
+    check_keying(manifest, path)
+    return manifest
+
+
+def check_keying(manifest, name):
+    """Paths keyed for another steplen or alphabet can't be restored as is"""
+    keying = manifest.get("keying", rekey.DEFAULT_KEYING)
+    if keying != rekey.current_keying():
+        raise BackupError(
+            f"{name} has paths keyed with steplen {keying['steplen']} and "
+            f"alphabet {keying['alphabet']}; restore it with those settings"
+        )
+
+
+def latest_backup(directory):
+    """The path of the latest complete backup in ``directory``, or None"""
+    if not os.path.isdir(directory):
+        return None
+    names = sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith("backup-")
+        and os.path.exists(os.path.join(directory, name, MANIFEST))
+    )
+    return os.path.join(directory, names[-1]) if names else None
+
+
+# Encoding
+
+
+def encode_value(value):
+    if isinstance(value, date):
+        # Unlike DjangoJSONEncoder, keep the microseconds
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot back up {type(value).__name__} values")
+
+
+def encode_rows(rows):
+    return b"".join(
+        json.dumps(
+            row, default=encode_value, ensure_ascii=False, separators=(",", ":")
+        ).encode()
+        + b"\n"
+        for row in rows
+    )
+
+
+def write_rows(path, rows):
+    """
+    Write ``rows`` (lists) to a gzipped NDJSON file and return its row count
+    and the SHA-256 of its uncompressed contents
+    """
+    digest = hashlib.sha256()
+    count = 0
+    with gzip.open(path, "wb", compresslevel=COMPRESS_LEVEL) as out:
+        for batch in batched(rows, BATCH_SIZE):
+            data = encode_rows(batch)
+            digest.update(data)
+            out.write(data)
+            count += len(batch)
+    return {"rows": count, "sha256": digest.hexdigest()}
+
+
+def table_digest(model):
+    """write_rows() stats of a table's current rows, without writing them"""
+    digest = hashlib.sha256()
+    count = 0
+    rows = model.objects.order_by("pk").values_list(*columns(model))
+    for batch in batched(rows.iterator(chunk_size=BATCH_SIZE), BATCH_SIZE):
+        digest.update(encode_rows(batch))
+        count += len(batch)
+    return {"rows": count, "sha256": digest.hexdigest()}
+
+
+def read_rows(path, stats):
+    """
+    The rows of a backup file as dicts, checking its row count and checksum
+    against ``stats`` from the manifest once it is read to the end
+    """
+    with gzip.open(path, "rb") as fh:
+        yield from decode_rows(fh, stats, path)
+
+
+def decode_rows(lines, stats, name):
+    """read_rows() of the NDJSON ``lines`` of the file ``name``"""
+    digest = hashlib.sha256()
+    count = 0
+    column_names = stats["columns"]
+    for line in lines:
+        digest.update(line)
+        count += 1
+        yield dict(zip(column_names, json.loads(line)))
+    if count != stats["rows"] or digest.hexdigest() != stats["sha256"]:
+        raise BackupError(f"{name} doesn't match its checksum in the manifest")
+
+
+# Backup
+
+
+def dump_queries(since):
+    """
+    file name -> (columns, queryset of value lists) of a backup, incremental
+    if ``since`` is the change seq of its base backup
+    """
+    queries = {
+        name: (columns(model), model.objects.order_by("pk"))
+        for name, model in MODELS.items()
+    }
+    if since is not None:
+        changed = changes.latest_changes(since).exclude(operation=LocationChange.DELETE)
+        for name, model, kind in (
+            ("locations", Location, LocationChange.LOCATION),
+            ("images", LocationImage, LocationChange.IMAGE),
+        ):
+            queryset = model.objects.filter(
+                pk__in=changed.filter(kind=kind).values("object_id")
+            )
+            queries[name] = (columns(model), queryset.order_by("pk"))
+        queries["tree"] = (TREE_COLUMNS, Location.objects.order_by("pk"))
+        queries["image_ids"] = (["id"], LocationImage.objects.order_by("pk"))
+    return {
+        name: (names, queryset.values_list(*names))
+        for name, (names, queryset) in queries.items()
+    }
+
+
+def in_snapshot(snapshot_id, dump):
+    """Call ``dump`` in a transaction that imports ``snapshot_id``"""
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot_id])
+            return dump()
+    finally:
+        # Threads don't return their connections to Django
+        connection.close()
+
+
+def backup(directory, incremental=False, media="link", jobs=4):
+    """
+    Write a backup into a new directory in ``directory`` and return its
+    path and manifest. ``media`` is "link" (hard links, or copies across
+    file systems), "tar" or "none".
+    """
+    base = latest_backup(directory) if incremental else None
+    if incremental and base is None:
+        raise BackupError(f"No backup in {directory} to base an incremental one on")
+    base_manifest = read_manifest(base) if base else None
+
+    now = datetime.now(UTC)
+    name = backup_name(now)
+    path = os.path.join(directory, name)
+    partial = os.path.join(directory, f".{name}.partial")
+    os.makedirs(partial)
+    try:
+        manifest = {
+            "format": FORMAT_VERSION,
+            "created_at": now.isoformat(),
+            "base": os.path.basename(base) if base else None,
+            "keying": rekey.current_keying(),
+            **dump_tables(partial, base_manifest, jobs),
+        }
+        manifest["media"] = copy_media(partial, manifest.pop("image_names"), media)
+        with open(os.path.join(partial, MANIFEST), "w") as fh:
+            json.dump(manifest, fh, indent=2)
+        os.rename(partial, path)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return path, manifest
+
+
+def dump_tables(path, base_manifest, jobs):
+    """Dump the tables into ``path``, in one snapshot of the database"""
+    with transaction.atomic():
+        snapshot_id = None
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SELECT pg_export_snapshot()")
+                [snapshot_id] = cursor.fetchone()
+        # With the change log writers ordered by seq (see changes.py), the
+        # snapshot holds exactly the changes up to this one
+        seq = changes.current_seq()
+        since = base_manifest["change_seq"] if base_manifest else None
+        queries = dump_queries(since)
+        image_names = []
+
+        def dump(name):
+            names, queryset = queries[name]
+            rows = queryset.iterator(chunk_size=BATCH_SIZE)
+            if name == "images":
+                rows = collect_names(rows, names.index("image"), image_names)
+            stats = write_rows(os.path.join(path, f"{name}.ndjson.gz"), rows)
+            return {"columns": names, **stats}
+
+        if snapshot_id is None:
+            # SQLite: every read of this transaction sees the same data
+            files = {name: dump(name) for name in queries}
+        else:
+            with ThreadPoolExecutor(jobs) as pool:
+                futures = {
+                    name: pool.submit(in_snapshot, snapshot_id, lambda n=name: dump(n))
+                    for name in queries
+                }
+                files = {name: future.result() for name, future in futures.items()}
+        totals = {name: model.objects.count() for name, model in MODELS.items()}
+    return {
+        "change_seq": seq,
+        "files": files,
+        "totals": totals,
+        "image_names": image_names,
+    }
+
+
+def collect_names(rows, index, names):
+    for row in rows:
+        names.append(row[index])
+        yield row
+
+
+def copy_media(path, image_names, mode):
+    """Store the image files of the backed up images in the backup"""
+    stored, missing = 0, []
+    if mode == "none":
+        return {"mode": mode, "files": 0, "missing": []}
+    archive = None
+    if mode == "tar":
+        archive = tarfile.open(os.path.join(path, MEDIA_TAR), "w")
+    try:
+        for name in image_names:
+            source = os.path.join(settings.MEDIA_ROOT, name)
+            if not os.path.exists(source):
+                # Deleted since the snapshot, or lost
+                missing.append(name)
+                continue
+            if archive is not None:
+                archive.add(source, arcname=name)
+            else:
+                link_or_copy(source, os.path.join(path, MEDIA_DIR, name))
+            stored += 1
+    finally:
+        if archive is not None:
+            archive.close()
+    return {"mode": mode, "files": stored, "missing": missing}
+
+
+def link_or_copy(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        # Another file system, or no hard links
+        shutil.copy2(source, target)
+
+
+# Restore
+
+
+def backup_chain(path):
+    """The manifests of the backups to restore ``path``, full backup first"""
+    chain = []
+    while True:
+        manifest = read_manifest(path)
+        chain.append((path, manifest))
+        if manifest["base"] is None:
+            return chain[::-1]
+        path = os.path.join(os.path.dirname(path), manifest["base"])
+        if not os.path.isdir(path):
+            raise BackupError(f"The base backup {manifest['base']} is missing")
+
+
+def table_rows(chain, name):
+    """
+    The rows of table ``name`` as of the last backup of the chain. Users and
+    tokens are in every backup in full. For locations and images, these are
+    the rows of the full backup without those deleted since, with the
+    changed rows of the incremental backups in their place and the new rows
+    after them.
+    """
+    last_path, last = chain[-1]
+    if len(chain) == 1 or name not in INCREMENTAL_FILES:
+        yield from read_rows(
+            os.path.join(last_path, f"{name}.ndjson.gz"), last["files"][name]
+        )
+        return
+
+    changed = {}
+    for path, manifest in chain[1:]:
+        for row in read_rows(
+            os.path.join(path, f"{name}.ndjson.gz"), manifest["files"][name]
+        ):
+            changed[row["id"]] = row
+    id_file = INCREMENTAL_FILES[name]
+    current = {
+        row["id"]: row
+        for row in read_rows(
+            os.path.join(last_path, f"{id_file}.ndjson.gz"), last["files"][id_file]
+        )
+    }
+    full_path, full = chain[0]
+    for row in read_rows(
+        os.path.join(full_path, f"{name}.ndjson.gz"), full["files"][name]
+    ):
+        if row["id"] in current:
+            yield {**changed.pop(row["id"], row), **current[row["id"]]}
+    for object_id, row in changed.items():
+        if object_id in current:
+            yield {**row, **current[object_id]}
+
+
+def build(model, rows):
+    """Model instances of backup rows, with the values converted back"""
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    for row in rows:
+        yield model(
+            **{
+                name: None if value is None else fields[name].to_python(value)
+                for name, value in row.items()
+                if name in fields
+            }
+        )
+
+
+def insert(model, objects):
+    """
+    Insert model instances as they are and return their ids. Like
+    bulk_create(), but a raw insert, so auto_now fields keep the backed up
+    timestamps.
+    """
+    fields = model._meta.concrete_fields
+    ids = []
+    for batch in batched(objects, BATCH_SIZE):
+        size = connection.ops.bulk_batch_size(fields, batch)
+        for chunk in batched(batch, size):
+            model.objects._insert(chunk, fields=fields, raw=True)
+        ids.extend(obj.pk for obj in batch)
+    return ids
+
+
+def restore(path, replace=False, media=True):
+    """
+    Restore the backup at ``path``, replacing the users, tokens, locations
+    and images. Refuses to replace an inventory that isn't empty unless
+    ``replace``. Returns the manifest of the backup.
+    """
+    chain = backup_chain(path)
+    manifest = chain[-1][1]
+    if not replace and (Location.objects.exists() or LocationImage.objects.exists()):
+        raise BackupError("The inventory isn't empty; use replace to overwrite it")
+    if media:
+        restore_media(chain)
+
+    with transaction.atomic():
+        old_tokens = list(Token.objects.values_list("key", flat=True))
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {Token._meta.db_table}")
+
+        users = list(build(User, table_rows(chain, "users")))
+        User.objects.exclude(pk__in=[user.pk for user in users]).delete()
+        User.objects.bulk_create(
+            users,
+            batch_size=BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[name for name in columns(User) if name != "id"],
+        )
+        insert(Token, build(Token, table_rows(chain, "tokens")))
+        reset_sequences([User])
+        replace_inventory(table_rows(chain, "locations"), table_rows(chain, "images"))
+        verify(chain)
+        # The authentication cache would keep accepting the replaced tokens
+        transaction.on_commit(lambda: evict_tokens(old_tokens))
+    return manifest
+
+
+def replace_inventory(locations, images):
+    """
+    Replace the locations and images with those of the ``locations`` and
+    ``images`` rows, inserted in bulk with their ids. Must be called in a
+    transaction. Returns the inserted ids by model.
+    """
+    old_locations = list(Location.objects.values_list("pk", flat=True))
+    old_images = list(LocationImage.objects.values_list("pk", flat=True))
+    with connection.cursor() as cursor:
+        for model in (LocationImage, Location):
+            cursor.execute(f"DELETE FROM {model._meta.db_table}")
+    inserted = {
+        Location: insert(Location, with_sort_names(build(Location, locations))),
+        LocationImage: insert(LocationImage, build(LocationImage, images)),
+    }
+    reset_sequences([Location, LocationImage])
+
+    # Synced clients see everything deleted, then everything inserted
+    for kind, old, new in (
+        (LocationChange.LOCATION, old_locations, inserted[Location]),
+        (LocationChange.IMAGE, old_images, inserted[LocationImage]),
+    ):
+        changes.record_changes(kind, old, LocationChange.DELETE)
+        changes.record_changes(kind, new, LocationChange.CREATE)
+    schedule_tree_version_bump()
+    return inserted
+
+
+def with_sort_names(locations):
+    """Backups from before sort_name was added don't have it"""
+    for location in locations:
+        location.sort_name = sort_key(location.name)
+        yield location
+
+
+def reset_sequences(models):
+    """Ids were inserted as they are, so move the sequences past them"""
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+def evict_tokens(keys):
+    for key in keys:
+        evict_token(key)
+
+
+def verify(chain):
+    """
+    Check that the restored tables have the row counts of the backup, and
+    the same contents where the backup holds them in full
+    """
+    manifest = chain[-1][1]
+    for name, model in MODELS.items():
+        if len(chain) == 1 or name not in INCREMENTAL_FILES:
+            expected = manifest["files"][name]
+            matches = table_digest(model) == {
+                "rows": expected["rows"],
+                "sha256": expected["sha256"],
+            }
+        else:
+            matches = model.objects.count() == manifest["totals"][name]
+        if not matches:
+            raise BackupError(f"The restored {name} don't match the backup")
+
+
+def restore_media(chain):
+    """Put the image files of the chain's backups back into MEDIA_ROOT"""
+    for path, manifest in chain:
+        if manifest["media"]["mode"] == "tar":
+            with tarfile.open(os.path.join(path, MEDIA_TAR)) as archive:
+                archive.extractall(settings.MEDIA_ROOT, filter="data")
+        elif manifest["media"]["mode"] == "link":
+            media_dir = os.path.join(path, MEDIA_DIR)
+            for root, _, files in os.walk(media_dir):
+                for name in files:
+                    source = os.path.join(root, name)
+                    target = os.path.join(
+                        settings.MEDIA_ROOT, os.path.relpath(source, media_dir)
+                    )
+                    if not os.path.exists(target):
+                        link_or_copy(source, target)
@@ -0,0 +1,242 @@
+"""
+Batch requests: an ordered list of locations API calls in one round trip.
+
+Every operation is dispatched to the regular view, so validation, errors and
+responses are exactly those of the individual endpoints, but the client is
+authenticated once for the whole batch and the operations share a single
+transaction. The first failing operation stops the batch, and the caller
+rolls back the ones before it.
+
+An operation can use the response of an earlier one by referring to it as
+``$<id>.<field>``: anywhere in its path (``/api/v1/locations/$box.id/move/``)
+or as a whole value in its body (``{"new_parent_id": "$box.id"}``).
+
+Responses of batches sent with an ``Idempotency-Key`` header are stored in
+the same transaction as their changes, so a retry of a batch that went
+through gets the stored response instead of running it again.
+"""
+
+import hashlib
+import io
+import json
+import re
+import secrets
+from datetime import timedelta
+from urllib.parse import unquote_to_bytes, urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import IntegrityError, transaction
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+BATCH_PATH_PREFIX = "/api/v1/locations/"
+
+REFERENCE = r"\$([A-Za-z_]\w*)((?:\.\w+)+)"
+PATH_REFERENCE = re.compile(REFERENCE)
+VALUE_REFERENCE = re.compile(f"^{REFERENCE}$")
+
+
+class BatchError(Exception):
+    """Raised when an operation cannot be dispatched"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def lookup(match, responses):
+    """The value a reference match points to in the earlier responses"""
+    name, fields = match.group(1), match.group(2).split(".")[1:]
+    if name not in responses:
+        raise BatchError(f"{match.group(0)}: no earlier operation has id {name!r}")
+    value = responses[name]
+    for field in fields:
+        try:
+            value = value[int(field)] if isinstance(value, list) else value[field]
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise BatchError(f"{match.group(0)}: not found in the response")
+    return value
+
+
+def resolve_references(value, responses):
+    """Replace the references in the values of a request body"""
+    if isinstance(value, str):
+        match = VALUE_REFERENCE.match(value)
+        return lookup(match, responses) if match else value
+    if isinstance(value, list):
+        return [resolve_references(item, responses) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_references(item, responses) for key, item in value.items()}
+    return value
+
+
+def quote_header(value):
+    """A form field or file name as browsers write it in multipart bodies"""
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def encode_multipart(boundary, data, files):
+    """
+    The multipart/form-data body of the ``data`` fields, whose values are
+    plain values or lists of them, and the ``files`` of an operation
+    """
+    lines = []
+    for name, value in data.items():
+        for item in value if isinstance(value, list) else [value]:
+            if item is None or isinstance(item, dict):
+                raise BatchError(
+                    f"{name}: only plain values and lists of them can be sent "
+                    "with files"
+                )
+            lines += [
+                f"--{boundary}".encode(),
+                f'Content-Disposition: form-data; name="{quote_header(name)}"'.encode(),
+                b"",
+                str(item).encode(),
+            ]
+    for name, file in files.items():
+        lines += [
+            f"--{boundary}".encode(),
+            f'Content-Disposition: form-data; name="{quote_header(name)}"; '
+            f'filename="{quote_header(file["name"])}"'.encode(),
+            f"Content-Type: {file['content_type']}".encode(),
+            b"",
+            file["content"],
+        ]
+    lines += [f"--{boundary}--".encode(), b""]
+    return b"\r\n".join(lines)
+
+
+def build_request(request, method, path, content, content_type, headers):
+    """A request for an operation, made over the connection of the batch"""
+    url = urlsplit(path)
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        # WSGI servers pass the path as bytes decoded as latin-1
+        "PATH_INFO": unquote_to_bytes(url.path).decode("iso-8859-1"),
+        "QUERY_STRING": url.query,
+        "CONTENT_TYPE": content_type,
+        "CONTENT_LENGTH": str(len(content)),
+        "SERVER_NAME": request.META.get("SERVER_NAME", "localhost"),
+        "SERVER_PORT": str(request.META.get("SERVER_PORT", "80")),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": request.META.get("REMOTE_ADDR", "127.0.0.1"),
+        "HTTP_HOST": request.get_host(),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(content),
+        "wsgi.errors": request.META.get("wsgi.errors", io.StringIO()),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers.items():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+    subrequest = WSGIRequest(environ)
+    # Authenticated as the batch, as DRF's Request takes these over
+    subrequest._force_auth_user = request.user
+    subrequest._force_auth_token = request.auth
+    return subrequest
+
+
+def dispatch(request, operation, responses):
+    """Run one operation through its view, as the batch's user"""
+    path = PATH_REFERENCE.sub(
+        lambda match: str(lookup(match, responses)), operation["path"]
+    )
+    url_path = urlsplit(path).path
+    if not url_path.startswith(BATCH_PATH_PREFIX):
+        raise BatchError(f"Only paths under {BATCH_PATH_PREFIX} can be batched")
+    try:
+        match = resolve(url_path)
+    except Resolver404:
+        raise BatchError(f"Not found: {url_path}", status_code=404)
+
+    body = resolve_references(operation["body"], responses)
+    if operation["files"]:
+        if not isinstance(body, dict):
+            raise BatchError("The body of an operation with files must be an object")
+        boundary = secrets.token_hex(16)
+        content = encode_multipart(boundary, body, operation["files"])
+        content_type = f"multipart/form-data; boundary={boundary}"
+    else:
+        content = json.dumps(body, cls=JSONEncoder).encode()
+        content_type = "application/json"
+
+    subrequest = build_request(
+        request, operation["method"], path, content, content_type, operation["headers"]
+    )
+
+    # The DRF view, not its async wrapper (see async_views.with_async_reads)
+    view = getattr(match.func, "sync_view", match.func)
+    response = view(subrequest, *match.args, **match.kwargs)
+    if response.streaming:
+        raise BatchError("Streaming responses cannot be batched")
+    return response
+
+
+def run_batch(request, operations):
+    """
+    Run ``operations``, as validated by BatchSerializer, in order. Return
+    the results so far and whether all of them succeeded; if not, the
+    caller must roll back its transaction.
+    """
+    responses = {}
+    results = []
+    for operation in operations:
+        result = {"id": operation.get("id")}
+        results.append(result)
+        try:
+            response = dispatch(request, operation, responses)
+        except BatchError as e:
+            result.update(status=e.status_code, body={"error": str(e)})
+            return results, False
+
+        body = getattr(response, "data", None)
+        result.update(status=response.status_code, body=body)
+        if response.status_code >= 400:
+            return results, False
+        if "id" in operation:
+            responses[operation["id"]] = body
+    return results, True
+
+
+def request_hash(data):
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"), cls=JSONEncoder)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def idempotency_cutoff():
+    return timezone.now() - timedelta(seconds=settings.BATCH_IDEMPOTENCY_KEY_EXPIRATION)
+
+
+def stored_response(user, key):
+    """The IdempotencyKey of an earlier batch with ``key``, unless expired"""
+    return IdempotencyKey.objects.filter(
+        user=user, key=key, created_at__gte=idempotency_cutoff()
+    ).first()
+
+
+def store_response(user, key, digest, status_code, data):
+    """
+    Store the response of a batch under ``key``, in the batch's transaction.
+    Return False if a concurrent batch with the same key got there first.
+    """
+    IdempotencyKey.objects.filter(created_at__lt=idempotency_cutoff()).delete()
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                user=user,
+                key=key,
+                request_hash=digest,
+                status_code=status_code,
+                response=json.loads(json.dumps(data, cls=JSONEncoder)),
+            )
+    except IntegrityError:
+        return False
+    return True
@@ -0,0 +1,98 @@
+"""
+Caching of the hot read paths (tree, statistics, breadcrumbs).
+
+Cached values are keyed by a global tree version that every Location and
+LocationImage write bumps once its transaction commits. A write therefore
+never has to find and delete the entries it affects: readers simply stop
+asking for the keys of the old version and those entries age out.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .singleflight import flights, worker_lock
+
+TREE_VERSION_KEY = "locations:tree-version"
+
+
+def get_tree_version():
+    """Return the current tree version, initializing it if needed"""
+    version = cache.get(TREE_VERSION_KEY)
+    if version is None:
+        # Start from the clock rather than 1, so a version lost to a cache
+        # clear or restart can never collide with keys written before it.
+        cache.add(TREE_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(TREE_VERSION_KEY)
+    return version
+
+
+async def aget_tree_version():
+    """get_tree_version() for async views, off the event loop"""
+    version = await cache.aget(TREE_VERSION_KEY)
+    if version is None:
+        await cache.aadd(TREE_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = await cache.aget(TREE_VERSION_KEY)
+    return version
+
+
+def bump_tree_version():
+    try:
+        return cache.incr(TREE_VERSION_KEY)
+    except ValueError:
+        return get_tree_version()
+
+
+def schedule_tree_version_bump():
+    """
+    Bump the tree version once the current transaction commits.
+
+    Bumping before the commit would let a concurrent reader cache data that
+    doesn't include the write under the new version.
+    """
+    transaction.on_commit(bump_tree_version)
+
+
+def cleaning_epoch():
+    """
+    A counter that advances every LOCATIONS_CLEANING_STATUS_TTL seconds.
+
+    ``needs_cleaning`` changes with the clock, not only with writes, so
+    values that include it are also keyed by this epoch.
+    """
+    return int(time.time() // settings.LOCATIONS_CLEANING_STATUS_TTL)
+
+
+def tree_cache_key(name, *parts):
+    suffix = ":".join(str(part) for part in parts)
+    return f"locations:{name}:{get_tree_version()}:{suffix}"
+
+
+def get_or_compute(name, compute, *parts, timeout=None):
+    """
+    Return the cached value of ``name`` for the current tree version,
+    computing and storing it on a miss.
+
+    Concurrent misses for the same key are coalesced, so a burst of
+    identical requests computes the value once. The cached values don't vary
+    by user, so the key (name, parts and tree version) is the whole scope.
+    """
+    key = tree_cache_key(name, *parts)
+    value = cache.get(key)
+    if value is None:
+        if timeout is None:
+            timeout = settings.LOCATIONS_CACHE_TIMEOUT
+        value = flights.do(key, lambda: fill(key, compute, timeout))
+    return value
+
+
+def fill(key, compute, timeout):
+    with worker_lock(key):
+        # Another worker may have stored the value while we waited
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, timeout)
+    return value
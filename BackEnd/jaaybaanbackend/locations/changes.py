@@ -0,0 +1,420 @@
+"""
+Change log of locations and their images, for delta sync.
+
+Every write appends a LocationChange entry in the write's own transaction, so
+the log never misses a committed change or shows an uncommitted one. A client
+that has seen everything up to ``seq`` asks for the changes after it and gets
+the latest change of each object that changed since, with the object's
+current data: syncing costs the size of what changed, not of the inventory.
+Entries are also published as live events (see events.py), so connected
+clients learn about changes without asking.
+
+Entries only record that an object changed, so older entries of an object
+are superseded by its latest one; compact() deletes them, except the create
+entries, which tell the export what is new since a seq.
+"""
+
+import threading
+from contextlib import contextmanager
+from itertools import batched
+
+from django.db import connection, transaction
+from django.db.models import Exists, Max, OuterRef, Q
+
+from . import events
+from .fast_serializers import (
+    STEPLEN,
+    TREE_COLUMNS,
+    compile_fields,
+    export_builder,
+    fetch_image_counts,
+    fetch_names,
+    location_rows,
+    row_builder,
+)
+from .models import Location, LocationChange, LocationImage
+from .serializers import LocationImageSerializer, LocationSerializer
+
+# Key of the PostgreSQL advisory lock that orders change log writers
+CHANGE_LOG_LOCK = 0x4A42_4348
+
+LOCATION_FIELDS = [
+    "id",
+    "parent_id",
+    "name",
+    "location_type",
+    "description",
+    "is_container",
+    "barcode",
+    "quantity",
+    "value",
+    "cleaned_time",
+    "cleaned_duration",
+    "primary_image_id",
+    "created_at",
+    "updated_at",
+]
+
+IMAGE_FIELDS = ["id", "location_id", "image", "description", "created_at"]
+
+# Operations whose events carry the location's (new) parent
+PARENT_OPERATIONS = (LocationChange.CREATE, LocationChange.MOVE)
+
+
+def change_event(seq, kind, object_id, operation, parent_id=None):
+    """The live event of a change log entry"""
+    event = {"seq": seq, "type": kind, "op": operation, "id": object_id}
+    if kind == LocationChange.LOCATION and operation in PARENT_OPERATIONS:
+        event["parent"] = parent_id
+    return event
+
+
+# Entries held back by deferred(), per thread
+_deferred = threading.local()
+
+
+def record_change(kind, object_id, operation, parent_id=None):
+    """
+    Append an entry to the change log and publish its event. Call it inside
+    the write's transaction; ``parent_id`` is the location's parent after a
+    create or move.
+    """
+    write_entries([(kind, object_id, operation, parent_id, True)])
+
+
+def record_changes(
+    kind, object_ids, operation, batch_size=1000, publish=False, parent_id=None
+):
+    """
+    Append an entry for each of many objects. Unless ``publish``, as for
+    bulk loads, no live events are published; clients pick the changes up
+    from the changes endpoint. ``parent_id`` is the parent of all the
+    locations, for the events of creates and moves.
+    """
+    write_entries(
+        [(kind, object_id, operation, parent_id, publish) for object_id in object_ids],
+        batch_size,
+    )
+
+
+@contextmanager
+def deferred():
+    """
+    Hold back the entries recorded in the block and write them when it ends,
+    for writes of several objects in one transaction, whose later row locks
+    would otherwise come after lock_change_log(). Use it inside the
+    transaction; entries of a block that raises or marks the transaction
+    for rollback are dropped.
+    """
+    if getattr(_deferred, "entries", None) is not None:
+        # Written by the outermost block
+        yield
+        return
+    _deferred.entries = entries = []
+    try:
+        yield
+    finally:
+        _deferred.entries = None
+    if not transaction.get_rollback():
+        write_entries(entries)
+
+
+def write_entries(entries, batch_size=1000):
+    """Insert (kind, object_id, operation, parent_id, publish) entries"""
+    pending = getattr(_deferred, "entries", None)
+    if pending is not None:
+        pending.extend(entries)
+        return
+    if not entries:
+        return
+    lock_change_log()
+    changes = LocationChange.objects.bulk_create(
+        (
+            LocationChange(kind=kind, object_id=object_id, operation=operation)
+            for kind, object_id, operation, _, _ in entries
+        ),
+        batch_size=batch_size,
+    )
+    events.publish_many(
+        [
+            change_event(change.seq, kind, object_id, operation, parent_id)
+            for change, (kind, object_id, operation, parent_id, publish) in zip(
+                changes, entries
+            )
+            if publish
+        ]
+    )
+
+
+def lock_change_log():
+    """Order the change log writers until the current transaction ends"""
+    if connection.vendor == "postgresql":
+        # Sequence values are taken in insert order but become visible in
+        # commit order, so a client could read seq 11 before a concurrent
+        # transaction commits seq 10 and then never see it. Holding a lock
+        # from the insert to the commit makes both orders the same.
+        #
+        # Take it after every row lock of the transaction: writers lock rows
+        # first, so one that locks a row while holding this lock can
+        # deadlock with a writer holding the row and waiting for this lock.
+        # Update the rows before recording their changes, and defer the
+        # entries of writes of several objects (see deferred()).
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CHANGE_LOG_LOCK])
+
+
+def current_seq():
+    """The seq of the latest change, 0 if there is none"""
+    return LocationChange.objects.aggregate(seq=Max("seq"))["seq"] or 0
+
+
+def latest_changes(since):
+    """The latest change of every object changed after ``since``, by seq"""
+    latest = (
+        LocationChange.objects.filter(seq__gt=since)
+        .values("kind", "object_id")
+        .annotate(latest=Max("seq"))
+        .values("latest")
+    )
+    return LocationChange.objects.filter(seq__in=latest).order_by("seq")
+
+
+def location_builder():
+    converters = compile_fields(LocationSerializer)
+    return row_builder(
+        LOCATION_FIELDS,
+        converters,
+        {
+            "parent_id": lambda row: row["parent_id"],
+            "primary_image_id": lambda row: row["primary_image_id"],
+        },
+    )
+
+
+def fetch_locations(ids):
+    """id -> row of the given locations, with their parent's id"""
+    rows = {
+        row["id"]: row
+        for row in Location.objects.filter(id__in=ids).values(
+            "path", *(name for name in LOCATION_FIELDS if name != "parent_id")
+        )
+    }
+    parent_paths = {row["path"][:-STEPLEN] for row in rows.values()} - {""}
+    parents = dict(
+        Location.objects.filter(path__in=parent_paths).values_list("path", "id")
+    )
+    for row in rows.values():
+        row["parent_id"] = parents.get(row["path"][:-STEPLEN])
+    return rows
+
+
+def fetch_images(ids):
+    return {
+        row["id"]: row
+        for row in LocationImage.objects.filter(id__in=ids).values(*IMAGE_FIELDS)
+    }
+
+
+def stream_changes(since, context=None, batch_size=500):
+    """
+    Delta lines for the changes after ``since``, in batches: the latest
+    change of each object, with its current data unless it was deleted.
+    """
+    kinds = {
+        LocationChange.LOCATION: (fetch_locations, location_builder()),
+        LocationChange.IMAGE: (
+            fetch_images,
+            row_builder(
+                IMAGE_FIELDS,
+                compile_fields(LocationImageSerializer, context),
+                {"location_id": lambda row: row["location_id"]},
+            ),
+        ),
+    }
+    changes = latest_changes(since).values_list("seq", "kind", "object_id", "operation")
+    for batch in batched(changes.iterator(chunk_size=batch_size), batch_size):
+        rows = {
+            kind: fetch(
+                [
+                    object_id
+                    for _, change_kind, object_id, operation in batch
+                    if change_kind == kind and operation != LocationChange.DELETE
+                ]
+            )
+            for kind, (fetch, _) in kinds.items()
+        }
+        lines = []
+        for seq, kind, object_id, operation in batch:
+            line = {"seq": seq, "type": kind, "op": operation, "id": object_id}
+            row = rows[kind].get(object_id)
+            if row is not None:
+                line["data"] = kinds[kind][1](row)
+            elif operation != LocationChange.DELETE:
+                # Deleted after the changes were read; its own entry comes
+                # with the next sync
+                line["op"] = LocationChange.DELETE
+            lines.append(line)
+        yield lines
+
+
+def change_events(since, limit):
+    """
+    The events of the latest changes after ``since``, to replay to a client
+    that reconnects, or None if there are more than ``limit``
+    """
+    latest = latest_changes(since).values_list("seq", "kind", "object_id", "operation")
+    batch = list(latest[: limit + 1])
+    if len(batch) > limit:
+        return None
+    rows = fetch_locations(
+        [
+            object_id
+            for _, kind, object_id, operation in batch
+            if kind == LocationChange.LOCATION and operation in PARENT_OPERATIONS
+        ]
+    )
+    replayed = []
+    for seq, kind, object_id, operation in batch:
+        parent_id = None
+        if kind == LocationChange.LOCATION and operation in PARENT_OPERATIONS:
+            if object_id in rows:
+                parent_id = rows[object_id]["parent_id"]
+            else:
+                # Deleted since, as in stream_changes()
+                operation = LocationChange.DELETE
+        replayed.append(change_event(seq, kind, object_id, operation, parent_id))
+    return replayed
+
+
+def stream_export_changes(since, batch_size=1000):
+    """
+    Export lines (see fast_serializers.build_export) of the locations
+    created or updated after ``since``, a change seq or a datetime, each
+    with its ``op``, and a line for each location deleted since, in batches.
+
+    A seq selects the changes from the change log. A datetime selects the
+    locations by ``updated_at``, which renames and moves also touch on the
+    descendants whose breadcrumb they change, and the deletions by the time
+    of their change log entry.
+    """
+    if isinstance(since, int):
+        yield from export_changes_since_seq(since, batch_size)
+        return
+
+    queryset = location_rows(
+        Location.objects.filter(updated_at__gte=since).order_by("updated_at", "id"),
+        TREE_COLUMNS,
+    )
+    for rows in batched(queryset.iterator(chunk_size=batch_size), batch_size):
+        yield export_lines(
+            [
+                (
+                    row["id"],
+                    row,
+                    (
+                        LocationChange.CREATE
+                        if row["created_at"] >= since
+                        else LocationChange.UPDATE
+                    ),
+                )
+                for row in rows
+            ]
+        )
+    deleted = (
+        LocationChange.objects.filter(
+            kind=LocationChange.LOCATION,
+            operation=LocationChange.DELETE,
+            created_at__gte=since,
+        )
+        .order_by("object_id")
+        .values_list("object_id", flat=True)
+        .distinct()
+    )
+    for ids in batched(deleted.iterator(chunk_size=batch_size), batch_size):
+        # Unless restored since
+        existing = set(Location.objects.filter(id__in=ids).values_list("id", flat=True))
+        yield export_lines(
+            [
+                (object_id, None, LocationChange.DELETE)
+                for object_id in ids
+                if object_id not in existing
+            ]
+        )
+
+
+def export_changes_since_seq(since, batch_size):
+    changes = (
+        latest_changes(since)
+        .filter(kind=LocationChange.LOCATION)
+        .values_list("object_id", "operation")
+    )
+    created = LocationChange.objects.filter(
+        seq__gt=since, kind=LocationChange.LOCATION, operation=LocationChange.CREATE
+    )
+    for batch in batched(changes.iterator(chunk_size=batch_size), batch_size):
+        ids = [
+            object_id
+            for object_id, operation in batch
+            if operation != LocationChange.DELETE
+        ]
+        rows = {
+            row["id"]: row
+            for row in location_rows(Location.objects.filter(id__in=ids), TREE_COLUMNS)
+        }
+        new = set(created.filter(object_id__in=ids).values_list("object_id", flat=True))
+        yield export_lines(
+            [
+                (
+                    object_id,
+                    rows.get(object_id),
+                    (
+                        LocationChange.CREATE
+                        if object_id in new
+                        else LocationChange.UPDATE
+                    ),
+                )
+                for object_id, _ in batch
+            ]
+        )
+
+
+def export_lines(changes):
+    """
+    Export lines of (id, row, operation) changes; a change without a row is
+    a deletion
+    """
+    rows = [row for _, row, _ in changes if row is not None]
+    build = export_builder(fetch_names(rows), fetch_image_counts(rows))
+    return [
+        (
+            {"op": operation, **build(row)}
+            if row is not None
+            else {"op": LocationChange.DELETE, "id": object_id}
+        )
+        for object_id, row, operation in changes
+    ]
+
+
+def compact():
+    """
+    Delete the entries superseded by a later entry of the same object. The
+    create entries are kept for export_changes_since_seq(), unless the
+    object was deleted since.
+    """
+    latest = (
+        LocationChange.objects.values("kind", "object_id")
+        .annotate(latest=Max("seq"))
+        .values("latest")
+    )
+    deleted_since = LocationChange.objects.filter(
+        kind=OuterRef("kind"),
+        object_id=OuterRef("object_id"),
+        operation=LocationChange.DELETE,
+        seq__gt=OuterRef("seq"),
+    )
+    deleted, _ = (
+        LocationChange.objects.exclude(seq__in=latest)
+        .exclude(Q(operation=LocationChange.CREATE) & ~Exists(deleted_since))
+        .delete()
+    )
+    return deleted
@@ -0,0 +1,119 @@
+"""
+Conditional requests for location reads and writes.
+
+ETags are derived from the tree version (see locations.cache), which every
+write bumps, so a client's copy can be validated without rebuilding the
+response. Location details also carry the row's ``updated_at``, which
+``If-Match`` uses for optimistic concurrency on PUT/PATCH.
+"""
+
+import re
+
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .cache import aget_tree_version, cleaning_epoch, get_tree_version
+from .models import Location
+
+# Only the row part is compared. It is strong for any content coding, so
+# the tags that CompressionMiddleware weakens are accepted too.
+LOCATION_ETAG = re.compile(r'^(?:W/)?"location-(\d+)-(\d+)-')
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = "The location was modified by another request."
+    default_code = "precondition_failed"
+
+
+def tree_etag(name, *parts):
+    """
+    ETag of a response that only depends on the tree version.
+
+    Call it before building the response: the data may then be newer than
+    the version in the ETag, which only costs a refetch, but never older.
+    """
+    suffix = "-".join(str(part) for part in parts)
+    return f'"{name}-{get_tree_version()}-{suffix}"'
+
+
+async def atree_etag(name, *parts):
+    """tree_etag() for async views"""
+    suffix = "-".join(str(part) for part in parts)
+    return f'"{name}-{await aget_tree_version()}-{suffix}"'
+
+
+def row_stamp(updated_at):
+    return int(updated_at.timestamp() * 1_000_000)
+
+
+def location_etag(location, tree_version):
+    """
+    ETag of a location detail. ``tree_version`` must be read before the
+    location was loaded (see tree_etag).
+    """
+    return location_row_etag(
+        {"id": location.pk, "updated_at": location.updated_at}, tree_version
+    )
+
+
+def location_row_etag(row, tree_version):
+    """location_etag() of a ``.values()`` row of the location"""
+    # The detail payload also includes ancestors, children, images and
+    # needs_cleaning, hence the tree version and cleaning epoch.
+    return (
+        f'"location-{row["id"]}-{row_stamp(row["updated_at"])}-'
+        f'{tree_version}-{cleaning_epoch()}"'
+    )
+
+
+def not_modified(request, etag):
+    """
+    Return a 304 response if If-None-Match says the client's copy is current,
+    otherwise None.
+    """
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header or request.method not in ("GET", "HEAD"):
+        return None
+    etags = parse_etags(header)
+    # If-None-Match uses the weak comparison
+    if "*" in etags or etag in (tag.removeprefix("W/") for tag in etags):
+        response = HttpResponseNotModified()
+        set_etag(response, etag)
+        return response
+    return None
+
+
+def set_etag(response, etag):
+    response["ETag"] = etag
+    # Private data: let the browser keep it, but always revalidate
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def check_if_match(request, location):
+    """
+    Enforce If-Match on an update of ``location`` without taking locks.
+
+    Only the row part of the ETag is compared, so unrelated writes elsewhere
+    in the tree don't fail the precondition. The row's ``updated_at`` is then
+    advanced with a compare-and-swap UPDATE, so of two concurrent writers with
+    the same ETag only one gets through. Must run inside a transaction.
+    """
+    header = request.META.get("HTTP_IF_MATCH")
+    if not header:
+        return
+    etags = parse_etags(header)
+    if "*" not in etags:
+        expected = (str(location.pk), str(row_stamp(location.updated_at)))
+        matches = (LOCATION_ETAG.match(tag) for tag in etags)
+        if not any(match and match.groups() == expected for match in matches):
+            raise PreconditionFailed()
+    claimed = Location.objects.filter(
+        pk=location.pk, updated_at=location.updated_at
+    ).update(updated_at=timezone.now())
+    if not claimed:
+        raise PreconditionFailed()
@@ -0,0 +1,207 @@
+"""
+Live change events, streamed to clients as server-sent events.
+
+Every change log entry is published as a compact event (see
+changes.change_event) when its transaction commits. Each process hands the
+events to the streams it serves through a Broadcaster. On PostgreSQL events
+are published with NOTIFY instead, which delivers them on commit and in
+commit order, and every process serving streams LISTENs on the channel, so
+clients also see writes made by other workers.
+
+The streams are long-lived, so they are served by an async view and only
+work under the ASGI server; an idle stream costs a queue, not a thread.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "locations_changes"
+
+# Seconds between attempts to reconnect the LISTEN connection
+LISTEN_RETRY_INTERVAL = 5
+
+# Tells a client it may have missed events: it should fetch the changes
+# after the last event it got from the changes endpoint
+RESYNC = object()
+
+
+def publish(event):
+    """Publish an event once the current transaction commits"""
+    publish_many([event])
+
+
+def publish_many(events):
+    """Publish events, in order, once the current transaction commits"""
+    if not events:
+        return
+    if connection.vendor == "postgresql":
+        # One statement for all of them, however many rows a write touched
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) "
+                "WITH ORDINALITY AS events(payload, n) ORDER BY n",
+                [
+                    CHANNEL,
+                    [json.dumps(event, separators=(",", ":")) for event in events],
+                ],
+            )
+    else:
+
+        def deliver():
+            for event in events:
+                broadcaster.deliver(event)
+
+        transaction.on_commit(deliver)
+
+
+class Subscription:
+    """The queue of events of one stream, read in its event loop"""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event):
+        if self.queue.full():
+            # The client doesn't keep up: drop its backlog and have it resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = RESYNC
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """Fans events out to the subscriptions of this process"""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self):
+        """Subscribe the running event loop to the events"""
+        subscription = Subscription(
+            asyncio.get_running_loop(), settings.EVENTS_QUEUE_SIZE
+        )
+        with self._lock:
+            self._subscriptions.add(subscription)
+        listening = self._listener is not None and not self._listener.done()
+        if connection.vendor == "postgresql" and not listening:
+            self._listener = asyncio.create_task(listen(self))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            idle = not self._subscriptions
+        if idle and self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    def deliver(self, event):
+        """Hand an event to every subscription; safe to call from any thread"""
+        with self._lock:
+            # The loop of a stream that was never closed is gone with it
+            self._subscriptions = {
+                subscription
+                for subscription in self._subscriptions
+                if not subscription.loop.is_closed()
+            }
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+
+broadcaster = Broadcaster()
+
+
+def listen_connection():
+    """A new autocommit database connection that LISTENs on CHANNEL"""
+    wrapper = connections["default"]
+    conn = wrapper.get_new_connection(wrapper.get_connection_params())
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    return conn
+
+
+async def listen(broadcaster):
+    """Deliver the notifications of every process, until cancelled"""
+    import psycopg2
+
+    loop = asyncio.get_running_loop()
+    connected_before = False
+    while True:
+        try:
+            conn = await loop.run_in_executor(None, listen_connection)
+        except psycopg2.Error:
+            logger.warning("Cannot LISTEN for location changes", exc_info=True)
+            await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+            continue
+        if connected_before:
+            # Notifications sent while disconnected are lost
+            broadcaster.deliver(RESYNC)
+        connected_before = True
+
+        readable = asyncio.Event()
+        loop.add_reader(conn.fileno(), readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                conn.poll()
+                while conn.notifies:
+                    broadcaster.deliver(json.loads(conn.notifies.pop(0).payload))
+        except psycopg2.Error:
+            logger.warning("Lost the LISTEN connection", exc_info=True)
+        finally:
+            loop.remove_reader(conn.fileno())
+            conn.close()
+        await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+
+def format_event(event):
+    if event is RESYNC:
+        return b"event: resync\ndata: {}\n\n"
+    data = json.dumps(event, separators=(",", ":"))
+    return f"id: {event['seq']}\nevent: change\ndata: {data}\n\n".encode()
+
+
+async def stream(subscription, replayed):
+    """
+    The body of an event stream: the ``replayed`` events, then the live
+    ones, with a comment every EVENTS_HEARTBEAT_INTERVAL seconds so proxies
+    keep idle streams open. ``replayed`` is None if there were too many
+    events to replay.
+    """
+    try:
+        last_seq = 0
+        if replayed is None:
+            yield format_event(RESYNC)
+            replayed = []
+        for event in replayed:
+            last_seq = event["seq"]
+            yield format_event(event)
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    subscription.get(), settings.EVENTS_HEARTBEAT_INTERVAL
+                )
+            except TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            # Events committed while the replay was read come twice
+            if event is RESYNC or event["seq"] > last_seq:
+                yield format_event(event)
+    finally:
+        broadcaster.unsubscribe(subscription)
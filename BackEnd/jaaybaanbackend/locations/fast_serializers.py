@@ -0,0 +1,471 @@
+"""
+Fast read-only serialization of locations for list, search, tree and export
+responses.
+
+The ModelSerializers run DRF's field machinery for every field of every row,
+plus a few queries per row for breadcrumbs, children and images. Here rows
+come straight from ``.values()``, the related data is fetched with one query
+per kind for the whole batch, and each field goes through a converter
+compiled once from the corresponding serializer field, so the output is
+exactly what the serializers produce.
+
+Fetching (``fetch_*``, database access) is kept apart from building
+(``build_*``, pure functions of the fetched data), so the build step can be
+reused with data fetched by other means, such as the async ORM of the
+``afetch_*`` functions used by the async views.
+"""
+
+from datetime import timedelta
+from itertools import batched
+
+from django.db.models import Count, Q
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Location, LocationImage
+from .serializers import (
+    LocationBreadcrumbSerializer,
+    LocationChildSerializer,
+    LocationExportSerializer,
+    LocationImageSerializer,
+    LocationSerializer,
+    LocationThumbnailSerializer,
+    LocationTreeSerializer,
+)
+
+STEPLEN = Location.steplen
+
+TREE_COLUMNS = [
+    "id",
+    "path",
+    "depth",
+    "numchild",
+    "name",
+    "location_type",
+    "description",
+    "is_container",
+    "barcode",
+    "quantity",
+    "value",
+    "cleaned_time",
+    "cleaned_duration",
+    "created_at",
+    "updated_at",
+]
+
+# With the primary image, joined in the same query
+LOCATION_COLUMNS = TREE_COLUMNS + [
+    "primary_image_id",
+    "primary_image__image",
+    "primary_image__description",
+]
+
+IMAGE_COLUMNS = ["id", "location_id", "image", "description", "created_at"]
+
+CHILD_COLUMNS = ["path"] + LocationChildSerializer.Meta.fields
+
+BREADCRUMB_COLUMNS = ["path"] + LocationBreadcrumbSerializer.Meta.fields
+
+# The children of the location page are listed without their own breadcrumb
+# and images
+PAGE_CHILD_FIELDS = [
+    name
+    for name in LocationSerializer.default_fields()
+    if name not in ("breadcrumb", "images")
+]
+
+# Fields whose to_representation() returns database values unchanged
+IDENTITY_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.IntegerField,
+)
+
+
+def compile_fields(serializer_class, context=None):
+    """
+    Map each plain model field of ``serializer_class`` to a converter that
+    turns the raw database value into the serializer's output, or to None
+    when the value is output as is.
+    """
+    model = serializer_class.Meta.model
+    converters = {}
+    for name, field in serializer_class(context=context or {}).fields.items():
+        if isinstance(
+            field, (serializers.SerializerMethodField, serializers.BaseSerializer)
+        ):
+            continue
+        if type(field) in IDENTITY_FIELDS:
+            converters[name] = None
+        elif isinstance(field, serializers.FileField):
+            model_field = model._meta.get_field(field.source)
+            converters[name] = file_converter(field, model_field)
+        else:
+            converters[name] = field.to_representation
+    return converters
+
+
+def file_converter(field, model_field):
+    def convert(name):
+        return field.to_representation(FieldFile(None, model_field, name))
+
+    return convert
+
+
+def row_builder(fields, converters, computed, columns=None):
+    """
+    Compile a function building one output dict, with keys in ``fields``
+    order, from a row. ``computed`` maps field names to functions of the row;
+    other fields are read from ``columns[name]`` (default: the field name)
+    and converted like the serializer does, None staying None.
+    """
+    columns = columns or {}
+    steps = [
+        (
+            (name, computed[name], None, None)
+            if name in computed
+            else (name, None, columns.get(name, name), converters[name])
+        )
+        for name in fields
+    ]
+
+    def build(row):
+        out = {}
+        for name, compute, column, convert in steps:
+            if compute is not None:
+                out[name] = compute(row)
+            else:
+                value = row[column]
+                out[name] = (
+                    value if value is None or convert is None else convert(value)
+                )
+        return out
+
+    return build
+
+
+def ancestor_paths(path):
+    return [path[:end] for end in range(STEPLEN, len(path), STEPLEN)]
+
+
+def breadcrumb(path, name, names):
+    """Location.get_breadcrumb() from a path -> name mapping of the ancestors"""
+    return " > ".join([names[p] for p in ancestor_paths(path)] + [name])
+
+
+def needs_cleaning(row, now):
+    """Location.needs_cleaning() for a row"""
+    if not row["cleaned_time"]:
+        return True
+    return now > row["cleaned_time"] + timedelta(days=row["cleaned_duration"])
+
+
+# Fetching
+
+
+def location_rows(queryset, columns=LOCATION_COLUMNS):
+    """A queryset of row dicts, to be paginated or listed"""
+    return queryset.values(*columns)
+
+
+def location_columns(fields):
+    """The columns needed for LocationSerializer ``fields``"""
+    # Images are flagged with is_primary
+    if "primary_image" in fields or "images" in fields:
+        return LOCATION_COLUMNS
+    return TREE_COLUMNS
+
+
+def fetch_names(rows):
+    """path -> name of every row and every ancestor of a row"""
+    names = {row["path"]: row["name"] for row in rows}
+    missing = {p for row in rows for p in ancestor_paths(row["path"])} - names.keys()
+    if missing:
+        names.update(
+            Location.objects.filter(path__in=missing).values_list("path", "name")
+        )
+    return names
+
+
+def fetch_images(rows):
+    """location id -> image rows, in the LocationImage ordering"""
+    images = {row["id"]: [] for row in rows}
+    queryset = LocationImage.objects.filter(location_id__in=list(images))
+    for image in queryset.order_by("created_at").values(*IMAGE_COLUMNS):
+        images[image["location_id"]].append(image)
+    return images
+
+
+def fetch_image_counts(rows=None):
+    """location id -> number of images, for ``rows`` or every location"""
+    queryset = LocationImage.objects.all()
+    if rows is not None:
+        queryset = queryset.filter(location_id__in=[row["id"] for row in rows])
+    counts = (
+        queryset.values("location_id")
+        .annotate(count=Count("id"))
+        .values_list("location_id", "count")
+    )
+    return dict(counts)
+
+
+def fetch_children(rows):
+    """path -> child rows, in display order"""
+    children = {row["path"]: [] for row in rows}
+    query = Q()
+    for row in rows:
+        if row["numchild"]:
+            query |= Q(depth=row["depth"] + 1, path__startswith=row["path"])
+    if query:
+        queryset = Location.objects.filter(query).order_by(*Location.sibling_order())
+        for child in queryset.values(*CHILD_COLUMNS):
+            children[child["path"][:-STEPLEN]].append(child)
+    return children
+
+
+def fetch_locations(rows, fields):
+    """The related data for LocationSerializer ``fields``, and nothing more"""
+    return {
+        "names": fetch_names(rows) if "breadcrumb" in fields else {},
+        "images": fetch_images(rows) if "images" in fields else {},
+        "children": fetch_children(rows) if "children" in fields else {},
+    }
+
+
+def fetch_page(pk, page_size):
+    """
+    The data of the location page: the location, its ancestors, images, the
+    first ``page_size`` children and subtree counts, in five queries. None if
+    there is no such location.
+    """
+    location = location_rows(Location.objects.filter(pk=pk)).first()
+    if location is None:
+        return None
+    path, depth = location["path"], location["depth"]
+    descendants = Location.objects.filter(path__startswith=path, depth__gt=depth)
+    children = descendants.filter(depth=depth + 1).order_by(*Location.sibling_order())
+    ancestors = Location.objects.filter(path__in=ancestor_paths(path))
+    return {
+        "location": location,
+        "ancestors": list(ancestors.order_by("path").values(*BREADCRUMB_COLUMNS)),
+        "images": fetch_images([location]),
+        "children": list(location_rows(children)[:page_size]),
+        "counts": descendants.aggregate(
+            descendants=Count("id"),
+            containers=Count("id", filter=Q(is_container=True)),
+        ),
+    }
+
+
+def fetch_tree(parent=None):
+    """Rows of the whole tree, or of ``parent``'s subtree, siblings in order"""
+    queryset = Location.get_tree(parent).order_by(*Location.sibling_order())
+    rows = list(location_rows(queryset, TREE_COLUMNS))
+    return {"rows": rows, "names": fetch_names(rows)}
+
+
+def fetch_export():
+    rows = list(location_rows(Location.objects.order_by("path"), TREE_COLUMNS))
+    return {
+        "rows": rows,
+        "names": fetch_names(rows),
+        "image_counts": fetch_image_counts(rows),
+    }
+
+
+# Async fetching, the same queries through the async ORM
+
+
+async def afetch_names(rows):
+    names = {row["path"]: row["name"] for row in rows}
+    missing = {p for row in rows for p in ancestor_paths(row["path"])} - names.keys()
+    if missing:
+        queryset = Location.objects.filter(path__in=missing)
+        names.update([item async for item in queryset.values_list("path", "name")])
+    return names
+
+
+async def afetch_images(rows):
+    images = {row["id"]: [] for row in rows}
+    queryset = LocationImage.objects.filter(location_id__in=list(images))
+    async for image in queryset.order_by("created_at").values(*IMAGE_COLUMNS):
+        images[image["location_id"]].append(image)
+    return images
+
+
+async def afetch_children(rows):
+    children = {row["path"]: [] for row in rows}
+    query = Q()
+    for row in rows:
+        if row["numchild"]:
+            query |= Q(depth=row["depth"] + 1, path__startswith=row["path"])
+    if query:
+        queryset = Location.objects.filter(query).order_by(*Location.sibling_order())
+        async for child in queryset.values(*CHILD_COLUMNS):
+            children[child["path"][:-STEPLEN]].append(child)
+    return children
+
+
+async def afetch_locations(rows, fields):
+    return {
+        "names": await afetch_names(rows) if "breadcrumb" in fields else {},
+        "images": await afetch_images(rows) if "images" in fields else {},
+        "children": await afetch_children(rows) if "children" in fields else {},
+    }
+
+
+# Building
+
+
+def build_locations(rows, names, images, children, fields, context=None):
+    """LocationSerializer(many=True, fields=fields) output"""
+    now = timezone.now()
+    build_image = row_builder(
+        LocationImageSerializer.Meta.fields,
+        compile_fields(LocationImageSerializer, context),
+        {},
+    )
+    build_thumbnail = row_builder(
+        LocationThumbnailSerializer.Meta.fields,
+        compile_fields(LocationThumbnailSerializer, context),
+        {},
+        {
+            "id": "primary_image_id",
+            "image": "primary_image__image",
+            "description": "primary_image__description",
+        },
+    )
+    build_child = row_builder(
+        LocationChildSerializer.Meta.fields,
+        compile_fields(LocationChildSerializer),
+        {},
+    )
+    build = row_builder(
+        fields,
+        compile_fields(LocationSerializer, context),
+        {
+            "breadcrumb": lambda row: breadcrumb(row["path"], row["name"], names),
+            "children_count": lambda row: row["numchild"],
+            "needs_cleaning": lambda row: needs_cleaning(row, now),
+            "primary_image": lambda row: (
+                None if row["primary_image_id"] is None else build_thumbnail(row)
+            ),
+            "images": lambda row: [
+                build_image(
+                    {**image, "is_primary": image["id"] == row["primary_image_id"]}
+                )
+                for image in images[row["id"]]
+            ],
+            "children": lambda row: [
+                build_child(child) for child in children[row["path"]]
+            ],
+        },
+    )
+    return [build(row) for row in rows]
+
+
+def build_tree(rows, names):
+    """
+    LocationTreeSerializer(many=True) output for the top-level rows, with
+    the children of each in the order of ``rows``
+    """
+    build = row_builder(
+        LocationTreeSerializer.Meta.fields,
+        compile_fields(LocationTreeSerializer),
+        {
+            "breadcrumb": lambda row: breadcrumb(row["path"], row["name"], names),
+            "children": lambda row: [],
+        },
+    )
+    nodes = {row["path"]: build(row) for row in rows}
+    top = []
+    for row in rows:
+        parent = nodes.get(row["path"][:-STEPLEN])
+        (parent["children"] if parent else top).append(nodes[row["path"]])
+    return top
+
+
+def export_builder(names, image_counts):
+    return row_builder(
+        LocationExportSerializer.Meta.fields,
+        compile_fields(LocationExportSerializer),
+        {
+            "breadcrumb_path": lambda row: breadcrumb(row["path"], row["name"], names),
+            "parent_name": lambda row: names.get(row["path"][:-STEPLEN]),
+            "images_count": lambda row: image_counts.get(row["id"], 0),
+        },
+    )
+
+
+def build_page(
+    location, ancestors, images, children, counts, context=None, next_url=None
+):
+    """
+    The location page, see fetch_page(). ``next_url`` is where the rest of
+    the children are listed, if there are more.
+    """
+    names = {row["path"]: row["name"] for row in ancestors}
+    build_crumb = row_builder(
+        LocationBreadcrumbSerializer.Meta.fields,
+        compile_fields(LocationBreadcrumbSerializer),
+        {},
+    )
+    [data] = build_locations(
+        [location],
+        names,
+        images,
+        {},
+        LocationSerializer.default_fields(),
+        context,
+    )
+    return {
+        "location": data,
+        "breadcrumb": [build_crumb(row) for row in [*ancestors, location]],
+        "children": {
+            "count": location["numchild"],
+            "next": next_url,
+            "results": build_locations(
+                children, {}, {}, {}, PAGE_CHILD_FIELDS, context
+            ),
+        },
+        "subtree": {
+            "descendants": counts["descendants"],
+            "containers": counts["containers"],
+            "items": counts["descendants"] - counts["containers"],
+        },
+    }
+
+
+def build_export(rows, names, image_counts):
+    """LocationExportSerializer(many=True) output"""
+    build = export_builder(names, image_counts)
+    return [build(row) for row in rows]
+
+
+def stream_export(batch_size=1000):
+    """
+    build_export() output in batches, reading the rows with a database
+    cursor instead of all at once. In path order ancestors come before their
+    descendants, so their names are known by the time they are needed; only
+    the names of locations with children are kept.
+    """
+    names = {}
+    build = export_builder(names, fetch_image_counts())
+    queryset = location_rows(Location.objects.order_by("path"), TREE_COLUMNS)
+    for rows in batched(queryset.iterator(chunk_size=batch_size), batch_size):
+        names.update((row["path"], row["name"]) for row in rows if row["numchild"])
+        yield [build(row) for row in rows]
+
+
+def serialize_locations(rows, context=None, fields=None):
+    """
+    LocationSerializer(rows, many=True, fields=fields).data for rows of
+    location_columns(fields)
+    """
+    if fields is None:
+        fields = LocationSerializer.default_fields()
+    rows = list(rows)
+    return build_locations(
+        rows, fields=fields, context=context, **fetch_locations(rows, fields)
+    )
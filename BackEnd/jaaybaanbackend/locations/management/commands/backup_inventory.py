@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from locations.backup import BackupError, backup
+
+
+class Command(BaseCommand):
+    help = (
+        "Back up users, tokens, locations, images and the image files from one "
+        "consistent snapshot of the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            default=settings.LOCATIONS_BACKUP_DIR,
+            help="Directory to write the backup into (default: "
+            "LOCATIONS_BACKUP_DIR)",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only back up the locations and images changed since the "
+            "latest backup in the output directory",
+        )
+        parser.add_argument(
+            "--media",
+            choices=["link", "tar", "none"],
+            default="link",
+            help="How to store the image files: hard links (copies across file "
+            "systems), a tar archive, or not at all (default: link)",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=4,
+            help="Tables dumped in parallel on PostgreSQL (default: 4)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            path, manifest = backup(
+                options["output"],
+                incremental=options["incremental"],
+                media=options["media"],
+                jobs=options["jobs"],
+            )
+        except BackupError as error:
+            raise CommandError(error)
+
+        for name, stats in manifest["files"].items():
+            self.stdout.write(f"  {name:<10} {stats['rows']:>10} rows")
+        media = manifest["media"]
+        self.stdout.write(f"  {'media':<10} {media['files']:>10} files")
+        for name in media["missing"]:
+            self.stdout.write(self.style.WARNING(f"Missing image file: {name}"))
+        kind = "Incremental backup" if manifest["base"] else "Backup"
+        self.stdout.write(
+            self.style.SUCCESS(f"{kind} at change seq {manifest['change_seq']}: {path}")
+        )
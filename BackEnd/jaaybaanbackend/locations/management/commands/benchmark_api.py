@@ -0,0 +1,227 @@
+import io
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from jaaybaanbackend import middleware
+from jaaybaanbackend.parsers import FastJSONParser
+from jaaybaanbackend.renderers import FastJSONRenderer, orjson
+from locations import fast_serializers
+from locations.models import Location, sort_key
+from locations.serializers import (
+    LocationExportSerializer,
+    LocationSerializer,
+    LocationTreeSerializer,
+)
+from locations.views import build_export, build_tree
+
+SUITES = ["renderers", "serializers", "compression"]
+
+
+def generate_tree(count, fanout):
+    """
+    Add a complete ``fanout``-ary tree of ``count`` locations under a new
+    root, with paths computed up front so it takes a single bulk insert.
+    Sibling names sort in path order, as node_order_by requires.
+    """
+    root = Location.add_root(name="Benchmark", location_type="house")
+    nodes = [root]
+    for i in range(1, count + 1):
+        parent = nodes[(i - 1) // fanout]
+        has_children = i * fanout + 1 <= count
+        depth = parent.depth + 1
+        nodes.append(
+            Location(
+                path=Location._get_path(parent.path, depth, (i - 1) % fanout + 1),
+                depth=depth,
+                numchild=max(0, min(fanout, count - i * fanout)),
+                name=f"Location {i:07d}",
+                sort_name=sort_key(f"Location {i:07d}"),
+                location_type="box" if has_children else "item",
+                description=f"Generated location {i} for benchmarking",
+                is_container=has_children,
+                barcode=f"BENCH{i:07d}",
+                quantity=i % 5 + 1,
+                value=Decimal(i % 1000) + Decimal("0.99"),
+            )
+        )
+    root.numchild = min(fanout, count)
+    root.save()
+    Location.objects.bulk_create(nodes[1:], batch_size=1000)
+    return root
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark API hot paths (time and peak memory) on the current data, "
+        "or on a generated tree that is rolled back afterwards"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--suite",
+            action="append",
+            choices=SUITES,
+            help="Suite to run (repeatable, default: all)",
+        )
+        parser.add_argument(
+            "--generate",
+            type=int,
+            default=0,
+            help="Generate N extra locations for the run; they are rolled back",
+        )
+        parser.add_argument(
+            "--fanout",
+            type=int,
+            default=10,
+            help="Children per container in the generated tree (default: 10)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Runs per measurement; the best time is reported (default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        self.repeat = options["repeat"]
+        with transaction.atomic():
+            if options["generate"]:
+                generate_tree(options["generate"], options["fanout"])
+            if not Location.objects.exists():
+                raise CommandError("No locations to benchmark; use --generate N")
+            self.stdout.write(f"{Location.objects.count()} locations")
+            for suite in options["suite"] or SUITES:
+                self.stdout.write(self.style.MIGRATE_HEADING(f"\n{suite}"))
+                getattr(self, f"suite_{suite}")()
+            transaction.set_rollback(True)
+
+    def measure(self, fn):
+        """Best wall time over the repeats, and peak traced memory of one run"""
+        best = float("inf")
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return best, peak
+
+    def count_queries(self, fn):
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            fn()
+        return count
+
+    def report(self, label, seconds, peak, size=None, queries=None):
+        line = (
+            f"  {label:<28} {seconds * 1000:9.1f} ms {peak / 1024 / 1024:9.1f} MB peak"
+        )
+        if size is not None:
+            line += f" {size / 1024 / 1024:9.1f} MB out"
+        if queries is not None:
+            line += f" {queries:7d} queries"
+        self.stdout.write(line)
+
+    def suite_renderers(self):
+        """JSON rendering and parsing of the tree and export payloads"""
+        if orjson is None:
+            self.stdout.write(
+                self.style.WARNING(
+                    "  orjson is not installed: FastJSONRenderer falls back to "
+                    "JSONRenderer"
+                )
+            )
+        payloads = {"tree": build_tree(), "export": build_export()}
+        codecs = [
+            ("json", JSONRenderer(), JSONParser()),
+            ("orjson", FastJSONRenderer(), FastJSONParser()),
+        ]
+        for name, data in payloads.items():
+            rendered = JSONRenderer().render(data)
+            for codec, renderer, parser in codecs:
+                seconds, peak = self.measure(lambda: renderer.render(data))
+                self.report(f"{name} render ({codec})", seconds, peak, len(rendered))
+                seconds, peak = self.measure(
+                    lambda: parser.parse(io.BytesIO(rendered), "application/json")
+                )
+                self.report(f"{name} parse ({codec})", seconds, peak)
+
+    def suite_serializers(self):
+        """ModelSerializers against the fast read path, for the same output"""
+        queryset = Location.objects.order_by("path")
+        page = slice(0, 100)
+        cases = [
+            (
+                "list page (serializer)",
+                lambda: LocationSerializer(
+                    queryset.select_related("primary_image")[page], many=True
+                ).data,
+            ),
+            (
+                "list page (fast)",
+                lambda: fast_serializers.serialize_locations(
+                    fast_serializers.location_rows(queryset)[page]
+                ),
+            ),
+            (
+                "tree (serializer)",
+                lambda: LocationTreeSerializer(
+                    Location.get_root_nodes(), many=True
+                ).data,
+            ),
+            ("tree (fast)", build_tree),
+            (
+                "export (serializer)",
+                lambda: LocationExportSerializer(queryset, many=True).data,
+            ),
+            ("export (fast)", lambda: build_export()["data"]),
+        ]
+        for label, fn in cases:
+            queries = self.count_queries(fn)
+            seconds, peak = self.measure(fn)
+            self.report(label, seconds, peak, queries=queries)
+
+    def suite_compression(self):
+        """Compression of the tree and export payloads at the configured levels"""
+        missing = [
+            coding
+            for coding in settings.COMPRESSION_LEVELS
+            if coding not in middleware.COMPRESSORS
+        ]
+        if missing:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"  Not installed, not offered: {', '.join(missing)}"
+                )
+            )
+        payloads = {
+            "tree": FastJSONRenderer().render(build_tree()),
+            "export": FastJSONRenderer().render(build_export()),
+        }
+        for name, rendered in payloads.items():
+            self.stdout.write(f"  {name}: {len(rendered) / 1024 / 1024:.1f} MB")
+            for coding in middleware.available_codings():
+                level = settings.COMPRESSION_LEVELS[coding]
+                seconds, peak = self.measure(
+                    lambda: middleware.compress(coding, rendered, level)
+                )
+                size = len(middleware.compress(coding, rendered, level))
+                label = f"{name} {coding}-{level} ({len(rendered) / size:.0f}x)"
+                self.report(label, seconds, peak, size)
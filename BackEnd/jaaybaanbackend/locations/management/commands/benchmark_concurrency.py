@@ -0,0 +1,273 @@
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.authtoken.models import Token
+
+from locations.cache import bump_tree_version
+from locations.changes import record_change
+from locations.models import Location, LocationChange
+
+from .benchmark_api import generate_tree
+
+BENCHMARK_USERNAME = "benchmark-concurrency"
+
+# The deployment modes of start.sh: gthread WSGI workers, or uvicorn workers
+# serving the ASGI app with the async views
+MODES = {
+    "wsgi": (
+        ["jaaybaanbackend.wsgi:application", "--worker-class", "gthread"],
+        {},
+    ),
+    "asgi": (
+        [
+            "jaaybaanbackend.asgi:application",
+            "--worker-class",
+            "uvicorn_worker.UvicornWorker",
+        ],
+        {"ASYNC_VIEWS": "true"},
+    ),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(port, path, token, read_size=None, delay=0):
+    """
+    GET ``path`` and read the whole response; with ``read_size``, read it
+    that many bytes at a time, ``delay`` seconds apart, through a small
+    receive buffer, like a client on a slow network. Return the status.
+    """
+    sock = socket.socket()
+    if read_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, read_size)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+            f"Authorization: Token {token}\r\nConnection: close\r\n\r\n".encode()
+        )
+        status = int((await reader.readline()).split()[1])
+        while await reader.read(read_size or 65536):
+            if delay:
+                await asyncio.sleep(delay)
+        return status
+    finally:
+        writer.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare how the WSGI and ASGI deployments keep serving fast requests "
+        "while slow clients download exports"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode",
+            action="append",
+            choices=list(MODES),
+            help="Deployment mode to run (repeatable, default: all)",
+        )
+        parser.add_argument(
+            "--generate",
+            type=int,
+            default=0,
+            help="Generate N extra locations for the run; they are deleted after",
+        )
+        parser.add_argument(
+            "--fanout",
+            type=int,
+            default=10,
+            help="Children per container in the generated tree (default: 10)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=3,
+            help="Gunicorn workers (default: 3, as in start.sh)",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=2,
+            help="Threads per gthread worker (default: 2, as in start.sh)",
+        )
+        parser.add_argument(
+            "--slow",
+            type=int,
+            default=6,
+            help="Slow clients downloading the NDJSON export (default: 6)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Concurrent fast clients requesting details (default: 8)",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=10,
+            help="Seconds of load per measurement (default: 10)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=5,
+            help="Seconds after which a fast request counts as timed out "
+            "(default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        root = None
+        if options["generate"]:
+            with transaction.atomic():
+                root = generate_tree(options["generate"], options["fanout"])
+            bump_tree_version()
+        user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME)
+        try:
+            token, _ = Token.objects.get_or_create(user=user)
+            location = Location.objects.order_by("-depth").first()
+            if location is None:
+                raise CommandError("No locations to benchmark; use --generate N")
+            self.stdout.write(f"{Location.objects.count()} locations")
+            self.fast_path = f"/api/v1/locations/{location.pk}/"
+            self.slow_path = "/api/v1/locations/export/?format=ndjson"
+            for mode in options["mode"] or list(MODES):
+                self.stdout.write(self.style.MIGRATE_HEADING(f"\n{mode}"))
+                with self.server(mode) as port:
+                    for slow in sorted({0, options["slow"]}):
+                        self.report(
+                            f"{slow} slow clients",
+                            asyncio.run(self.load(port, token.key, slow)),
+                        )
+        finally:
+            user.delete()
+            if root is not None:
+                self.delete_tree(root)
+
+    def delete_tree(self, root):
+        """Delete the generated tree in one statement instead of row by row"""
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Location._meta.db_table} WHERE path LIKE %s",
+                    [root.path + "%"],
+                )
+            record_change(LocationChange.LOCATION, root.pk, LocationChange.DELETE)
+        bump_tree_version()
+
+    @contextmanager
+    def server(self, mode):
+        """Run gunicorn in ``mode`` on a free port"""
+        args, env = MODES[mode]
+        port = free_port()
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                *args,
+                "--bind",
+                f"127.0.0.1:{port}",
+                "--workers",
+                str(self.options["workers"]),
+                "--threads",
+                str(self.options["threads"]),
+                "--log-level",
+                "warning",
+            ],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, **env},
+        )
+        try:
+            self.wait_until_ready(process, port)
+            yield port
+        finally:
+            process.terminate()
+            process.wait()
+
+    def wait_until_ready(self, process, port):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError("The server exited; is the ASGI extra installed?")
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/health/", timeout=1)
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError("The server did not start")
+
+    async def load(self, port, token, slow):
+        """
+        Run ``slow`` slow export downloads and, once they are under way,
+        --concurrency clients requesting a detail back to back for
+        --duration seconds. Return the fast latencies and timeouts.
+        """
+        slow_clients = [
+            asyncio.create_task(
+                fetch(port, self.slow_path, token, read_size=4096, delay=0.05)
+            )
+            for _ in range(slow)
+        ]
+        await asyncio.sleep(1 if slow else 0)
+
+        latencies = []
+        timeouts = 0
+        deadline = time.monotonic() + self.options["duration"]
+
+        async def client():
+            nonlocal timeouts
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                try:
+                    async with asyncio.timeout(self.options["timeout"]):
+                        status = await fetch(port, self.fast_path, token)
+                except TimeoutError:
+                    timeouts += 1
+                    continue
+                if status != 200:
+                    raise CommandError(f"{self.fast_path} returned {status}")
+                latencies.append(time.monotonic() - start)
+
+        try:
+            await asyncio.gather(
+                *(client() for _ in range(self.options["concurrency"]))
+            )
+        finally:
+            for task in slow_clients:
+                task.cancel()
+            await asyncio.gather(*slow_clients, return_exceptions=True)
+        return latencies, timeouts
+
+    def report(self, label, result):
+        latencies, timeouts = result
+        line = f"  {label:<18} {len(latencies) / self.options['duration']:8.1f} req/s"
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            line += (
+                f" p50 {quantiles[49] * 1000:8.1f} ms"
+                f" p95 {quantiles[94] * 1000:8.1f} ms"
+                f" max {max(latencies) * 1000:8.1f} ms"
+            )
+        line += f" {timeouts:5d} timeouts"
+        self.stdout.write(line)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from locations import changes
+
+
+class Command(BaseCommand):
+    help = (
+        "Compact the location change log: delete entries superseded by a "
+        "later change of the same location or image"
+    )
+
+    def handle(self, *args, **options):
+        deleted = changes.compact()
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {deleted} superseded change log entries")
+        )
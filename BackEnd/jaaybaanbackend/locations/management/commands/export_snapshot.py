@@ -0,0 +1,57 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locations import snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the inventory as an offline SQLite snapshot, either to a file "
+        "or to the snapshot cache served by /api/v1/locations/snapshot.sqlite"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output",
+            nargs="?",
+            help="File to write the snapshot to (default: write the cached "
+            "snapshot of the current tree version, if it is missing)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Overwrite the output file if it exists",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows read and inserted at a time (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        if output is None:
+            file, meta = snapshot.open_snapshot()
+            file.close()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Snapshot of tree version {meta['tree_version']} "
+                    f"(change seq {meta['change_seq']}): {file.name}"
+                )
+            )
+            return
+
+        if os.path.exists(output):
+            if not options["force"]:
+                raise CommandError(f"{output} exists; use --force to overwrite it")
+            os.remove(output)
+        snapshot.write_snapshot(output, batch_size=options["batch_size"])
+        meta = snapshot.read_meta(output)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Wrote {output} (change seq {meta['change_seq']}, "
+                f"{os.path.getsize(output)} bytes)"
+            )
+        )
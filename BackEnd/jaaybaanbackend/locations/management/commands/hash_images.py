@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from locations.models import LocationImage
+
+
+class Command(BaseCommand):
+    help = "Compute perceptual hashes for images that don't have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute hashes for every image, not only missing ones",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of images saved per query",
+        )
+
+    def handle(self, *args, **options):
+        queryset = LocationImage.objects.order_by("pk")
+        if not options["all"]:
+            queryset = queryset.filter(phash__isnull=True)
+
+        fields = ["phash", "phash_band0", "phash_band1", "phash_band2", "phash_band3"]
+        batch = []
+        hashed = failed = 0
+        for image in queryset.iterator(chunk_size=options["batch_size"]):
+            image.compute_perceptual_hash()
+            if image.phash is None:
+                failed += 1
+                continue
+            batch.append(image)
+            if len(batch) >= options["batch_size"]:
+                LocationImage.objects.bulk_update(batch, fields)
+                hashed += len(batch)
+                batch = []
+        if batch:
+            LocationImage.objects.bulk_update(batch, fields)
+            hashed += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Hashed {hashed} images"))
+        if failed:
+            self.stdout.write(self.style.WARNING(f"Could not read {failed} images"))
@@ -0,0 +1,58 @@
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locations.archive import import_archive
+from locations.backup import BackupError
+
+
+class Command(BaseCommand):
+    help = (
+        "Import an archive downloaded from /api/v1/locations/export/?format=zip, "
+        "with its image files"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("archive", help="ZIP file to import")
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Replace the current locations and images; without it the "
+            "inventory must be empty",
+        )
+        parser.add_argument(
+            "--no-media",
+            action="store_true",
+            help="Don't extract the image files",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            manifest, counts = import_archive(
+                options["archive"],
+                replace=options["replace"],
+                media=not options["no_media"],
+            )
+        except (BackupError, OSError, zipfile.BadZipFile) as error:
+            raise CommandError(error)
+
+        for name, count in counts.items():
+            self.stdout.write(f"  {name:<10} {count:>10} rows")
+        dropped = manifest["files"]["images"]["rows"] - counts["images"]
+        if dropped:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Left out {dropped} images of locations deleted while the "
+                    "archive was written"
+                )
+            )
+        if manifest["media"]["missing"]:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{len(manifest['media']['missing'])} image files were "
+                    "missing from the archive"
+                )
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Imported the archive of {manifest['created_at']}")
+        )
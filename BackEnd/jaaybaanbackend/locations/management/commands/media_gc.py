@@ -0,0 +1,193 @@
+import os
+import time
+import uuid
+from itertools import batched, chain
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+
+from locations import changes
+from locations.models import LocationImage, ImageUpload
+from locations.uploads import discard_upload_file
+
+IMAGE_DIR = "location_images"
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconcile MEDIA_ROOT/location_images with the LocationImage table: "
+        "report (or delete) orphaned files, including the partial files of "
+        "chunked uploads whose upload is gone, and rows whose file is missing"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete orphaned files instead of only reporting them",
+        )
+        parser.add_argument(
+            "--delete-missing",
+            action="store_true",
+            help="Delete LocationImage rows whose file no longer exists",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="Ignore files modified in the last N seconds (default: 3600), "
+            "so uploads that are still being saved are not touched",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of files / rows handled per database query",
+        )
+        parser.add_argument(
+            "--verbose-list",
+            action="store_true",
+            help="Print every orphaned file and missing row",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.batch_size = options["batch_size"]
+        self.media_root = os.fspath(settings.MEDIA_ROOT)
+
+        orphans, orphan_bytes = self.collect_orphans()
+        missing = self.collect_missing()
+        uploads = self.collect_expired_uploads()
+
+        action = "Deleted" if options["delete"] else "Found"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{action} {orphans} orphaned files ({orphan_bytes / 1024 / 1024:.1f} MB)"
+            )
+        )
+        action = "Deleted" if options["delete_missing"] else "Found"
+        self.stdout.write(
+            self.style.SUCCESS(f"{action} {missing} image rows with missing files")
+        )
+        action = "Deleted" if options["delete"] else "Found"
+        self.stdout.write(
+            self.style.SUCCESS(f"{action} {uploads} expired chunked uploads")
+        )
+        if (
+            not options["delete"]
+            and not options["delete_missing"]
+            and (orphans or missing or uploads)
+        ):
+            self.stdout.write(
+                self.style.WARNING(
+                    "Dry run: use --delete / --delete-missing to clean up"
+                )
+            )
+
+    def scan_files(self, directory, prefix=""):
+        """
+        Yield (name, entry, size) for old enough files in ``directory``, one
+        directory entry at a time, named ``prefix`` + the file name
+        """
+        if not os.path.isdir(directory):
+            return
+        cutoff = time.time() - self.options["min_age"]
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > cutoff:
+                    continue
+                yield f"{prefix}{entry.name}", entry, stat.st_size
+
+    def orphan_images(self):
+        """Image files that no LocationImage row points to"""
+        files = self.scan_files(
+            os.path.join(self.media_root, IMAGE_DIR), f"{IMAGE_DIR}/"
+        )
+        for batch in batched(files, self.batch_size):
+            names = [name for name, _, _ in batch]
+            known = set(
+                LocationImage.objects.filter(image__in=names).values_list(
+                    "image", flat=True
+                )
+            )
+            yield from (file for file in batch if file[0] not in known)
+
+    def orphan_uploads(self):
+        """
+        Partial files of chunked uploads without an ImageUpload row, such as
+        those of uploads deleted with their location
+        """
+        files = self.scan_files(os.fspath(settings.CHUNKED_UPLOAD_DIR))
+        for batch in batched(files, self.batch_size):
+            ids = {}
+            for name, _, _ in batch:
+                stem, extension = os.path.splitext(name)
+                if extension != ".part":
+                    continue
+                try:
+                    ids[name] = uuid.UUID(stem)
+                except ValueError:
+                    continue
+            known = set(
+                ImageUpload.objects.filter(pk__in=ids.values()).values_list(
+                    "pk", flat=True
+                )
+            )
+            yield from (
+                file for file in batch if file[0] in ids and ids[file[0]] not in known
+            )
+
+    def collect_orphans(self):
+        """Files on disk that no row points to"""
+        count = 0
+        total_bytes = 0
+        for name, entry, size in chain(self.orphan_images(), self.orphan_uploads()):
+            count += 1
+            total_bytes += size
+            if self.options["verbose_list"]:
+                self.stdout.write(f"orphan: {name}")
+            if self.options["delete"]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        return count, total_bytes
+
+    def collect_missing(self):
+        """LocationImage rows whose file is gone, streamed in chunks"""
+        count = 0
+        rows = LocationImage.objects.order_by("pk").values_list("pk", "image")
+        for batch in batched(
+            rows.iterator(chunk_size=self.batch_size), self.batch_size
+        ):
+            missing_ids = []
+            for pk, name in batch:
+                if name and os.path.exists(os.path.join(self.media_root, name)):
+                    continue
+                missing_ids.append(pk)
+                if self.options["verbose_list"]:
+                    self.stdout.write(f"missing: #{pk} {name}")
+            count += len(missing_ids)
+            if missing_ids and self.options["delete_missing"]:
+                # The images' locations are updated before the change log
+                with transaction.atomic(), changes.deferred():
+                    LocationImage.objects.filter(pk__in=missing_ids).delete()
+        return count
+
+    def collect_expired_uploads(self):
+        """Chunked uploads that were abandoned before being finalized"""
+        cutoff = timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRATION)
+        expired = ImageUpload.objects.filter(updated_at__lt=cutoff)
+        count = 0
+        for upload in expired.iterator(chunk_size=self.batch_size):
+            count += 1
+            if self.options["delete"]:
+                discard_upload_file(upload)
+                upload.delete()
+        return count
@@ -0,0 +1,44 @@
+from itertools import batched
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from locations import changes
+from locations.cache import schedule_tree_version_bump
+from locations.models import Location, LocationChange
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrite the tree paths so siblings are in name order, as the sorted "
+        "tree mode keeps them. Needed when switching TREE_MODE from append "
+        "back to sorted."
+    )
+
+    def handle(self, *args, **options):
+        if settings.LOCATIONS_TREE_MODE == "append":
+            raise CommandError(
+                "TREE_MODE is append, where paths keep the insertion order; "
+                "set it to sorted first"
+            )
+
+        with transaction.atomic():
+            before = dict(Location.objects.values_list("pk", "path"))
+            Location.fix_tree(fix_paths=True)
+            moved = [
+                pk
+                for pk, path in Location.objects.values_list("pk", "path").iterator()
+                if before.get(pk) != path
+            ]
+            now = timezone.now()
+            for batch in batched(moved, 1000):
+                Location.objects.filter(pk__in=batch).update(updated_at=now)
+            changes.record_changes(
+                LocationChange.LOCATION, moved, LocationChange.UPDATE
+            )
+            schedule_tree_version_bump()
+        self.stdout.write(
+            self.style.SUCCESS(f"Rewrote the paths of {len(moved)} locations")
+        )
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from locations.backup import BackupError, restore
+
+
+class Command(BaseCommand):
+    help = (
+        "Restore a backup written by backup_inventory, with the incremental "
+        "backups it is based on, and verify the restored rows against it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("backup", help="Directory of the backup to restore")
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Replace the current locations and images; without it the "
+            "inventory must be empty",
+        )
+        parser.add_argument(
+            "--no-media",
+            action="store_true",
+            help="Don't restore the image files",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            manifest = restore(
+                options["backup"],
+                replace=options["replace"],
+                media=not options["no_media"],
+            )
+        except BackupError as error:
+            raise CommandError(error)
+
+        for name, count in manifest["totals"].items():
+            self.stdout.write(f"  {name:<10} {count:>10} rows")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Restored and verified the backup of {manifest['created_at']}"
+            )
+        )
@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from locations import rekey
+from locations.models import Location
+
+
+class Command(BaseCommand):
+    help = (
+        "Report how much of the tree path capacity (levels, and positions "
+        "under a parent) is in use, and re-key the paths to another steplen "
+        "or alphabet: --prepare while the app runs, then --switch with it "
+        "stopped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--steplen",
+            type=int,
+            default=Location.steplen,
+            help=f"Characters per level to plan for (default: the current "
+            f"{Location.steplen})",
+        )
+        parser.add_argument(
+            "--alphabet",
+            default=Location.alphabet,
+            help="Digits of a level, in the database's sort order, to plan for "
+            "(default: the current alphabet)",
+        )
+        parser.add_argument(
+            "--prepare",
+            action="store_true",
+            help="Compute the new paths in batches while the tree is in use; "
+            "can be run again to catch up",
+        )
+        parser.add_argument(
+            "--switch",
+            action="store_true",
+            help="Swap the new paths in; stop the app first, and start it "
+            "again with the new TREE_STEPLEN and TREE_ALPHABET",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=rekey.BATCH_SIZE,
+            help=f"Locations re-keyed per transaction (default: {rekey.BATCH_SIZE})",
+        )
+
+    def handle(self, *args, **options):
+        steplen, alphabet = options["steplen"], options["alphabet"]
+        levels = rekey.analyze()
+        self.stdout.write("Depth  Locations  Most siblings  Highest position")
+        for level in levels:
+            self.stdout.write(
+                f"{level['depth']:>5}  {level['locations']:>9}  "
+                f"{level['siblings']:>13}  {level['position']:>16}"
+            )
+        self.write_headroom("Current", levels, Location.steplen, Location.alphabet)
+        changed = (steplen, alphabet) != (Location.steplen, Location.alphabet)
+        if changed:
+            self.write_headroom("Planned", levels, steplen, alphabet)
+
+        if not (options["prepare"] or options["switch"]):
+            return
+        if not changed:
+            raise CommandError("Give a --steplen or --alphabet to re-key to")
+        try:
+            if options["prepare"]:
+                total = Location.objects.count()
+                done = rekey.prepare(
+                    steplen,
+                    alphabet,
+                    options["batch_size"],
+                    lambda done: self.stdout.write(f"Staged {done}/{total} paths"),
+                )
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Staged {done} paths; stop the app and run --switch"
+                    )
+                )
+            if options["switch"]:
+                count = rekey.switch(steplen, alphabet, options["batch_size"])
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Re-keyed {count} locations; start the app with "
+                        f"TREE_STEPLEN={steplen} TREE_ALPHABET={alphabet}"
+                    )
+                )
+        except rekey.RekeyError as e:
+            raise CommandError(str(e))
+
+    def write_headroom(self, label, levels, steplen, alphabet):
+        room = rekey.headroom(levels, steplen, alphabet)
+        self.stdout.write(
+            f"{label} keying, steplen {steplen} with {len(alphabet)} digits: "
+            f"{room['depth']} of {room['max_depth']} levels "
+            f"({percent(room['depth'], room['max_depth'])}), highest position "
+            f"{room['position']} of {room['max_positions']} "
+            f"({percent(room['position'], room['max_positions'])})"
+        )
+        if not room["fits"]:
+            self.stdout.write(
+                self.style.ERROR(f"The tree doesn't fit the {label.lower()} keying")
+            )
+
+
+def percent(used, limit):
+    return f"{100 * used / limit:.1f}%"
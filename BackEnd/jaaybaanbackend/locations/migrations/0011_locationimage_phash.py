@@ -0,0 +1,38 @@
+# Generated by Django 5.2.5 on 2026-10-19 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0010_imageupload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="locationimage",
+            name="phash",
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="locationimage",
+            name="phash_band0",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="locationimage",
+            name="phash_band1",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="locationimage",
+            name="phash_band2",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="locationimage",
+            name="phash_band3",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
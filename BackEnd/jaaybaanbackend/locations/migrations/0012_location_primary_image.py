@@ -0,0 +1,53 @@
+# Generated by Django 5.2.5 on 2026-10-19 01:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_primary_flags(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+    LocationImage = apps.get_model("locations", "LocationImage")
+
+    primaries = LocationImage.objects.filter(is_primary=True).order_by("created_at")
+    for location_id, image_id in primaries.values_list("location_id", "id").iterator():
+        Location.objects.filter(pk=location_id).update(primary_image_id=image_id)
+
+
+def copy_primary_pointers(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+    LocationImage = apps.get_model("locations", "LocationImage")
+
+    image_ids = Location.objects.filter(primary_image__isnull=False).values_list(
+        "primary_image_id", flat=True
+    )
+    LocationImage.objects.filter(pk__in=image_ids).update(is_primary=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0011_locationimage_phash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="location",
+            name="primary_image",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="locations.locationimage",
+            ),
+        ),
+        migrations.RunPython(copy_primary_flags, copy_primary_pointers),
+        migrations.AlterModelOptions(
+            name="locationimage",
+            options={"ordering": ["created_at"]},
+        ),
+        migrations.RemoveField(
+            model_name="locationimage",
+            name="is_primary",
+        ),
+    ]
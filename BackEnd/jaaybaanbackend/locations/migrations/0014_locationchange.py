@@ -0,0 +1,48 @@
+# Generated by Django 5.2.5 on 2026-10-19 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0013_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LocationChange",
+            fields=[
+                ("seq", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("location", "Location"), ("image", "Location image")],
+                        max_length=10,
+                    ),
+                ),
+                ("object_id", models.BigIntegerField()),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("create", "Create"),
+                            ("update", "Update"),
+                            ("move", "Move"),
+                            ("delete", "Delete"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "ordering": ["seq"],
+                "indexes": [
+                    models.Index(
+                        fields=["kind", "object_id"], name="locations_l_kind_c097ef_idx"
+                    )
+                ],
+            },
+        ),
+    ]
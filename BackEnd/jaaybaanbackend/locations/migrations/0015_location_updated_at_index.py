@@ -0,0 +1,25 @@
+# Generated by Django 5.2.5 on 2026-10-19 02:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0014_locationchange"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="location",
+            index=models.Index(
+                fields=["updated_at"], name="locations_l_updated_fdc0af_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="locationchange",
+            index=models.Index(
+                fields=["created_at"], name="locations_l_created_cec4a0_idx"
+            ),
+        ),
+    ]
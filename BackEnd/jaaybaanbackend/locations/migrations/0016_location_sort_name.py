@@ -0,0 +1,49 @@
+# Generated by Django 5.2.5 on 2026-10-19 02:53
+
+import unicodedata
+from itertools import batched
+
+from django.db import migrations, models
+
+# A copy of locations.text.normalize() as of this migration, so later
+# changes to it don't change what the migration does
+SEARCH_CHARACTERS = str.maketrans(
+    "يكۀة" "٠١٢٣٤٥٦٧٨٩" "۰۱۲۳۴۵۶۷۸۹" "\u200c",
+    "یکهه" "0123456789" "0123456789" " ",
+)
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text).casefold().translate(SEARCH_CHARACTERS)
+
+
+def fill_sort_names(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+
+    rows = Location.objects.only("pk", "name").order_by("pk").iterator(chunk_size=1000)
+    for batch in batched(rows, 1000):
+        for location in batch:
+            location.sort_name = normalize(location.name)[:255]
+        Location.objects.bulk_update(batch, ["sort_name"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0015_location_updated_at_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="location",
+            name="sort_name",
+            field=models.CharField(default="", editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_sort_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="location",
+            index=models.Index(
+                fields=["sort_name"], name="locations_l_sort_na_b70eb0_idx"
+            ),
+        ),
+    ]
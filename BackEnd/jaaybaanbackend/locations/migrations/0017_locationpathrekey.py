@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-19 02:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("locations", "0016_location_sort_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LocationPathRekey",
+            fields=[
+                (
+                    "location",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="+",
+                        serialize=False,
+                        to="locations.location",
+                    ),
+                ),
+                ("path", models.CharField(max_length=255)),
+                ("new_path", models.CharField(max_length=255)),
+            ],
+        ),
+    ]
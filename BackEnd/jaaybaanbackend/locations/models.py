@@ -1,7 +1,39 @@
+import os
 import re
-from django.db import models
+import uuid
+from collections import defaultdict
+from itertools import batched
+from django.conf import settings
+from django.db import connection, models, transaction
+from treebeard.exceptions import PathOverflow
 from treebeard.mp_tree import MP_Node
 
+from .text import normalize
+
+# Subtrees whose path prefix is replaced by one UPDATE
+PREFIX_BATCH_SIZE = 500
+
+
+def sort_key(name):
+    """The sort_name of a location named ``name``"""
+    return normalize(name)[:255]
+
+
+class TreeOrder:
+    """
+    Location.node_order_by, by LOCATIONS_TREE_MODE. In "sorted" mode
+    treebeard keeps siblings in name order in their paths, so an insert or
+    sorted move rewrites the paths of the siblings after it and of all their
+    descendants. In "append" mode paths only keep the insertion order, new
+    children go last, and siblings are displayed in sort_name order.
+
+    In both modes a rename writes no paths, but it still touches every
+    descendant, whose breadcrumbs change (see touch_descendants()).
+    """
+
+    def __get__(self, instance, owner):
+        return [] if settings.LOCATIONS_TREE_MODE == "append" else ["name"]
+
 
 def location_image_upload_path(instance, filename):
     """
@@ -31,6 +63,8 @@ def location_image_upload_path(instance, filename):
 
 class Location(MP_Node):
     name = models.CharField(max_length=255)
+    # The name normalized for display order; see TreeOrder
+    sort_name = models.CharField(max_length=255, editable=False, default="")
     location_type = models.CharField(
         max_length=50,
         choices=[
@@ -65,10 +99,23 @@ class Location(MP_Node):
         help_text="Duration in days before this location needs cleaning again",
     )
 
+    # Denormalized pointer to the primary image, so lists can show a thumbnail
+    # without loading every image of every location
+    primary_image = models.ForeignKey(
+        "LocationImage",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name="+",
+    )
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    node_order_by = ["name"]
+    node_order_by = TreeOrder()
+    # See locations.rekey
+    steplen = settings.LOCATIONS_TREE_STEPLEN
+    alphabet = settings.LOCATIONS_TREE_ALPHABET
 
     class Meta:
         ordering = ["path"]
@@ -77,14 +124,42 @@ class Location(MP_Node):
             models.Index(fields=["location_type"]),
             models.Index(fields=["is_container"]),
             models.Index(fields=["created_at"]),
+            models.Index(fields=["updated_at"]),
             models.Index(fields=["cleaned_time"]),
             models.Index(fields=["barcode"]),
             models.Index(fields=["name"]),
+            models.Index(fields=["sort_name"]),
         ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def sibling_order(cls):
+        """The order_by() of siblings as displayed"""
+        return ["path"] if cls.node_order_by else ["sort_name", "path"]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Renames touch the descendants on save
+        if "name" in instance.__dict__:
+            instance._loaded_name = instance.name
+        # A changed primary image is set on save
+        if "primary_image_id" in instance.__dict__:
+            instance._loaded_primary_image_id = instance.primary_image_id
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using, fields, from_queryset)
+        # The values are the database's again, as after from_db()
+        loaded = self.__dict__ if fields is None else fields
+        if "name" in loaded and "name" in self.__dict__:
+            self._loaded_name = self.name
+        if {"primary_image", "primary_image_id"} & set(loaded):
+            if "primary_image_id" in self.__dict__:
+                self._loaded_primary_image_id = self.primary_image_id
+
     def get_breadcrumb(self):
         """Returns the path as breadcrumb"""
         ancestors = list(self.get_ancestors()) + [self]
@@ -124,6 +199,183 @@ class Location(MP_Node):
         self.cleaned_time = timezone.now()
         self.save(update_fields=["cleaned_time"])
 
+    def move(self, target, pos=None):
+        """Move the node; treebeard rewrites paths with raw UPDATEs"""
+        from django.utils import timezone
+
+        from .cache import schedule_tree_version_bump
+        from .changes import record_change
+
+        if not self.node_order_by and pos is not None and pos.startswith("sorted-"):
+            # In append mode the position doesn't decide the display order
+            pos = pos.replace("sorted-", "last-")
+        if pos is not None and pos.endswith("-child"):
+            parent = target
+        else:
+            parent = target.get_parent()
+        with transaction.atomic():
+            super().move(target, pos=pos)
+            record_change(
+                LocationChange.LOCATION,
+                self.pk,
+                LocationChange.MOVE,
+                parent_id=None if parent is None else parent.pk,
+            )
+            Location.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+            # The node's own path is stale after a move
+            self.refresh_from_db(fields=["path", "depth", "updated_at"])
+            self.touch_descendants()
+        schedule_tree_version_bump()
+
+    def touch_descendants(self):
+        """
+        Mark the descendants as updated and log it. Their breadcrumbs change
+        with a rename or move of this location (and their paths with a
+        move), which treebeard writes without saving them.
+        """
+        from django.utils import timezone
+
+        from .changes import record_changes
+
+        descendants = Location.objects.filter(
+            path__startswith=self.path, depth__gt=self.depth
+        )
+        ids = list(descendants.values_list("pk", flat=True))
+        if ids:
+            descendants.update(updated_at=timezone.now())
+            record_changes(LocationChange.LOCATION, ids, LocationChange.UPDATE)
+
+    def add_children(self, children):
+        """
+        Add a child for each dict of field values in ``children``, in the
+        positions add_child() would give them, and return them in the order
+        given. Instead of a query and a shift of the following siblings for
+        every child, the positions are worked out together: in sorted mode
+        one query places the new names, the siblings that make room are
+        shifted by a couple of UPDATEs, and the new rows are inserted in
+        bulk. In append mode they all go last.
+        """
+        from .cache import schedule_tree_version_bump
+        from .changes import record_changes
+
+        depth = self.depth + 1
+        with transaction.atomic():
+            # Adds under the same parent wait for this one
+            parent = Location.objects.select_for_update().get(pk=self.pk)
+            siblings = (
+                parent.get_children().order_by("path").values_list("path", flat=True)
+            )
+            if not self.node_order_by:
+                # New children go after the last one
+                siblings = siblings.reverse()[:1]
+            siblings = list(siblings)
+            placed = defaultdict(list)
+            if self.node_order_by:
+                for index, next_path in parent.place_names(
+                    [child["name"] for child in children]
+                ):
+                    placed[next_path].append(index)
+            else:
+                placed[None] = list(range(len(children)))
+
+            # Existing children keep their position unless new ones push them
+            paths = [None] * len(children)
+            shifts = []
+            position = 1
+            for path in [*siblings, None]:
+                for index in placed[path]:
+                    paths[index] = self._get_path(parent.path, depth, position)
+                    position += 1
+                if path is not None:
+                    old = self._str2int(path[-self.steplen :])
+                    if old < position:
+                        shifts.append(
+                            (path, self._get_path(parent.path, depth, position))
+                        )
+                    position = max(old, position) + 1
+            if position > len(self.alphabet) ** self.steplen:
+                raise PathOverflow(f"Too many children under {parent.path}")
+
+            # Through temporary prefixes, so no path is taken twice midway
+            temporary = [f"{parent.path}~{new[-self.steplen:]}" for _, new in shifts]
+            for prefixes in (
+                [(old, temp) for (old, _), temp in zip(shifts, temporary)],
+                [(temp, new) for (_, new), temp in zip(shifts, temporary)],
+            ):
+                for batch in batched(prefixes, PREFIX_BATCH_SIZE):
+                    parent.replace_path_prefixes(batch)
+
+            created = Location.objects.bulk_create(
+                Location(
+                    path=path,
+                    depth=depth,
+                    numchild=0,
+                    sort_name=sort_key(child["name"]),
+                    **child,
+                )
+                for path, child in zip(paths, children)
+            )
+            Location.objects.filter(pk=parent.pk).update(
+                numchild=models.F("numchild") + len(created)
+            )
+            self.numchild = parent.numchild + len(created)
+            record_changes(
+                LocationChange.LOCATION,
+                [location.pk for location in created],
+                LocationChange.CREATE,
+                publish=True,
+                parent_id=parent.pk,
+            )
+        schedule_tree_version_bump()
+        return created
+
+    def place_names(self, names):
+        """
+        (index, path of the child it goes before, or None for the end) of
+        each of ``names`` as a new child, in the order they go in. As in
+        treebeard's sorted inserts, a name goes before the first child the
+        database sorts after it, so the names are compared in the database
+        with its collation.
+        """
+        table = connection.ops.quote_name(Location._meta.db_table)
+        added = " UNION ALL ".join(["SELECT %s AS name, %s AS idx"] * len(names))
+        sql = f"""
+            SELECT idx, next_path FROM (
+                SELECT added.name, added.idx, (
+                    SELECT MIN(path) FROM {table}
+                    WHERE path LIKE %s AND depth = %s AND name > added.name
+                ) AS next_path
+                FROM ({added}) AS added
+            ) AS placed
+            ORDER BY CASE WHEN next_path IS NULL THEN 1 ELSE 0 END,
+                next_path, name, idx
+        """
+        params = [value for index, name in enumerate(names) for value in (name, index)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.path + "%", self.depth + 1, *params])
+            return cursor.fetchall()
+
+    def replace_path_prefixes(self, prefixes):
+        """
+        Replace the path prefixes of the (old, new) pairs ``prefixes``, all
+        of one length, in the subtrees of this location, in one UPDATE
+        """
+        length = len(prefixes[0][0])
+        table = connection.ops.quote_name(Location._meta.db_table)
+        cases = " ".join(["WHEN %s THEN %s"] * len(prefixes))
+        matches = ", ".join(["%s"] * len(prefixes))
+        sql = f"""
+            UPDATE {table}
+            SET path = (CASE SUBSTR(path, 1, {length}) {cases} END)
+                || SUBSTR(path, {length + 1})
+            WHERE path LIKE %s AND SUBSTR(path, 1, {length}) IN ({matches})
+        """
+        params = [value for pair in prefixes for value in pair]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql, [*params, self.path + "%", *(old for old, _ in prefixes)]
+            )
+
     def save(self, *args, **kwargs):
         """Override save to ensure proper tree structure"""
         # If it's not a container, it can't have children
@@ -133,12 +385,60 @@ class Location(MP_Node):
                     "Cannot make a location non-container if it has children"
                 )
 
-        if not self.pk and not hasattr(self, "_mp_path"):
-            # For new objects without a parent, make it a root node
-            if not kwargs.get("parent"):
-                super().save(*args, **kwargs)
-                return
-        super().save(*args, **kwargs)
+        renamed = self.pk and getattr(self, "_loaded_name", self.name) != self.name
+        loaded_primary = getattr(
+            self, "_loaded_primary_image_id", self.primary_image_id
+        )
+        primary_changed = (
+            self.pk
+            and not self._state.adding
+            and kwargs.get("update_fields") is None
+            and loaded_primary != self.primary_image_id
+        )
+        if (
+            primary_changed
+            and self.primary_image_id is not None
+            and not self.images.filter(pk=self.primary_image_id).exists()
+        ):
+            raise ValueError("The primary image must be an image of this location")
+        self.sort_name = sort_key(self.name)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "name" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "sort_name"}
+        elif update_fields is None and self.pk and not self._state.adding:
+            # The primary image is only written by LocationImage.set_primary(),
+            # so saving a copy loaded before it can't put the old one back;
+            # a changed one is set through it below
+            unloaded = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name != "primary_image"
+                and field.attname not in unloaded
+            ]
+
+        from .changes import deferred
+
+        # In a transaction with the change log entry written on post_save,
+        # which a rename defers until its descendants are locked
+        with transaction.atomic(), deferred():
+            if not self.pk and not hasattr(self, "_mp_path"):
+                # For new objects without a parent, make it a root node
+                if not kwargs.get("parent"):
+                    super().save(*args, **kwargs)
+                    return
+            super().save(*args, **kwargs)
+            if renamed:
+                # O(subtree) in either tree mode: one UPDATE, and a change
+                # log entry per descendant
+                self.touch_descendants()
+            if primary_changed and self.primary_image_id is not None:
+                self.primary_image.set_primary()
+            elif primary_changed:
+                LocationImage(pk=loaded_primary, location=self).set_primary(False)
+        self._loaded_name = self.name
+        self._loaded_primary_image_id = self.primary_image_id
 
 
 class LocationImage(models.Model):
@@ -147,23 +447,243 @@ class LocationImage(models.Model):
     )
     image = models.ImageField(upload_to=location_image_upload_path)
     description = models.CharField(max_length=255, blank=True, null=True)
-    is_primary = models.BooleanField(default=False)
+
+    # Perceptual hash (dHash) for near-duplicate detection, stored signed to
+    # fit a BigIntegerField, plus its four 16-bit bands for indexed lookups
+    phash = models.BigIntegerField(blank=True, null=True, db_index=True)
+    phash_band0 = models.IntegerField(blank=True, null=True, db_index=True)
+    phash_band1 = models.IntegerField(blank=True, null=True, db_index=True)
+    phash_band2 = models.IntegerField(blank=True, null=True, db_index=True)
+    phash_band3 = models.IntegerField(blank=True, null=True, db_index=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Pending change of the primary flag, applied to the location on save
+    _is_primary = None
+
     class Meta:
-        ordering = ["-is_primary", "created_at"]
+        ordering = ["created_at"]
 
     def __str__(self):
         return f"{self.location.name} - Image"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # A replaced file is hashed again on save
+        if "image" in instance.__dict__:
+            instance._loaded_image = instance.image.name
+        return instance
+
+    @property
+    def is_primary(self):
+        """Whether this is its location's primary image"""
+        if self._is_primary is not None:
+            return self._is_primary
+        return self.pk is not None and self.location.primary_image_id == self.pk
+
+    @is_primary.setter
+    def is_primary(self, value):
+        self._is_primary = bool(value)
+
+    @property
+    def perceptual_hash(self):
+        """The unsigned 64-bit perceptual hash, or None if not computed"""
+        from .perceptual_hash import to_unsigned
+
+        return None if self.phash is None else to_unsigned(self.phash)
+
+    def set_perceptual_hash(self, value):
+        from .perceptual_hash import hash_bands, to_signed
+
+        self.phash = None if value is None else to_signed(value)
+        bands = hash_bands(value) if value is not None else (None,) * 4
+        (
+            self.phash_band0,
+            self.phash_band1,
+            self.phash_band2,
+            self.phash_band3,
+        ) = bands
+
+    def compute_perceptual_hash(self):
+        """Hash the image file; leaves the hash empty if it can't be read"""
+        from .perceptual_hash import dhash
+
+        if not self.image:
+            self.set_perceptual_hash(None)
+            return
+        was_closed = self.image.closed
+        try:
+            self.image.open("rb")
+            self.image.seek(0)
+            value = dhash(self.image)
+        except Exception:
+            value = None
+        finally:
+            if was_closed:
+                self.image.close()
+            else:
+                self.image.seek(0)
+        self.set_perceptual_hash(value)
+
     def save(self, *args, **kwargs):
         """
-        Override save to ensure only one primary image per location
+        Override save to point the location at its new primary image.
+
+        Swapping the primary image is a single UPDATE of the location row; the
+        other images of the location are never touched.
         """
-        if self.is_primary:
-            # Set all other images of this location to non-primary
-            LocationImage.objects.filter(
-                location=self.location, is_primary=True
-            ).exclude(pk=self.pk).update(is_primary=False)
-        super().save(*args, **kwargs)
+        replaced = getattr(self, "_loaded_image", self.image.name) != self.image.name
+        if replaced or (self.phash is None and self.image):
+            self.compute_perceptual_hash()
+
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self._is_primary or (self._is_primary is False and not adding):
+                self.set_primary(self._is_primary)
+        self._is_primary = None
+        self._loaded_image = self.image.name
+
+    def set_primary(self, primary=True):
+        """Make this image the primary image of its location, or unset it"""
+        locations = Location.objects.filter(pk=self.location_id)
+        if primary:
+            locations.update(primary_image=self)
+        else:
+            locations.filter(primary_image=self).update(primary_image=None)
+
+        if LocationImage.location.is_cached(self):
+            if primary:
+                self.location.primary_image_id = self.pk
+            elif self.location.primary_image_id == self.pk:
+                self.location.primary_image_id = None
+
+
+class ImageUpload(models.Model):
+    """A resumable, chunked image upload that has not been finalized yet"""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    location = models.ForeignKey(
+        Location, on_delete=models.CASCADE, related_name="image_uploads"
+    )
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField(help_text="Total size of the file in bytes")
+    offset = models.PositiveBigIntegerField(
+        default=0, help_text="Number of bytes received so far"
+    )
+    description = models.CharField(max_length=255, blank=True, null=True)
+    is_primary = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["created_at"]
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+    @property
+    def temp_path(self):
+        """Path of the partial file the chunks are written into"""
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{self.pk}.part")
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.size
+
+    def is_expired(self):
+        """Check if the upload has been inactive longer than the expiration window"""
+        from django.utils import timezone
+        from datetime import timedelta
+
+        expiration = timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRATION)
+        return timezone.now() > self.updated_at + expiration
+
+
+class IdempotencyKey(models.Model):
+    """
+    The response of a batch request sent with an ``Idempotency-Key`` header,
+    replayed when the client retries it
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="idempotency_keys",
+    )
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(
+        max_length=64, help_text="SHA-256 of the request body"
+    )
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key_per_user"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.status_code})"
+
+
+class LocationChange(models.Model):
+    """
+    An entry of the append-only change log that clients sync from. Entries
+    only say what changed; the current data is read when they are served.
+    """
+
+    LOCATION = "location"
+    IMAGE = "image"
+    KIND_CHOICES = [(LOCATION, "Location"), (IMAGE, "Location image")]
+
+    CREATE = "create"
+    UPDATE = "update"
+    MOVE = "move"
+    DELETE = "delete"
+    OPERATION_CHOICES = [
+        (CREATE, "Create"),
+        (UPDATE, "Update"),
+        (MOVE, "Move"),
+        (DELETE, "Delete"),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["seq"]
+        indexes = [
+            models.Index(fields=["kind", "object_id"]),
+            # Deletions since a time, for the changed-since export
+            models.Index(fields=["created_at"]),
+        ]
+
+    def __str__(self):
+        return f"#{self.seq} {self.operation} {self.kind} {self.object_id}"
+
+
+class LocationPathRekey(models.Model):
+    """
+    The path of a location re-keyed to a new steplen and alphabet, staged
+    while the tree stays in use and swapped in at the end (see
+    locations.rekey). ``path`` is the path it was computed from, so rows
+    whose location moved since are computed again.
+    """
+
+    location = models.OneToOneField(
+        Location, on_delete=models.CASCADE, primary_key=True, related_name="+"
+    )
+    path = models.CharField(max_length=255)
+    new_path = models.CharField(max_length=255)
+
+    def __str__(self):
+        return f"{self.path} -> {self.new_path}"
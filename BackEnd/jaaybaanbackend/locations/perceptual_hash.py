@@ -0,0 +1,152 @@
+"""
+Perceptual image hashing and near-duplicate lookup.
+
+Every image gets a 64-bit difference hash (dHash). Two photos of the same
+item end up a few bits apart, so near-duplicates are found by Hamming
+distance. Instead of comparing every pair, the hash is split into four
+16-bit bands (multi-index hashing): if two hashes are at most ``d`` bits
+apart, at least one band differs by at most ``d // 4`` bits, so only images
+sharing a (nearly) equal band need to be compared.
+"""
+
+from itertools import combinations
+
+from django.db.models import Q
+from PIL import Image
+
+HASH_SIZE = 8
+BAND_COUNT = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+MAX_DISTANCE = 10
+
+
+def dhash(fp):
+    """Compute the 64-bit difference hash of an image file"""
+    with Image.open(fp) as img:
+        img = img.convert("L").resize(
+            (HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS
+        )
+        pixels = img.tobytes()
+
+    value = 0
+    width = HASH_SIZE + 1
+    for row in range(HASH_SIZE):
+        offset = row * width
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def to_signed(value):
+    """Map an unsigned 64-bit hash onto the signed range of a BigIntegerField"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hash_bands(value):
+    """Split an unsigned hash into its bands, most significant first"""
+    return tuple(
+        (value >> (BAND_BITS * (BAND_COUNT - 1 - i))) & BAND_MASK
+        for i in range(BAND_COUNT)
+    )
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def band_neighbours(band, radius):
+    """All band values within ``radius`` bits of ``band``"""
+    values = [band]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), distance):
+            flipped = band
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def band_radius(max_distance):
+    return max_distance // BAND_COUNT
+
+
+def candidate_filter(value, max_distance):
+    """
+    A Q object selecting every image that may be within ``max_distance`` of
+    ``value``, answered from the band indexes.
+    """
+    radius = band_radius(max_distance)
+    query = Q()
+    for i, band in enumerate(hash_bands(value)):
+        query |= Q(**{f"phash_band{i}__in": band_neighbours(band, radius)})
+    return query
+
+
+def find_clusters(rows, max_distance):
+    """
+    Group ``(id, unsigned_hash)`` rows into clusters of near-duplicates.
+
+    Rather than probing around every image, occupied buckets of each band are
+    paired with the occupied buckets within the band radius, so only images
+    that share a (nearly) equal band are ever compared. Returns a list of id
+    lists, each with at least two members.
+    """
+    radius = band_radius(max_distance)
+    hashes = {}
+    buckets = [{} for _ in range(BAND_COUNT)]
+    shifts = [BAND_BITS * (BAND_COUNT - 1 - i) for i in range(BAND_COUNT)]
+    for pk, value in rows:
+        hashes[pk] = value
+        for bands, shift in zip(buckets, shifts):
+            band = (value >> shift) & BAND_MASK
+            members = bands.get(band)
+            if members is None:
+                bands[band] = [pk]
+            else:
+                members.append(pk)
+
+    parent = {}
+
+    def find(pk):
+        root = pk
+        while root in parent:
+            root = parent[root]
+        while pk != root:
+            parent[pk], pk = root, parent[pk]
+        return root
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    for bands in buckets:
+        for band, members in bands.items():
+            count = len(members)
+            for i in range(count - 1):
+                value = hashes[members[i]]
+                for j in range(i + 1, count):
+                    if (value ^ hashes[members[j]]).bit_count() <= max_distance:
+                        union(members[i], members[j])
+            if not radius:
+                continue
+            for probe in band_neighbours(band, radius)[1:]:
+                # Each pair of neighbouring buckets is visited once
+                if probe > band and probe in bands:
+                    for a in members:
+                        value = hashes[a]
+                        for b in bands[probe]:
+                            if (value ^ hashes[b]).bit_count() <= max_distance:
+                                union(a, b)
+
+    clusters = {}
+    for pk in parent:
+        clusters.setdefault(find(pk), []).append(pk)
+    for root, members in clusters.items():
+        members.append(root)
+    return [sorted(ids) for ids in clusters.values()]
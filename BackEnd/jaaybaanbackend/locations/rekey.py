@@ -0,0 +1,250 @@
+"""
+Tree path capacity, and re-keying the paths to another steplen or alphabet.
+
+Treebeard writes the position of a location among its siblings as
+``steplen`` digits of ``alphabet`` per level, in a path of at most 255
+characters. That caps the tree at 255 // steplen levels and the positions
+under a parent at len(alphabet) ** steplen - 1. New children take the
+position after the highest one in use (a sorted insert shifts the siblings
+after it up by one), so positions freed by deletes and moves aren't reused.
+Past either limit inserts fail with PathOverflow.
+
+Re-keying keeps every position and only writes it with the new digits, so a
+new path depends on the old path alone. prepare() computes the new paths in
+short transactions while the tree stays in use, into LocationPathRekey, and
+catches up with the locations whose path changed meanwhile. switch() then
+computes the few that are still stale and swaps all paths in at once, with
+writes to the tree locked out. The app has to be stopped for the switch,
+which takes a couple of UPDATEs, and started again with the new
+TREE_STEPLEN and TREE_ALPHABET.
+"""
+
+from django.db import connection, transaction
+from django.db.models import CharField, Count, Exists, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat, Length, Substr
+from treebeard.numconv import int2str, str2int
+
+from .cache import schedule_tree_version_bump
+from .models import Location, LocationPathRekey
+
+BATCH_SIZE = 1000
+
+# Catch-up passes of prepare() over the locations changed during a pass
+CATCH_UP_PASSES = 3
+
+# Neither in alphabets nor safe in paths: the placeholder paths of the swap
+# and of add_children() start with "~", and raw LIKE patterns don't escape
+# "%" and "_"
+RESERVED_CHARACTERS = "~%_\\"
+
+# Treebeard's, which backups from before the keying was recorded have
+DEFAULT_KEYING = {"steplen": 4, "alphabet": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+
+
+class RekeyError(Exception):
+    """Raised when the tree can't be re-keyed as asked"""
+
+
+def current_keying():
+    return {"steplen": Location.steplen, "alphabet": Location.alphabet}
+
+
+def capacity(steplen, alphabet):
+    """The most levels, and positions under one parent, a keying allows"""
+    max_length = Location._meta.get_field("path").max_length
+    return {"depth": max_length // steplen, "positions": len(alphabet) ** steplen - 1}
+
+
+def analyze():
+    """
+    Per level of the tree: the number of locations, the most siblings under
+    one parent and the highest position in use
+    """
+    steplen, alphabet = Location.steplen, Location.alphabet
+    # The alphabet is in database sort order, so the highest step is the max
+    last_step = Substr("path", Length("path") - steplen + 1, steplen)
+    levels = list(
+        Location.objects.order_by("depth")
+        .values("depth")
+        .annotate(locations=Count("pk"), widest=Max("numchild"), step=Max(last_step))
+    )
+    widest = {level["depth"]: level.pop("widest") for level in levels}
+    for level in levels:
+        depth = level["depth"]
+        level["siblings"] = widest[depth - 1] if depth > 1 else level["locations"]
+        level["position"] = str2int(level.pop("step"), len(alphabet), alphabet)
+    return levels
+
+
+def headroom(levels, steplen, alphabet):
+    """How much of the capacity of a keying the tree of ``levels`` takes"""
+    limits = capacity(steplen, alphabet)
+    depth = max((level["depth"] for level in levels), default=0)
+    position = max((level["position"] for level in levels), default=0)
+    return {
+        "depth": depth,
+        "max_depth": limits["depth"],
+        "position": position,
+        "max_positions": limits["positions"],
+        "fits": depth <= limits["depth"] and position <= limits["positions"],
+    }
+
+
+def check_keying(steplen, alphabet):
+    if steplen < 1:
+        raise RekeyError("The steplen must be at least 1")
+    if len(alphabet) < 2 or len(set(alphabet)) != len(alphabet):
+        raise RekeyError("The alphabet must have at least two distinct characters")
+    ordered = database_order(alphabet)
+    if ordered != alphabet:
+        raise RekeyError(
+            f"The alphabet must be in the database's sort order: {ordered}"
+        )
+    if reserved := set(alphabet) & set(RESERVED_CHARACTERS):
+        raise RekeyError(f"The alphabet can't contain {''.join(sorted(reserved))}")
+
+
+def database_order(characters):
+    """
+    ``characters`` sorted as the database sorts the paths, which can differ
+    from code point order, for example in case under PostgreSQL's default
+    collations
+    """
+    collation = Location._meta.get_field("path").db_collation
+    order = "c"
+    if collation:
+        order += f" COLLATE {connection.ops.quote_name(collation)}"
+    characters = list(characters)
+    selects = " UNION ALL ".join(["SELECT %s AS c"] * len(characters))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT c FROM ({selects}) AS characters ORDER BY {order}", characters
+        )
+        return "".join(c for c, in cursor.fetchall())
+
+
+def check_fits(steplen, alphabet):
+    room = headroom(analyze(), steplen, alphabet)
+    if not room["fits"]:
+        raise RekeyError(
+            f"The tree is {room['depth']} levels deep with position "
+            f"{room['position']} in use; steplen {steplen} with "
+            f"{len(alphabet)} digits allows {room['max_depth']} levels and "
+            f"{room['max_positions']} positions"
+        )
+
+
+def rekey_path(path, steplen, alphabet):
+    """``path`` keyed with ``steplen`` and ``alphabet`` instead"""
+    old_steplen, old_alphabet = Location.steplen, Location.alphabet
+    return "".join(
+        int2str(
+            str2int(path[start : start + old_steplen], len(old_alphabet), old_alphabet),
+            len(alphabet),
+            alphabet,
+        ).rjust(steplen, alphabet[0])
+        for start in range(0, len(path), old_steplen)
+    )
+
+
+def stale_locations():
+    """Locations without a new path, or whose path changed since it was staged"""
+    staged = LocationPathRekey.objects.filter(
+        location=OuterRef("pk"), path=OuterRef("path")
+    )
+    return Location.objects.filter(~Exists(staged))
+
+
+def stage(steplen, alphabet, batch_size=BATCH_SIZE, progress=None):
+    """
+    Compute the new paths of the stale locations, a batch per transaction,
+    calling ``progress`` with the number done after each. Returns the number.
+    """
+    done = 0
+    last = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                stale_locations()
+                .select_for_update()
+                .filter(pk__gt=last)
+                .order_by("pk")
+                .values_list("pk", "path")[:batch_size]
+            )
+            if not rows:
+                return done
+            LocationPathRekey.objects.bulk_create(
+                [
+                    LocationPathRekey(
+                        location_id=pk,
+                        path=path,
+                        new_path=rekey_path(path, steplen, alphabet),
+                    )
+                    for pk, path in rows
+                ],
+                update_conflicts=True,
+                unique_fields=["location"],
+                update_fields=["path", "new_path"],
+            )
+        done += len(rows)
+        last = rows[-1][0]
+        if progress:
+            progress(done)
+
+
+def prepare(steplen, alphabet, batch_size=BATCH_SIZE, progress=None):
+    """
+    Stage the new path of every location while the tree stays in use.
+    Can be run again, to catch up, before switch(). Returns the number of
+    paths computed.
+    """
+    check_keying(steplen, alphabet)
+    check_fits(steplen, alphabet)
+    sample = LocationPathRekey.objects.first()
+    if sample and rekey_path(sample.path, steplen, alphabet) != sample.new_path:
+        # Staged for another keying
+        LocationPathRekey.objects.all().delete()
+
+    total = done = stage(steplen, alphabet, batch_size, progress)
+    for _ in range(CATCH_UP_PASSES):
+        if not done:
+            break
+        done = stage(steplen, alphabet, batch_size, progress)
+        total += done
+    return total
+
+
+def switch(steplen, alphabet, batch_size=BATCH_SIZE):
+    """
+    Swap the staged paths in, computing those still stale first. Returns
+    the number of locations re-keyed.
+    """
+    check_keying(steplen, alphabet)
+    with transaction.atomic():
+        lock_tree()
+        check_fits(steplen, alphabet)
+        stage(steplen, alphabet, batch_size)
+        count = Location.objects.count()
+        if LocationPathRekey.objects.count() != count:
+            raise RekeyError("Not every location has a staged path")
+
+        # Through placeholders, so no path is taken twice midway
+        Location.objects.update(path=Concat(Value("~"), Cast("pk", CharField())))
+        Location.objects.update(
+            path=Subquery(
+                LocationPathRekey.objects.filter(location=OuterRef("pk")).values(
+                    "new_path"
+                )
+            )
+        )
+        LocationPathRekey.objects.all().delete()
+        schedule_tree_version_bump()
+    return count
+
+
+def lock_tree():
+    """Keep other transactions from writing to the tree until this one ends"""
+    if connection.vendor == "postgresql":
+        table = connection.ops.quote_name(Location._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")
@@ -1,19 +1,84 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.db import connection
 from rest_framework import serializers
-from .models import Location, LocationImage
+from .models import Location, LocationImage, ImageUpload
 
 
 class LocationImageSerializer(serializers.ModelSerializer):
+    is_primary = serializers.BooleanField(required=False)
+
     class Meta:
         model = LocationImage
         fields = ["id", "image", "description", "is_primary", "created_at"]
         read_only_fields = ["id", "created_at"]
 
 
+class LocationThumbnailSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LocationImage
+        fields = ["id", "image", "description"]
+
+
+class LocationImageDuplicateSerializer(LocationImageSerializer):
+    location_id = serializers.IntegerField(source="location.id", read_only=True)
+    location_name = serializers.CharField(source="location.name", read_only=True)
+    distance = serializers.SerializerMethodField()
+
+    class Meta(LocationImageSerializer.Meta):
+        fields = LocationImageSerializer.Meta.fields + [
+            "location_id",
+            "location_name",
+            "distance",
+        ]
+
+    def get_distance(self, obj):
+        return getattr(obj, "distance", None)
+
+
+class ImageUploadSerializer(serializers.ModelSerializer):
+    complete = serializers.BooleanField(source="is_complete", read_only=True)
+
+    class Meta:
+        model = ImageUpload
+        fields = [
+            "id",
+            "filename",
+            "size",
+            "offset",
+            "description",
+            "is_primary",
+            "complete",
+            "created_at",
+            "updated_at",
+        ]
+        read_only_fields = ["id", "offset", "created_at", "updated_at"]
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Size must be greater than zero.")
+        return value
+
+
+class LocationChildSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Location
+        fields = ["id", "name", "location_type", "is_container"]
+
+
 class LocationSerializer(serializers.ModelSerializer):
     images = LocationImageSerializer(many=True, read_only=True)
+    primary_image = LocationThumbnailSerializer(read_only=True)
     breadcrumb = serializers.SerializerMethodField()
     children_count = serializers.SerializerMethodField()
     needs_cleaning = serializers.SerializerMethodField()
+    children = serializers.SerializerMethodField()
+
+    # Only included when asked for with ?expand= / ?fields=
+    optional_fields = ["children"]
+    expandable_fields = ["images", "breadcrumb", "children"]
 
     class Meta:
         model = Location
@@ -33,16 +98,71 @@ class LocationSerializer(serializers.ModelSerializer):
             "breadcrumb",
             "children_count",
             "needs_cleaning",
+            "primary_image",
             "images",
+            "children",
         ]
         read_only_fields = ["id", "created_at", "updated_at"]
 
+    def __init__(self, *args, fields=None, **kwargs):
+        """
+        ``fields`` restricts the output to the given field names, see
+        select_fields(); by default every field but the optional ones is
+        included.
+        """
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            fields = self.default_fields()
+        for name in set(self.fields) - set(fields):
+            self.fields.pop(name)
+
+    @classmethod
+    def default_fields(cls):
+        return [name for name in cls.Meta.fields if name not in cls.optional_fields]
+
+    @classmethod
+    def select_fields(cls, query_params):
+        """
+        The output fields requested with ``?fields=a,b`` (default: all but
+        the optional fields) plus ``?expand=images,breadcrumb,children``, in
+        the serializer's order.
+        """
+
+        def names(param):
+            value = query_params.get(param)
+            if value is None:
+                return None
+            return {name.strip() for name in value.split(",") if name.strip()}
+
+        fields = names("fields")
+        expand = names("expand") or set()
+        errors = {}
+        for param, requested, valid in [
+            ("fields", fields or set(), cls.Meta.fields),
+            ("expand", expand, cls.expandable_fields),
+        ]:
+            unknown = requested - set(valid)
+            if unknown:
+                errors[param] = [
+                    f"Unknown fields: {', '.join(sorted(unknown))}. "
+                    f"Valid fields: {', '.join(valid)}"
+                ]
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        selected = set(cls.default_fields()) if fields is None else fields
+        return [name for name in cls.Meta.fields if name in selected | expand]
+
     def get_breadcrumb(self, obj):
         return obj.get_breadcrumb()
 
     def get_children_count(self, obj):
         return obj.get_children().count()
 
+    def get_children(self, obj):
+        children = obj.get_children().order_by(*Location.sibling_order())
+        return LocationChildSerializer(children, many=True).data
+
     def get_needs_cleaning(self, obj):
         return obj.needs_cleaning()
 
@@ -64,6 +184,80 @@ class LocationSerializer(serializers.ModelSerializer):
         return value
 
 
+class LocationBulkFieldsSerializer(serializers.ModelSerializer):
+    """The values the update_fields bulk operation sets"""
+
+    class Meta:
+        model = Location
+        fields = [
+            "location_type",
+            "description",
+            "is_container",
+            "quantity",
+            "value",
+            "cleaned_duration",
+        ]
+        extra_kwargs = {name: {"required": False} for name in fields}
+
+
+def column_maximum(name):
+    """The largest value the database stores in a Location integer column"""
+    field = Location._meta.get_field(name)
+    return connection.ops.integer_field_range(field.get_internal_type())[1]
+
+
+class LocationBulkIncrementsSerializer(serializers.Serializer):
+    """The amounts the update_fields bulk operation adds"""
+
+    quantity = serializers.IntegerField(required=False)
+    cleaned_duration = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        for name, amount in attrs.items():
+            maximum = column_maximum(name)
+            if abs(amount) > maximum:
+                raise serializers.ValidationError(
+                    {name: f"Ensure this value is between -{maximum} and {maximum}."}
+                )
+        return attrs
+
+
+class LocationBulkUpdateSerializer(serializers.Serializer):
+    set = LocationBulkFieldsSerializer(required=False)
+    add = LocationBulkIncrementsSerializer(required=False)
+
+    def validate(self, attrs):
+        values = attrs.get("set", {})
+        increments = attrs.get("add", {})
+        if not values and not increments:
+            raise serializers.ValidationError("Nothing to update")
+        both = sorted(set(values) & set(increments))
+        if both:
+            raise serializers.ValidationError(
+                f"Cannot both set and add to {', '.join(both)}"
+            )
+        return attrs
+
+
+class LocationBulkChildSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Location
+        fields = [
+            "name",
+            "location_type",
+            "description",
+            "is_container",
+            "barcode",
+            "quantity",
+            "value",
+            "cleaned_duration",
+        ]
+
+
+class LocationBulkChildrenSerializer(serializers.Serializer):
+    children = LocationBulkChildSerializer(many=True, allow_empty=False, max_length=500)
+
+
 class LocationTreeSerializer(serializers.ModelSerializer):
     children = serializers.SerializerMethodField()
     breadcrumb = serializers.SerializerMethodField()
@@ -87,7 +281,7 @@ class LocationTreeSerializer(serializers.ModelSerializer):
         return obj.get_breadcrumb()
 
     def get_children(self, obj):
-        children = obj.get_children()
+        children = obj.get_children().order_by(*Location.sibling_order())
         return LocationTreeSerializer(children, many=True).data
 
 
@@ -118,6 +312,26 @@ class LocationSearchSerializer(serializers.Serializer):
     parent_id = serializers.IntegerField(required=False)
 
 
+class LocationChangesSerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, required=False, default=0)
+
+
+class LocationEventsSerializer(serializers.Serializer):
+    # Replay the changes after it first; from the Last-Event-ID header when
+    # the client reconnects
+    since = serializers.IntegerField(min_value=0, required=False)
+
+
+class LocationExportSinceSerializer(serializers.Serializer):
+    # A change seq, or a timestamp
+    since = serializers.CharField(required=False)
+
+    def validate_since(self, value):
+        if value.isdigit():
+            return int(value)
+        return serializers.DateTimeField().to_internal_value(value)
+
+
 class LocationExportSerializer(serializers.ModelSerializer):
     breadcrumb_path = serializers.SerializerMethodField()
     parent_name = serializers.SerializerMethodField()
@@ -150,3 +364,49 @@ class LocationExportSerializer(serializers.ModelSerializer):
 
     def get_images_count(self, obj):
         return obj.images.count()
+
+
+class BatchFileSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    content = serializers.CharField(help_text="Base64-encoded file content")
+    content_type = serializers.CharField(
+        required=False, default="application/octet-stream"
+    )
+
+    def validate_content(self, value):
+        try:
+            return base64.b64decode(value, validate=True)
+        except binascii.Error:
+            raise serializers.ValidationError("Content must be valid base64")
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    id = serializers.RegexField(
+        r"^[A-Za-z_]\w*$",
+        max_length=50,
+        required=False,
+        help_text="Name for referring to the response as $<id>.<field>",
+    )
+    method = serializers.ChoiceField(choices=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    path = serializers.CharField(max_length=2000)
+    body = serializers.JSONField(required=False, default=dict)
+    headers = serializers.DictField(
+        child=serializers.CharField(), required=False, default=dict
+    )
+    files = serializers.DictField(
+        child=BatchFileSerializer(), required=False, default=dict
+    )
+
+
+class BatchSerializer(serializers.Serializer):
+    operations = serializers.ListField(child=BatchOperationSerializer(), min_length=1)
+
+    def validate_operations(self, value):
+        if len(value) > settings.BATCH_MAX_OPERATIONS:
+            raise serializers.ValidationError(
+                f"At most {settings.BATCH_MAX_OPERATIONS} operations are allowed"
+            )
+        ids = [operation["id"] for operation in value if "id" in operation]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError("Operation ids must be unique")
+        return value
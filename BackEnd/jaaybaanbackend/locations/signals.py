@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import schedule_tree_version_bump
+from .changes import record_change
+from .models import Location, LocationChange, LocationImage
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=LocationImage)
+@receiver(post_delete, sender=LocationImage)
+def invalidate_location_caches(sender, instance=None, **kwargs):
+    schedule_tree_version_bump()
+
+
+@receiver(post_save, sender=Location)
+def log_location_save(sender, instance=None, created=False, **kwargs):
+    if created:
+        # Cached by add_child(), so this is usually free
+        parent = instance.get_parent()
+        record_change(
+            LocationChange.LOCATION,
+            instance.pk,
+            LocationChange.CREATE,
+            parent_id=None if parent is None else parent.pk,
+        )
+    else:
+        record_change(LocationChange.LOCATION, instance.pk, LocationChange.UPDATE)
+
+
+@receiver(post_delete, sender=Location)
+def log_location_delete(sender, instance=None, **kwargs):
+    record_change(LocationChange.LOCATION, instance.pk, LocationChange.DELETE)
+
+
+@receiver(post_save, sender=LocationImage)
+@receiver(post_delete, sender=LocationImage)
+def log_image_change(sender, instance=None, created=False, **kwargs):
+    if kwargs["signal"] is post_delete:
+        operation = LocationChange.DELETE
+    else:
+        operation = LocationChange.CREATE if created else LocationChange.UPDATE
+    # The location's primary image and image count may have changed with it.
+    # Its row is locked before the change log (see changes.lock_change_log).
+    Location.objects.filter(pk=instance.location_id).update(updated_at=timezone.now())
+    record_change(LocationChange.IMAGE, instance.pk, operation)
+    record_change(LocationChange.LOCATION, instance.location_id, LocationChange.UPDATE)
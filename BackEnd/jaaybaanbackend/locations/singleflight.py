@@ -0,0 +1,89 @@
+"""
+Request coalescing ("single-flight") for expensive cache fills.
+
+When many identical requests miss the cache at once, e.g. right after a
+write bumped the tree version or after a deploy, only one of them computes
+the value; the others wait for it and share the result. Threads of a worker
+are coalesced in memory. Setting LOCATIONS_SINGLEFLIGHT_LOCK_DIR also
+serializes the fill across worker processes with file locks, so the other
+workers find the value in the shared cache instead of computing it again.
+"""
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Keys are hashed onto a fixed set of lock files, so the directory doesn't
+# grow with every tree version
+LOCK_STRIPES = 64
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Call ``fn`` and return its result, unless a call for ``key`` is
+        already in flight in this process, in which case wait for that one
+        and return (or raise) its result instead.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+
+@contextmanager
+def worker_lock(key):
+    """Hold an exclusive file lock for ``key`` across worker processes"""
+    lock_dir = settings.LOCATIONS_SINGLEFLIGHT_LOCK_DIR
+    if not lock_dir or fcntl is None:
+        yield
+        return
+
+    os.makedirs(lock_dir, exist_ok=True)
+    stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(lock_dir, f"{stripe:02d}.lock"), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+flights = SingleFlight()
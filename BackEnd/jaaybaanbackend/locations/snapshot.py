@@ -0,0 +1,298 @@
+"""
+Offline snapshots: the whole inventory as a ready-to-query SQLite database.
+
+A local-first client downloads one file and queries it as is, instead of
+parsing the JSON export and indexing it again on the device. Locations come
+with their parent, breadcrumb and a normalized search text, indexed by an
+FTS5 table; images come with their URL.
+
+Writing a snapshot reads every row, so snapshots are kept on disk by tree
+version like the cached responses (see locations.cache): downloads of the
+same version share one file, and concurrent misses are coalesced by the
+single-flight. A snapshot records the change log seq read before its data,
+so a client can sync the changes made since from the changes endpoint.
+"""
+
+import os
+import sqlite3
+import tempfile
+from datetime import UTC
+from itertools import batched
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import changes
+from .cache import get_tree_version
+from .fast_serializers import STEPLEN, compile_fields
+from .models import Location, LocationImage
+from .serializers import LocationImageSerializer
+from .singleflight import flights, worker_lock
+from .text import normalize
+
+# Bumped whenever the tables below change
+SCHEMA_VERSION = 1
+
+CONTENT_TYPE = "application/vnd.sqlite3"
+
+READ_BLOCK_SIZE = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE locations (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    path TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    numchild INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    location_type TEXT NOT NULL,
+    description TEXT,
+    is_container INTEGER NOT NULL,
+    barcode TEXT,
+    quantity INTEGER NOT NULL,
+    value REAL,
+    cleaned_time TEXT,
+    cleaned_duration INTEGER NOT NULL,
+    primary_image_id INTEGER,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    breadcrumb TEXT NOT NULL,
+    search_text TEXT NOT NULL
+);
+CREATE TABLE images (
+    id INTEGER PRIMARY KEY,
+    location_id INTEGER NOT NULL,
+    image TEXT NOT NULL,
+    description TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE locations_fts USING fts5(
+    search_text,
+    content='locations',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+# Created once the rows are in, which is faster than maintaining them
+INDEXES = """
+CREATE UNIQUE INDEX locations_path ON locations (path);
+CREATE INDEX locations_parent_id ON locations (parent_id);
+CREATE INDEX locations_barcode ON locations (barcode);
+CREATE INDEX locations_location_type ON locations (location_type);
+CREATE INDEX images_location_id ON images (location_id);
+INSERT INTO locations_fts (locations_fts) VALUES ('rebuild');
+"""
+
+LOCATION_COLUMNS = [
+    "id",
+    "path",
+    "depth",
+    "numchild",
+    "name",
+    "location_type",
+    "description",
+    "is_container",
+    "barcode",
+    "quantity",
+    "value",
+    "cleaned_time",
+    "cleaned_duration",
+    "primary_image_id",
+    "created_at",
+    "updated_at",
+]
+
+IMAGE_COLUMNS = ["id", "location_id", "image", "description", "created_at"]
+
+
+def iso_datetime(value):
+    """
+    ``value`` as ISO 8601 in UTC, so the text sorts and compares in time
+    order. DRF's DateTimeField looks up the current time zone for every
+    value, which dominated the time taken to write a snapshot.
+    """
+    return value.astimezone(UTC).isoformat().replace("+00:00", "Z")
+
+
+# Writing
+
+
+def location_rows(batch_size):
+    """
+    Snapshot rows of every location, in batches. In path order parents come
+    before their children, so as in fast_serializers.stream_export() only the
+    id and breadcrumb of locations with children are kept.
+    """
+    parents = {}
+    queryset = Location.objects.order_by("path").values(*LOCATION_COLUMNS)
+    for rows in batched(queryset.iterator(chunk_size=batch_size), batch_size):
+        batch = []
+        for row in rows:
+            parent_id, crumbs = parents.get(row["path"][:-STEPLEN], (None, ""))
+            crumb = f"{crumbs} > {row['name']}" if crumbs else row["name"]
+            if row["numchild"]:
+                parents[row["path"]] = (row["id"], crumb)
+            text = " ".join(
+                value for value in (crumb, row["description"], row["barcode"]) if value
+            )
+            batch.append(
+                (
+                    row["id"],
+                    parent_id,
+                    row["path"],
+                    row["depth"],
+                    row["numchild"],
+                    row["name"],
+                    row["location_type"],
+                    row["description"],
+                    row["is_container"],
+                    row["barcode"],
+                    row["quantity"],
+                    None if row["value"] is None else float(row["value"]),
+                    (
+                        None
+                        if row["cleaned_time"] is None
+                        else iso_datetime(row["cleaned_time"])
+                    ),
+                    row["cleaned_duration"],
+                    row["primary_image_id"],
+                    iso_datetime(row["created_at"]),
+                    iso_datetime(row["updated_at"]),
+                    crumb,
+                    normalize(text),
+                )
+            )
+        yield batch
+
+
+def image_rows(batch_size):
+    """Snapshot rows of every image, in batches, with URLs as the API has them"""
+    url = compile_fields(LocationImageSerializer)["image"]
+    queryset = LocationImage.objects.order_by("id").values_list(*IMAGE_COLUMNS)
+    for rows in batched(queryset.iterator(chunk_size=batch_size), batch_size):
+        yield [
+            (image_id, location_id, url(image), description, iso_datetime(created_at))
+            for image_id, location_id, image, description, created_at in rows
+        ]
+
+
+def write_snapshot(path, tree_version=None, batch_size=1000):
+    """Write a snapshot of the inventory to a new SQLite database at ``path``"""
+    # Read before the data, so syncing from it can only repeat changes
+    meta = {
+        "schema_version": SCHEMA_VERSION,
+        "tree_version": tree_version,
+        "change_seq": changes.current_seq(),
+        "exported_at": iso_datetime(timezone.now()),
+    }
+    db = sqlite3.connect(path)
+    try:
+        # A half-written file is thrown away, so skip the journal and fsyncs
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        db.executescript(SCHEMA)
+        for batch in location_rows(batch_size):
+            db.executemany(
+                f"INSERT INTO locations VALUES ({', '.join('?' * 19)})", batch
+            )
+        for batch in image_rows(batch_size):
+            db.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?)", batch)
+        db.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [(key, str(value)) for key, value in meta.items() if value is not None],
+        )
+        db.executescript(INDEXES)
+        db.commit()
+    finally:
+        db.close()
+
+
+def read_meta(path):
+    """The meta table of the snapshot at ``path``"""
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return dict(db.execute("SELECT key, value FROM meta"))
+    finally:
+        db.close()
+
+
+# Caching by tree version
+
+
+def snapshot_path(version):
+    return os.path.join(settings.LOCATIONS_SNAPSHOT_DIR, f"snapshot-{version}.sqlite")
+
+
+def open_snapshot():
+    """
+    Open the snapshot of the current tree version, writing it first if it
+    isn't on disk yet. Returns the open file and its meta table.
+    """
+    while True:
+        version = get_tree_version()
+        path = snapshot_path(version)
+        if not os.path.exists(path):
+            flights.do(path, lambda: fill(path, version))
+        try:
+            # An open file stays readable once a newer snapshot deletes it
+            file = open(path, "rb")
+        except FileNotFoundError:
+            # Deleted by the snapshot of a newer version in between
+            continue
+        try:
+            meta = read_meta(path)
+        except sqlite3.OperationalError:
+            file.close()
+            if os.path.exists(path):
+                raise
+            continue
+        return file, meta
+
+
+def fill(path, version):
+    with worker_lock(path):
+        # Another worker may have written it while we waited
+        if os.path.exists(path):
+            return
+        os.makedirs(settings.LOCATIONS_SNAPSHOT_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            suffix=".tmp", dir=settings.LOCATIONS_SNAPSHOT_DIR
+        )
+        os.close(fd)
+        try:
+            write_snapshot(temp_path, version)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    delete_older_snapshots(version)
+
+
+def delete_older_snapshots(version):
+    """Delete the snapshots of tree versions before ``version``"""
+    for name in os.listdir(settings.LOCATIONS_SNAPSHOT_DIR):
+        stem, _, suffix = name.partition(".")
+        prefix, _, older = stem.partition("-")
+        if (
+            suffix == "sqlite"
+            and prefix == "snapshot"
+            and older.isdigit()
+            and int(older) < version
+        ):
+            try:
+                os.remove(os.path.join(settings.LOCATIONS_SNAPSHOT_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def read_blocks(file):
+    """The contents of ``file`` in blocks, closing it at the end"""
+    with file:
+        while block := file.read(READ_BLOCK_SIZE):
+            yield block
@@ -1,3 +1,1830 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import gzip
+import importlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from jaaybaanbackend import renderers
+from jaaybaanbackend import urls as root_urls
+from jaaybaanbackend.middleware import negotiate
+from jaaybaanbackend.parsers import FastJSONParser
+from jaaybaanbackend.renderers import FastJSONRenderer
+from jaaybaanbackend.sqlite_cache import SQLiteCache
+from . import (
+    archive,
+    async_views,
+    backup,
+    changes,
+    events,
+    rekey,
+    snapshot,
+    text,
+    uploads,
+    views,
+)
+from . import urls as locations_urls
+from .cache import get_or_compute, get_tree_version
+from .models import (
+    Location,
+    LocationChange,
+    LocationImage,
+    ImageUpload,
+    LocationPathRekey,
+)
+from .serializers import (
+    LocationExportSerializer,
+    LocationSerializer,
+    LocationTreeSerializer,
+)
+
+
+def make_image_bytes(color="red", size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def make_pattern_bytes(size=(64, 64), reverse=False):
+    """A horizontal gradient, so the perceptual hash is not all zeros"""
+    img = Image.linear_gradient("L").rotate(90 if reverse else -90).resize(size)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class LocationAPITestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.enterContext(
+            override_settings(
+                MEDIA_ROOT=self.media_root,
+                CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, "chunked_uploads"),
+            )
+        )
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="testuser", password="testpass123"
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        self.house = Location.add_root(name="House", location_type="house")
+        self.room = self.house.add_child(name="Kitchen", location_type="room")
+
+
+class ChunkedImageUploadTestCase(LocationAPITestCase):
+    def send_chunk(self, url, data, offset):
+        return self.client.generic(
+            "PATCH",
+            url,
+            data,
+            content_type="application/offset+octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_chunked_upload_resumes_and_finalizes(self):
+        """Test that an interrupted upload resumes from the server offset"""
+        content = make_image_bytes()
+        base = f"/api/v1/locations/{self.room.id}/images/uploads/"
+
+        response = self.client.post(
+            base, {"filename": "photo.png", "size": len(content)}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        url = f"{base}{response.data['id']}/"
+
+        half = len(content) // 2
+        response = self.send_chunk(url, content[:half], 0)
+        self.assertEqual(response.data["offset"], half)
+
+        # Skipping ahead is rejected with the offset to resume from
+        response = self.send_chunk(url, content[half + 10 :], half + 10)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data["offset"], half)
+
+        response = self.client.get(url)
+        self.assertEqual(response["Upload-Offset"], str(half))
+
+        response = self.send_chunk(url, content[half:], half)
+        self.assertTrue(response.data["complete"])
+
+        response = self.client.post(f"{url}complete/")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        image = LocationImage.objects.get(location=self.room)
+        with image.image.open("rb") as fh:
+            self.assertEqual(fh.read(), content)
+        self.assertFalse(ImageUpload.objects.exists())
+
+    def test_incomplete_upload_cannot_be_finalized(self):
+        """Test that finalizing before all bytes arrived fails"""
+        base = f"/api/v1/locations/{self.room.id}/images/uploads/"
+        response = self.client.post(
+            base, {"filename": "photo.png", "size": 100}, format="json"
+        )
+        response = self.client.post(f"{base}{response.data['id']}/complete/")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_expired_upload_cannot_be_finalized(self):
+        """Test that an upload expired or removed meanwhile isn't finalized"""
+        content = make_image_bytes()
+        base = f"/api/v1/locations/{self.room.id}/images/uploads/"
+        response = self.client.post(
+            base, {"filename": "photo.png", "size": len(content)}, format="json"
+        )
+        url = f"{base}{response.data['id']}/"
+        self.send_chunk(url, content, 0)
+        upload = ImageUpload.objects.get()
+
+        # Expired while its image was being verified
+        ImageUpload.objects.update(
+            updated_at=timezone.now() - datetime.timedelta(days=30)
+        )
+        with self.assertRaises(uploads.UploadError) as cm:
+            uploads.finish_upload(upload)
+        self.assertEqual(cm.exception.status_code, 410)
+
+        response = self.client.post(f"{url}complete/")
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        ImageUpload.objects.all().delete()
+        with self.assertRaises(uploads.UploadError) as cm:
+            uploads.finish_upload(upload)
+        self.assertEqual(cm.exception.status_code, 404)
+        uploads.discard_upload_file(upload)
+        self.assertFalse(LocationImage.objects.exists())
+
+
+class MediaGarbageCollectorTestCase(LocationAPITestCase):
+    def test_media_gc_deletes_orphans_and_missing_rows(self):
+        """Test that media_gc removes orphaned files and rows without files"""
+        kept = LocationImage(location=self.room)
+        kept.image.save("kept.png", ContentFile(make_image_bytes()))
+        gone = LocationImage(location=self.room)
+        gone.image.save("gone.png", ContentFile(make_image_bytes()))
+        os.remove(gone.image.path)
+
+        orphan = os.path.join(self.media_root, "location_images", "orphan.png")
+        with open(orphan, "wb") as fh:
+            fh.write(b"orphan")
+        # A chunked upload, and one deleted with its location
+        box = self.room.add_child(name="Box", location_type="box")
+        upload = uploads.start_upload(self.room, "photo.png", 10)
+        abandoned = uploads.start_upload(box, "photo.png", 10)
+        box.delete()
+        self.assertFalse(ImageUpload.objects.filter(pk=abandoned.pk).exists())
+
+        out = io.StringIO()
+        call_command(
+            "media_gc", "--delete", "--delete-missing", "--min-age=0", stdout=out
+        )
+
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(abandoned.temp_path))
+        self.assertTrue(os.path.exists(upload.temp_path))
+        self.assertTrue(os.path.exists(kept.image.path))
+        self.assertEqual(
+            list(LocationImage.objects.values_list("pk", flat=True)), [kept.pk]
+        )
+        self.assertIn("Deleted 2 orphaned files", out.getvalue())
+
+
+class DuplicateImageTestCase(LocationAPITestCase):
+    def add_image(self, location, content):
+        image = LocationImage(location=location)
+        image.image.save("photo.png", ContentFile(content))
+        return image
+
+    def test_near_duplicates_are_found(self):
+        """Test that resized copies are found and different images are not"""
+        original = self.add_image(self.room, make_pattern_bytes())
+        resized = self.add_image(self.house, make_pattern_bytes(size=(120, 100)))
+        other = self.add_image(self.house, make_pattern_bytes(reverse=True))
+        self.assertIsNotNone(original.phash)
+
+        response = self.client.get(
+            "/api/v1/locations/images/duplicates/", {"image_id": original.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [image["id"] for image in response.data["duplicates"]]
+        self.assertEqual(ids, [resized.id])
+        self.assertEqual(response.data["duplicates"][0]["location_id"], self.house.id)
+
+        response = self.client.get("/api/v1/locations/images/duplicates/")
+        clusters = [[image["id"] for image in c] for c in response.data["clusters"]]
+        self.assertEqual(clusters, [[original.id, resized.id]])
+        self.assertNotIn(other.id, clusters[0])
+
+    def test_replaced_image_is_hashed_again(self):
+        """Test that replacing the file of an image replaces its hash"""
+        image = self.add_image(self.room, make_pattern_bytes())
+        other = self.add_image(self.house, make_pattern_bytes(reverse=True))
+        response = self.client.patch(
+            f"/api/v1/locations/{self.room.id}/images/{image.id}/",
+            {"image": ContentFile(make_pattern_bytes(reverse=True), name="new.png")},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        image.refresh_from_db()
+        self.assertEqual(image.phash, other.phash)
+
+
+class PrimaryImageTestCase(LocationAPITestCase):
+    def upload(self, is_primary):
+        return self.client.post(
+            f"/api/v1/locations/{self.room.id}/images/",
+            {
+                "image": ContentFile(make_image_bytes(), name="photo.png"),
+                "is_primary": is_primary,
+            },
+            format="multipart",
+        )
+
+    def test_primary_image_pointer_is_swapped(self):
+        """Test that marking a new primary image updates only the location"""
+        first = self.upload(True).data
+        second = self.upload(False).data
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.primary_image_id, first["id"])
+        self.assertFalse(second["is_primary"])
+
+        image = LocationImage.objects.get(pk=second["id"])
+        image.is_primary = True
+        image.save()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.primary_image_id, second["id"])
+
+        response = self.client.get(f"/api/v1/locations/{self.room.id}/")
+        self.assertEqual(response.data["primary_image"]["id"], second["id"])
+        flags = {image["id"]: image["is_primary"] for image in response.data["images"]}
+        self.assertEqual(flags, {first["id"]: False, second["id"]: True})
+
+        LocationImage.objects.get(pk=second["id"]).delete()
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.primary_image_id)
+
+    def test_stale_save_keeps_primary_image(self):
+        """Test that saving a location loaded earlier keeps a newer primary"""
+        stale = Location.objects.get(pk=self.room.pk)
+        image = self.upload(True).data
+        stale.description = "Tiled"
+        stale.save()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.primary_image_id, image["id"])
+        self.assertEqual(self.room.description, "Tiled")
+
+    def test_changed_primary_image_is_saved(self):
+        """Test that a save sets or clears a primary image changed on it"""
+        self.upload(True)
+        second = self.upload(False).data
+        self.room.refresh_from_db()
+        self.room.primary_image_id = second["id"]
+        self.room.save()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.primary_image_id, second["id"])
+
+        self.room.primary_image = None
+        self.room.save()
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.primary_image_id)
+
+        other = LocationImage.objects.create(
+            location=self.house,
+            image=ContentFile(make_image_bytes(), name="other.png"),
+        )
+        self.room.primary_image = other
+        with self.assertRaises(ValueError):
+            self.room.save()
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.primary_image_id)
+
+
+class TreeCacheTestCase(LocationAPITestCase):
+    def test_writes_bump_tree_version_and_refresh_tree(self):
+        """Test that cached tree responses are replaced after a write commits"""
+        response = self.client.get("/api/v1/locations/tree/")
+        self.assertEqual(response.data[0]["children"][0]["name"], "Kitchen")
+
+        version = get_tree_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.name = "Pantry"
+            self.room.save()
+        self.assertGreater(get_tree_version(), version)
+
+        response = self.client.get("/api/v1/locations/tree/")
+        self.assertEqual(response.data[0]["children"][0]["name"], "Pantry")
+
+    def test_statistics_are_served_from_cache(self):
+        """Test that repeated statistics requests skip the aggregate queries"""
+        first = self.client.get("/api/v1/locations/statistics/")
+        with self.assertNumQueries(0):
+            second = self.client.get("/api/v1/locations/statistics/")
+        self.assertEqual(first.data, second.data)
+
+    def test_sqlite_cache_backend(self):
+        """Test the shared SQLite cache backend"""
+        backend = SQLiteCache(os.path.join(self.media_root, "cache.sqlite3"), {})
+        backend.set("answer", {"value": 41})
+        self.assertEqual(backend.get("answer"), {"value": 41})
+        self.assertFalse(backend.add("answer", 0))
+        backend.set("counter", 41, timeout=None)
+        self.assertEqual(backend.incr("counter"), 42)
+        backend.set("expired", 1, timeout=-1)
+        self.assertIsNone(backend.get("expired"))
+        self.assertTrue(backend.add("expired", 2))
+        self.assertEqual(
+            backend.get_many(["counter", "expired", "missing"]),
+            {
+                "counter": 42,
+                "expired": 2,
+            },
+        )
+        with self.assertRaises(ValueError):
+            backend.incr("missing")
+
+
+class ConditionalRequestTestCase(LocationAPITestCase):
+    def test_unchanged_tree_and_statistics_return_304(self):
+        """Test that If-None-Match answers 304 until the tree changes"""
+        for url in ["/api/v1/locations/tree/", "/api/v1/locations/statistics/"]:
+            etag = self.client.get(url)["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                Location.add_root(name=f"Garage {url}", location_type="house")
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response["ETag"], etag)
+
+    def test_detail_if_match(self):
+        """Test optimistic concurrency on location updates"""
+        url = f"/api/v1/locations/{self.room.id}/"
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Unrelated writes don't fail the precondition
+        with self.captureOnCommitCallbacks(execute=True):
+            self.house.add_child(name="Bedroom", location_type="room")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                url, {"name": "Pantry"}, format="json", HTTP_IF_MATCH=etag
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = self.client.patch(
+            url, {"name": "Larder"}, format="json", HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.name, "Pantry")
+
+
+class SingleFlightTestCase(LocationAPITestCase):
+    def test_concurrent_misses_compute_once(self):
+        """Test that concurrent identical cache misses share one computation"""
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"total": 1}
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(get_or_compute("test", compute, 1))
+            )
+            for _ in range(8)
+        ]
+        with override_settings(
+            LOCATIONS_SINGLEFLIGHT_LOCK_DIR=os.path.join(self.media_root, "locks")
+        ):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"total": 1}] * 8)
+
+
+class FastJSONTestCase(LocationAPITestCase):
+    @skipUnless(renderers.orjson, "Without orjson, FastJSONRenderer is JSONRenderer")
+    def test_renderer_matches_json_renderer(self):
+        """Test that FastJSONRenderer output is identical to JSONRenderer"""
+        data = {
+            "value": Decimal("12.50"),
+            "exported_at": timezone.now(),
+            "date": datetime.date(2025, 1, 2),
+            "id": uuid.uuid4(),
+            "name": "جعبه ابزار",
+            "lazy": gettext_lazy("Not found."),
+            "locations": Location.objects.values_list("name", flat=True),
+            "nested": [{"a": 1, "b": None, "c": 1.5, "d": True}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        # Keys orjson rejects, which JSONRenderer converts
+        for data in [{1: "a", 2.5: "b", None: "c"}, {True: "a", False: "b"}]:
+            self.assertEqual(
+                FastJSONRenderer().render(data), JSONRenderer().render(data)
+            )
+
+        response = self.client.get("/api/v1/locations/export/")
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+
+    def test_parser(self):
+        """Test that FastJSONParser accepts JSON bodies and rejects bad ones"""
+        response = self.client.patch(
+            f"/api/v1/locations/{self.room.id}/",
+            '{"name": "آشپزخانه"}',
+            content_type="application/json",
+        )
+        self.assertEqual(response.data["name"], "آشپزخانه")
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"name": NaN}'))
+
+
+class FastSerializerTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.box = self.room.add_child(
+            name="Box", location_type="box", barcode="B-1", value=Decimal("9.5")
+        )
+        self.box.add_child(name="Hammer", location_type="item", is_container=False)
+        Location.add_root(name="Garage", location_type="house", description="x")
+        # Sorted insertion of the root shifted the other paths
+        self.room.refresh_from_db()
+        for is_primary in (False, True):
+            image = LocationImage(location=self.room, description="photo")
+            image.is_primary = is_primary
+            image.image.save("photo.png", ContentFile(make_image_bytes()))
+
+    def assertSameJSON(self, data, expected):
+        self.assertEqual(JSONRenderer().render(data), JSONRenderer().render(expected))
+
+    def test_list_and_search_match_location_serializer(self):
+        """Test that list and search output equals LocationSerializer output"""
+        response = self.client.get("/api/v1/locations/")
+        queryset = Location.objects.order_by("path")
+        context = {"request": response.wsgi_request}
+        self.assertSameJSON(
+            response.data["results"],
+            LocationSerializer(queryset, many=True, context=context).data,
+        )
+        room = next(r for r in response.data["results"] if r["id"] == self.room.id)
+        self.assertEqual(room["primary_image"]["id"], room["images"][1]["id"])
+
+        response = self.client.get("/api/v1/locations/search/", {"query": "box"})
+        # Matched by breadcrumb; the box itself has a barcode, and a missing
+        # has_barcode parameter reads as false
+        expected = Location.objects.filter(name="Hammer")
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertSameJSON(
+            response.data["results"], LocationSerializer(expected, many=True).data
+        )
+
+    def test_tree_and_export_match_serializers(self):
+        """Test that tree and export output equals the serializers' output"""
+        response = self.client.get("/api/v1/locations/tree/")
+        self.assertSameJSON(
+            response.data,
+            LocationTreeSerializer(Location.get_root_nodes(), many=True).data,
+        )
+        response = self.client.get(
+            "/api/v1/locations/tree/", {"parent_id": self.room.id}
+        )
+        self.assertSameJSON(
+            response.data, LocationTreeSerializer([self.room], many=True).data
+        )
+
+        response = self.client.get("/api/v1/locations/export/")
+        queryset = Location.objects.order_by("path")
+        self.assertSameJSON(
+            response.data["data"],
+            LocationExportSerializer(queryset, many=True).data,
+        )
+
+    def test_location_page(self):
+        """Test the compound location page and its query count"""
+        url = f"/api/v1/locations/{self.room.id}/page/"
+        self.client.get(url)  # cache the token
+        response, queries = self.count_queries(url, {"page_size": 1})
+        self.assertEqual(queries, 5)
+
+        detail = self.client.get(f"/api/v1/locations/{self.room.id}/")
+        self.assertSameJSON(response.data["location"], detail.data)
+        breadcrumb = self.client.get(f"/api/v1/locations/{self.room.id}/breadcrumb/")
+        self.assertSameJSON(response.data["breadcrumb"], breadcrumb.data)
+        self.assertEqual(response.data["subtree"]["descendants"], 2)
+        self.assertEqual(response.data["subtree"]["items"], 1)
+
+        children = response.data["children"]
+        self.assertEqual(children["count"], 1)
+        self.assertIsNone(children["next"])
+        self.assertEqual(children["results"][0]["id"], self.box.id)
+        self.assertEqual(children["results"][0]["children_count"], 1)
+
+        self.house.refresh_from_db()
+        self.house.add_child(name="Attic", location_type="room")
+        house = self.client.get(
+            f"/api/v1/locations/{self.house.id}/page/", {"page_size": 1}
+        )
+        self.assertIn(
+            f"parent_id={self.house.id}&page=2", house.data["children"]["next"]
+        )
+
+        response = self.client.get(
+            url, {"page_size": 1}, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get("/api/v1/locations/0/page/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def count_queries(self, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(*args, **kwargs)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_fields_limit_output_and_queries(self):
+        """Test that ?fields= returns only those fields, with fewer queries"""
+        self.client.get("/api/v1/locations/")  # cache the token
+        _, full = self.count_queries("/api/v1/locations/")
+        response, sparse = self.count_queries(
+            "/api/v1/locations/", {"fields": "id,name"}
+        )
+        self.assertLess(sparse, full)
+        for result in response.data["results"]:
+            self.assertEqual(list(result), ["id", "name"])
+
+        response = self.client.get(
+            f"/api/v1/locations/{self.room.id}/", {"fields": "name,breadcrumb"}
+        )
+        self.assertEqual(
+            response.data, {"name": "Kitchen", "breadcrumb": "House > Kitchen"}
+        )
+
+    def test_expand_children(self):
+        """Test that ?expand=children adds the direct children"""
+        params = {"fields": "id", "expand": "children"}
+        response = self.client.get("/api/v1/locations/", params)
+        fields = ["id", "children"]
+        queryset = Location.objects.order_by("path")
+        self.assertSameJSON(
+            response.data["results"],
+            LocationSerializer(queryset, many=True, fields=fields).data,
+        )
+        room = next(r for r in response.data["results"] if r["id"] == self.room.id)
+        self.assertEqual([child["id"] for child in room["children"]], [self.box.id])
+
+        response = self.client.get(f"/api/v1/locations/{self.room.id}/", params)
+        self.assertEqual(response.data, room)
+
+        # Not included by default
+        response = self.client.get(f"/api/v1/locations/{self.room.id}/")
+        self.assertNotIn("children", response.data)
+        self.assertIn("images", response.data)
+
+    def test_unknown_fields_are_rejected(self):
+        """Test that unknown ?fields= and ?expand= names are a 400"""
+        for params in ({"fields": "id,secret"}, {"expand": "name"}):
+            for url in ("/api/v1/locations/", "/api/v1/locations/search/"):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(next(iter(params)), response.data)
+
+
+class CompressionTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(20):
+            self.room.add_child(
+                name=f"Shelf {i:02d}", location_type="shelf", description="x" * 50
+            )
+        self.room.refresh_from_db()
+
+    def test_negotiate(self):
+        """Test Accept-Encoding negotiation against the server's preference"""
+        codings = ["zstd", "br", "gzip"]
+        self.assertEqual(negotiate("gzip, br, zstd", codings), "zstd")
+        self.assertEqual(negotiate("gzip;q=0.5, br", codings), "br")
+        self.assertEqual(negotiate("*;q=0.1, gzip;q=0", ["gzip"]), None)
+        self.assertEqual(negotiate("identity", codings), None)
+        self.assertEqual(negotiate("", codings), None)
+
+    @override_settings(COMPRESSION_LEVELS={"gzip": 6})
+    def test_gzip_response(self):
+        """Test that large JSON responses are compressed, small ones not"""
+        url = "/api/v1/locations/tree/"
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertIn("Accept-Encoding", plain["Vary"])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response["ETag"], "W/" + plain["ETag"])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Weak tags of compressed details still work for If-Match
+        detail = f"/api/v1/locations/{self.room.id}/"
+        with self.settings(COMPRESSION_MIN_SIZE=0):
+            etag = self.client.get(detail, HTTP_ACCEPT_ENCODING="gzip")["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+        response = self.client.patch(
+            detail, {"name": "Pantry"}, format="json", HTTP_IF_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(
+            "/api/v1/locations/statistics/", HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    @override_settings(COMPRESSION_LEVELS={"gzip": 6})
+    def test_ndjson_export_streams(self):
+        """Test that the NDJSON export streams, compressed, one line per location"""
+        expected = self.client.get("/api/v1/locations/export/").data["data"]
+        response = self.client.get(
+            "/api/v1/locations/export/",
+            {"format": "ndjson"},
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        body = gzip.decompress(b"".join(response.streaming_content))
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(lines, json.loads(JSONRenderer().render(expected)))
+
+
+class BulkOperationsTestCase(LocationAPITestCase):
+    def bulk(self, **data):
+        return self.client.post(
+            "/api/v1/locations/bulk-operations/", data, format="json"
+        )
+
+    def test_update_fields(self):
+        """Test that update_fields sets and adds in one update, within the rules"""
+        self.room.refresh_from_db()
+        cup = self.room.add_child(name="Cup", location_type="item", quantity=2)
+        plate = self.room.add_child(name="Plate", location_type="item", quantity=5)
+        ids = [self.room.id, cup.id, plate.id]
+        seq = changes.current_seq()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(9):
+                response = self.bulk(
+                    operation="update_fields",
+                    location_ids=ids,
+                    set={"is_container": False, "cleaned_duration": 7},
+                    add={"quantity": -3},
+                )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["processed"], 1)
+        self.assertEqual(
+            {(f["id"], f["error"]) for f in response.data["failed"]},
+            {
+                (
+                    self.room.id,
+                    "Cannot make a location non-container if it has children",
+                ),
+                (cup.id, "quantity cannot be negative"),
+            },
+        )
+        plate.refresh_from_db()
+        self.assertEqual(
+            (plate.is_container, plate.cleaned_duration, plate.quantity),
+            (False, 7, 2),
+        )
+        self.room.refresh_from_db()
+        self.assertTrue(self.room.is_container)
+        self.assertEqual(
+            list(
+                LocationChange.objects.filter(seq__gt=seq).values_list(
+                    "object_id", "operation"
+                )
+            ),
+            [(plate.id, "update")],
+        )
+
+        response = self.bulk(
+            operation="update_fields",
+            location_ids=ids,
+            set={"location_type": "spaceship", "quantity": 1},
+            add={"quantity": 1},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("location_type", response.data["set"])
+
+        maximum = connection.ops.integer_field_range("PositiveIntegerField")[1]
+        Location.objects.filter(pk=cup.pk).update(quantity=maximum - 1)
+        response = self.bulk(
+            operation="update_fields", location_ids=ids[1:], add={"quantity": 2}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["processed"], 1)
+        self.assertEqual(
+            response.data["failed"][0]["error"],
+            f"quantity cannot be more than {maximum}",
+        )
+        response = self.bulk(
+            operation="update_fields",
+            location_ids=ids,
+            add={"quantity": maximum + 1},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("quantity", response.data["add"])
+
+
+class BulkChildrenTestCase(LocationAPITestCase):
+    def test_bulk_children(self):
+        """Test that bulk children land in sorted order with the subtrees shifted"""
+        self.room.refresh_from_db()
+        for name in ("Bowl", "Drawer", "Fork"):
+            self.room.refresh_from_db()
+            self.room.add_child(name=name, location_type="item")
+        drawer = Location.objects.get(name="Drawer")
+        spoon = drawer.add_child(name="Spoon", location_type="item")
+        names = ["Egg", "Apple", "Cup", "Grater", "Drawer", "Zest", "Bread"]
+
+        publish_many = mock.patch.object(
+            events, "publish_many", wraps=events.publish_many
+        )
+        with self.captureOnCommitCallbacks(execute=True), publish_many as publish:
+            with self.assertNumQueries(12):
+                response = self.client.post(
+                    f"/api/v1/locations/{self.room.id}/children/bulk/",
+                    {
+                        "children": [
+                            {"name": name, "location_type": "item"} for name in names
+                        ]
+                    },
+                    format="json",
+                )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # The events of all the children in one statement on PostgreSQL
+        publish.assert_called_once()
+        self.assertEqual(len(publish.call_args.args[0]), len(names))
+        self.assertEqual(
+            list(
+                Location.objects.filter(id__in=response.data["ids"]).values_list(
+                    "name", flat=True
+                )
+            ),
+            sorted(names),
+        )
+        self.assertEqual(
+            [Location.objects.get(id=id).name for id in response.data["ids"]],
+            names,
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(
+            [child.name for child in self.room.get_children()],
+            sorted(["Bowl", "Drawer", "Fork", *names]),
+        )
+        self.assertEqual(self.room.numchild, 10)
+        spoon.refresh_from_db()
+        self.assertEqual(spoon.get_parent().name, "Drawer")
+        self.assertEqual(Location.find_problems(), ([], [], [], [], []))
+
+        # The same order one add_child() at a time gives
+        self.house.refresh_from_db()
+        other = self.house.add_child(name="Other", location_type="room")
+        for name in ["Bowl", "Drawer", "Fork", *names]:
+            other.refresh_from_db()
+            other.add_child(name=name, location_type="item")
+        self.assertEqual(
+            [child.path[-4:] for child in other.get_children()],
+            [child.path[-4:] for child in self.room.get_children()],
+        )
+
+        response = self.client.post(
+            f"/api/v1/locations/{spoon.id}/children/bulk/",
+            {"children": []},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(LOCATIONS_TREE_MODE="append")
+class AppendTreeModeTestCase(LocationAPITestCase):
+    def test_append_mode(self):
+        """Test that children are appended and displayed in sort_name order"""
+        for name in ("Fork", "bowl", "Drawer"):
+            self.room.refresh_from_db()
+            self.room.add_child(name=name, location_type="item")
+        fork = Location.objects.get(name="Fork")
+        self.room.refresh_from_db()
+        self.room.add_child(name="Apple", location_type="item")
+        response = self.client.post(
+            f"/api/v1/locations/{self.room.id}/children/bulk/",
+            {"children": [{"name": "Egg", "location_type": "item"}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Location.objects.get(pk=fork.pk).path, fork.path)
+        self.assertEqual(
+            [child.name for child in self.room.get_children()],
+            ["Fork", "bowl", "Drawer", "Apple", "Egg"],
+        )
+
+        display = ["Apple", "bowl", "Drawer", "Egg", "Fork"]
+        response = self.client.get("/api/v1/locations/", {"parent_id": self.room.id})
+        self.assertEqual([row["name"] for row in response.data["results"]], display)
+        response = self.client.get(
+            "/api/v1/locations/tree/", {"parent_id": self.room.id}
+        )
+        self.assertEqual(
+            [child["name"] for child in response.data[0]["children"]], display
+        )
+
+        # Sorted moves append too, and renames only change the sort key
+        cellar = self.house.add_child(name="Cellar", location_type="room")
+        cellar.add_child(name="Zest", location_type="item")
+        fork.refresh_from_db()
+        fork.move(cellar, pos="sorted-child")
+        fork.name = "Apron"
+        fork.save()
+        cellar.refresh_from_db()
+        self.assertEqual(
+            [child.name for child in cellar.get_children()], ["Zest", "Apron"]
+        )
+        self.assertEqual(
+            list(
+                cellar.get_children()
+                .order_by(*Location.sibling_order())
+                .values_list("name", flat=True)
+            ),
+            ["Apron", "Zest"],
+        )
+        self.assertEqual(Location.find_problems(), ([], [], [], [], []))
+
+        with self.assertRaises(CommandError):
+            call_command("reorder_tree", stdout=io.StringIO())
+        with override_settings(LOCATIONS_TREE_MODE="sorted"):
+            call_command("reorder_tree", stdout=io.StringIO())
+            self.assertEqual(Location.sibling_order(), ["path"])
+        self.room.refresh_from_db()
+        self.assertEqual(
+            [child.name for child in self.room.get_children()],
+            ["Apple", "Drawer", "Egg", "bowl"],
+        )
+        self.assertEqual(Location.find_problems(), ([], [], [], [], []))
+
+
+class BatchTestCase(LocationAPITestCase):
+    url = "/api/v1/batch/"
+
+    def test_operations_with_references(self):
+        """Test a batch that creates, moves and cleans using earlier results"""
+        operations = [
+            {
+                "id": "box",
+                "method": "POST",
+                "path": "/api/v1/locations/",
+                "body": {
+                    "name": "Box",
+                    "location_type": "box",
+                    "parent_id": self.room.id,
+                },
+            },
+            {
+                "id": "hammer",
+                "method": "POST",
+                "path": "/api/v1/locations/",
+                "body": {
+                    "name": "Hammer",
+                    "location_type": "item",
+                    "is_container": False,
+                    "parent_id": "$box.id",
+                },
+            },
+            {
+                "method": "POST",
+                "path": "/api/v1/locations/$box.id/images/",
+                "body": {"description": "Front"},
+                "files": {
+                    "image": {
+                        "name": "box.png",
+                        "content": base64.b64encode(make_image_bytes()).decode(),
+                        "content_type": "image/png",
+                    }
+                },
+            },
+            {
+                "method": "POST",
+                "path": "/api/v1/locations/$hammer.id/move/",
+                "body": {"new_parent_id": self.house.id},
+            },
+            {"method": "POST", "path": "/api/v1/locations/$hammer.id/mark-cleaned/"},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, {"operations": operations}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertTrue(response.data["success"])
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [201, 201, 201, 200, 200],
+        )
+        box = Location.objects.get(name="Box")
+        hammer = Location.objects.get(name="Hammer")
+        self.assertEqual(box.get_parent(), self.room)
+        self.assertEqual(hammer.get_parent(), self.house)
+        self.assertIsNotNone(hammer.cleaned_time)
+        self.assertEqual(box.images.get().description, "Front")
+
+    def test_failure_rolls_back(self):
+        """Test that a failing operation undoes the operations before it"""
+        operations = [
+            {
+                "method": "POST",
+                "path": "/api/v1/locations/",
+                "body": {"name": "Box", "location_type": "box"},
+            },
+            {"method": "DELETE", "path": f"/api/v1/locations/{self.house.id}/"},
+            {"method": "GET", "path": "/api/v1/locations/tree/"},
+        ]
+        response = self.client.post(self.url, {"operations": operations}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(response.data["success"])
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]], [201, 400]
+        )
+        self.assertFalse(Location.objects.filter(name="Box").exists())
+
+        for operation in [
+            {"method": "GET", "path": "/api/v1/auth/profile/"},
+            {"method": "GET", "path": "/api/v1/locations/$nothing.id/"},
+        ]:
+            response = self.client.post(
+                self.url, {"operations": [operation]}, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("error", response.data["results"][0]["body"])
+
+    def test_idempotency_key(self):
+        """Test that a retried batch is answered from the stored response"""
+        data = {
+            "operations": [
+                {
+                    "method": "POST",
+                    "path": "/api/v1/locations/",
+                    "body": {"name": "Box", "location_type": "box"},
+                }
+            ]
+        }
+        first = self.client.post(
+            self.url, data, format="json", HTTP_IDEMPOTENCY_KEY="retry-1"
+        )
+        retry = self.client.post(
+            self.url, data, format="json", HTTP_IDEMPOTENCY_KEY="retry-1"
+        )
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data, json.loads(first.content))
+        self.assertEqual(Location.objects.filter(name="Box").count(), 1)
+
+        data["operations"][0]["body"]["name"] = "Crate"
+        response = self.client.post(
+            self.url, data, format="json", HTTP_IDEMPOTENCY_KEY="retry-1"
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertFalse(Location.objects.filter(name="Crate").exists())
+
+    def test_subrequests(self):
+        """Test that query strings and multipart fields reach the views"""
+        image = {
+            "image": {
+                "name": 'front "1".png',
+                "content": base64.b64encode(make_image_bytes()).decode(),
+                "content_type": "image/png",
+            }
+        }
+        operations = [
+            {"method": "GET", "path": "/api/v1/locations/?parent_id=root"},
+            {
+                "method": "POST",
+                "path": f"/api/v1/locations/{self.room.id}/images/",
+                "body": {"description": "نمای جلو"},
+                "files": image,
+            },
+        ]
+        response = self.client.post(self.url, {"operations": operations}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        results = response.data["results"]
+        self.assertEqual(
+            [location["id"] for location in results[0]["body"]["results"]],
+            [self.house.id],
+        )
+        self.assertEqual(self.room.images.get().description, "نمای جلو")
+
+        operations[1]["body"] = {"description": None}
+        response = self.client.post(
+            self.url, {"operations": operations[1:]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("description", response.data["results"][0]["body"]["error"])
+
+    def test_async_views(self):
+        """Test that batches run the DRF views with the async reads on"""
+        self.addCleanup(self.reload_urls)
+        self.enterContext(override_settings(LOCATIONS_ASYNC_VIEWS=True))
+        self.reload_urls()
+        operations = [
+            {
+                "method": "PATCH",
+                "path": f"/api/v1/locations/{self.room.id}/",
+                "body": {"description": "Tiled"},
+            },
+            {"method": "GET", "path": f"/api/v1/locations/{self.room.id}/"},
+        ]
+        response = self.client.post(self.url, {"operations": operations}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(response.data["results"][1]["body"]["description"], "Tiled")
+
+    def reload_urls(self):
+        # The root URLconf keeps the included patterns once they're resolved
+        importlib.reload(locations_urls)
+        importlib.reload(root_urls)
+        clear_url_caches()
+
+
+class ChangeLogTestCase(LocationAPITestCase):
+    def get_changes(self, since):
+        response = self.client.get("/api/v1/locations/changes/", {"since": since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        body = b"".join(response.streaming_content)
+        return int(response["Change-Seq"]), [
+            json.loads(line) for line in body.splitlines()
+        ]
+
+    def test_changes_since(self):
+        """Test that the feed returns the latest change of each changed object"""
+        since, lines = self.get_changes(0)
+        self.assertEqual(
+            [(line["op"], line["id"]) for line in lines],
+            [("create", self.house.id), ("create", self.room.id)],
+        )
+        self.assertEqual(lines[1]["data"]["parent_id"], self.house.id)
+
+        box = self.room.add_child(name="Box", location_type="box")
+        self.room.description = "Updated"
+        self.room.save()
+        self.room.mark_as_cleaned()
+        box.refresh_from_db()
+        box.move(self.house, "sorted-child")
+        image = LocationImage(location=self.house)
+        image.is_primary = True
+        image.image.save("photo.png", ContentFile(make_image_bytes()))
+        self.house.refresh_from_db()
+        _, lines = self.get_changes(since)
+        changed = {(line["type"], line["id"]): line for line in lines}
+        self.assertEqual(len(lines), len(changed))
+        self.assertEqual(
+            set(changed),
+            {
+                ("location", self.room.id),
+                ("location", box.id),
+                ("location", self.house.id),
+                ("image", image.id),
+            },
+        )
+        self.assertEqual(changed["location", box.id]["op"], "move")
+        self.assertEqual(
+            changed["location", box.id]["data"]["parent_id"], self.house.id
+        )
+        self.assertEqual(
+            changed["location", self.room.id]["data"]["description"], "Updated"
+        )
+        self.assertEqual(
+            changed["location", self.house.id]["data"]["primary_image_id"], image.id
+        )
+        self.assertTrue(changed["image", image.id]["data"]["image"].startswith("http"))
+
+        latest, _ = self.get_changes(0)
+        box.delete()
+        _, lines = self.get_changes(latest)
+        # Deletes carry no data
+        self.assertIn(
+            {"seq": lines[-1]["seq"], "type": "location", "op": "delete", "id": box.id},
+            lines,
+        )
+
+        response = self.client.get("/api/v1/locations/changes/", {"since": -1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rows_locked_before_change_log(self):
+        """Test that writes update their rows before writing the change log"""
+        box = self.room.add_child(name="Box", location_type="box")
+        table = connection.ops.quote_name(Location._meta.db_table)
+        log = connection.ops.quote_name(LocationChange._meta.db_table)
+
+        def rows_first(queries):
+            sql = [query["sql"] for query in queries]
+            updates = [
+                i for i, query in enumerate(sql) if query.startswith(f"UPDATE {table}")
+            ]
+            inserts = [
+                i
+                for i, query in enumerate(sql)
+                if query.startswith(f"INSERT INTO {log}")
+            ]
+            return max(updates) < min(inserts)
+
+        image = LocationImage(location=box)
+        with CaptureQueriesContext(connection) as queries:
+            image.image.save("box.png", ContentFile(make_image_bytes()))
+        self.assertTrue(rows_first(queries.captured_queries))
+
+        self.room.refresh_from_db()
+        self.room.name = "Pantry"
+        with CaptureQueriesContext(connection) as queries:
+            self.room.save()
+        self.assertTrue(rows_first(queries.captured_queries))
+
+        operations = [
+            {
+                "method": "PATCH",
+                "path": f"/api/v1/locations/{location.id}/",
+                "body": {"description": "Dusty"},
+            }
+            for location in (self.house, box)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/v1/batch/", {"operations": operations}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertTrue(rows_first(queries.captured_queries))
+
+    def test_compaction(self):
+        """Test that compaction drops superseded entries only"""
+        for name in ("Pantry", "Larder", "Scullery"):
+            self.room.name = name
+            self.room.save()
+        box = self.room.add_child(name="Box", location_type="box")
+        box.delete()
+        _, before = self.get_changes(0)
+        export = self.get_export(0)
+        out = io.StringIO()
+        call_command("compact_changes", stdout=out)
+        # The room's renames, superseded by adding the box, and the create
+        # of the deleted box
+        self.assertIn("Deleted 4 superseded", out.getvalue())
+        self.assertEqual(LocationChange.objects.count(), 4)
+        _, after = self.get_changes(0)
+        self.assertEqual(after, before)
+        self.assertEqual(self.get_export(0), export)
+        self.assertEqual(export[self.room.id]["op"], "create")
+
+    def get_export(self, since):
+        response = self.client.get(
+            "/api/v1/locations/export/", {"since": since, "format": "ndjson"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = b"".join(response.streaming_content)
+        return {line["id"]: line for line in map(json.loads, body.splitlines())}
+
+    def test_export_since(self):
+        """Test that the export since a seq or time has inserts, updates and deletes"""
+        seq = int(self.client.get("/api/v1/locations/export/")["Change-Seq"])
+        start = timezone.now()
+        box = self.room.add_child(name="Box", location_type="box", is_container=True)
+        item = box.add_child(name="Item", location_type="item")
+        shelf = self.house.add_child(name="Shelf", location_type="shelf")
+        shelf.delete()
+        self.room.refresh_from_db()
+        self.room.name = "Pantry"
+        self.room.save()
+
+        for since in (seq, start.isoformat()):
+            lines = self.get_export(since)
+            self.assertEqual(
+                {id: line["op"] for id, line in lines.items()},
+                {
+                    # Its numchild
+                    self.house.id: "update",
+                    self.room.id: "update",
+                    box.id: "create",
+                    item.id: "create",
+                    shelf.id: "delete",
+                },
+            )
+            self.assertEqual(lines[shelf.id], {"op": "delete", "id": shelf.id})
+            # The rename reaches the descendants' breadcrumbs
+            self.assertEqual(
+                lines[item.id]["breadcrumb_path"], "House > Pantry > Box > Item"
+            )
+
+        # A move touches the moved subtree
+        later = timezone.now()
+        box.refresh_from_db()
+        box.move(self.house, "sorted-child")
+        lines = self.get_export(later.isoformat())
+        self.assertEqual(set(lines), {box.id, item.id})
+        self.assertEqual(lines[item.id]["parent_name"], "Box")
+        self.assertEqual(lines[item.id]["breadcrumb_path"], "House > Box > Item")
+
+        response = self.client.get("/api/v1/locations/export/", {"since": seq})
+        self.assertEqual(response.json()["count"], 5)
+
+        response = self.client.get("/api/v1/locations/export/", {"since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LiveEventsTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        token = Token.objects.get(user=self.user)
+        self.headers = {"Authorization": "Token " + token.key}
+
+    def test_change_events(self):
+        """Test that changes are published on commit, with the new parent"""
+        with mock.patch.object(events.broadcaster, "deliver") as deliver:
+            with self.captureOnCommitCallbacks(execute=True):
+                box = self.room.add_child(name="Box", location_type="box")
+            self.assertEqual(deliver.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                box.move(self.house, "sorted-child")
+        self.assertEqual(
+            [call.args[0] for call in deliver.call_args_list],
+            [
+                {
+                    "seq": 3,
+                    "type": "location",
+                    "op": "create",
+                    "id": box.id,
+                    "parent": self.room.id,
+                },
+                {
+                    "seq": 4,
+                    "type": "location",
+                    "op": "move",
+                    "id": box.id,
+                    "parent": self.house.id,
+                },
+            ],
+        )
+
+        # Replay after a reconnect
+        box.delete()
+        self.assertEqual(
+            changes.change_events(1, 10),
+            [
+                {
+                    "seq": 2,
+                    "type": "location",
+                    "op": "create",
+                    "id": self.room.id,
+                    "parent": self.house.id,
+                },
+                # The parent's numchild
+                {"seq": 5, "type": "location", "op": "update", "id": self.house.id},
+                {"seq": 6, "type": "location", "op": "delete", "id": box.id},
+            ],
+        )
+        self.assertIsNone(changes.change_events(0, 2))
+
+    @override_settings(EVENTS_HEARTBEAT_INTERVAL=0.05)
+    async def test_event_stream(self):
+        """Test that the stream replays missed changes, then live ones"""
+        response = await self.async_client.get(
+            "/api/v1/locations/events/", headers={**self.headers, "Last-Event-ID": "1"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(
+            await anext(chunks),
+            f'id: 2\nevent: change\ndata: {{"seq":2,"type":"location","op":"create",'
+            f'"id":{self.room.id},"parent":{self.house.id}}}\n\n'.encode(),
+        )
+
+        events.broadcaster.deliver(
+            {"seq": 1, "type": "location", "op": "update", "id": self.house.id}
+        )
+        events.broadcaster.deliver(
+            {"seq": 3, "type": "location", "op": "update", "id": self.room.id}
+        )
+        events.broadcaster.deliver(events.RESYNC)
+        # The replayed change is not sent again
+        self.assertTrue((await anext(chunks)).startswith(b"id: 3\n"))
+        self.assertEqual(await anext(chunks), b"event: resync\ndata: {}\n\n")
+        self.assertEqual(await anext(chunks), b": keep-alive\n\n")
+        await chunks.aclose()
+
+    async def test_event_stream_errors(self):
+        """Test authentication and validation of event streams"""
+        response = await self.async_client.get("/api/v1/locations/events/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response["WWW-Authenticate"], "Token")
+
+        response = await self.async_client.get(
+            "/api/v1/locations/events/", {"since": "x"}, headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_event_stream_needs_asgi(self):
+        response = self.client.get("/api/v1/locations/events/")
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+
+class AsyncViewsTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        token = Token.objects.get(user=self.user)
+        self.headers = {"Authorization": "Token " + token.key}
+        self.factory = AsyncRequestFactory()
+        self.room.refresh_from_db()
+        self.room.add_child(name="Shelf", location_type="shelf", barcode="S1")
+        self.house.refresh_from_db()
+        self.house.cleaned_time = timezone.now()
+        self.house.save()
+        LocationImage.objects.create(
+            location=self.house,
+            image=ContentFile(make_image_bytes(), name="photo.png"),
+        )
+
+    def get_async(self, view, path, params=None, headers=None, **kwargs):
+        if headers is None:
+            headers = self.headers
+        request = self.factory.get(path, params, headers=headers)
+        return async_to_sync(view)(request, **kwargs)
+
+    def test_same_responses(self):
+        """Test that the async views respond like the DRF views"""
+        list_path = "/api/v1/locations/"
+        detail_path = f"/api/v1/locations/{self.house.id}/"
+        cases = [
+            (async_views.location_list, list_path, {}, {}),
+            (async_views.location_list, list_path, {"parent_id": self.house.id}, {}),
+            (async_views.location_list, list_path, {"parent_id": "root"}, {}),
+            (async_views.location_list, list_path, {"page_size": 1, "page": 2}, {}),
+            (async_views.location_list, list_path, {"page": 9}, {}),
+            (
+                async_views.location_list,
+                list_path,
+                {"fields": "id,name", "expand": "children"},
+                {},
+            ),
+            (async_views.location_detail, detail_path, {}, {"pk": self.house.id}),
+            (
+                async_views.location_detail,
+                detail_path,
+                {"fields": "id,images"},
+                {"pk": self.house.id},
+            ),
+            (async_views.location_detail, "/api/v1/locations/999/", {}, {"pk": 999}),
+            (async_views.location_search, "/api/v1/locations/search/", {}, {}),
+            (
+                async_views.location_search,
+                "/api/v1/locations/search/",
+                {"query": "house"},
+                {},
+            ),
+            (
+                async_views.location_search,
+                "/api/v1/locations/search/",
+                {"needs_cleaning": "true", "has_barcode": "false"},
+                {},
+            ),
+            (
+                async_views.location_search,
+                "/api/v1/locations/search/",
+                {"parent_id": self.house.id, "location_type": "shelf"},
+                {},
+            ),
+            (async_views.location_tree, "/api/v1/locations/tree/", {}, {}),
+            (async_views.location_statistics, "/api/v1/locations/statistics/", {}, {}),
+        ]
+        for view, path, params, kwargs in cases:
+            with self.subTest(path=path, params=params):
+                expected = self.client.get(path, params)
+                response = self.get_async(view, path, params, **kwargs)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(json.loads(response.content), expected.json())
+                self.assertEqual(response.get("ETag"), expected.get("ETag"))
+
+        response = self.get_async(async_views.location_tree, path, headers={})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cache_off_event_loop(self):
+        """Test that the async views don't read the cache on the event loop"""
+        get = cache.get
+
+        def get_off_loop(*args, **kwargs):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return get(*args, **kwargs)
+
+        with mock.patch.object(cache, "get", get_off_loop):
+            for view, path, kwargs in [
+                (
+                    async_views.location_detail,
+                    f"/api/v1/locations/{self.house.id}/",
+                    {"pk": self.house.id},
+                ),
+                (async_views.location_tree, "/api/v1/locations/tree/", {}),
+                (async_views.location_statistics, "/api/v1/locations/statistics/", {}),
+            ]:
+                with self.subTest(path=path):
+                    response = self.get_async(view, path, **kwargs)
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    async def test_streamed_export(self):
+        """Test that NDJSON is streamed asynchronously under ASGI"""
+        response = await self.async_client.get(
+            "/api/v1/locations/export/", {"format": "ndjson"}, headers=self.headers
+        )
+        self.assertTrue(response.is_async)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(
+            [json.loads(line)["name"] for line in body.splitlines()],
+            ["House", "Kitchen", "Shelf"],
+        )
+
+    def test_other_methods(self):
+        """Test that writes are handed to the DRF views"""
+        view = async_views.with_async_reads(
+            async_views.location_list, views.LocationListCreateView.as_view()
+        )
+        request = self.factory.post(
+            "/api/v1/locations/",
+            {"name": "Garage", "location_type": "room"},
+            content_type="application/json",
+            headers=self.headers,
+        )
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Location.objects.filter(name="Garage").exists())
+
+
+class SnapshotTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.snapshot_dir = os.path.join(self.media_root, "snapshots")
+        self.enterContext(override_settings(LOCATIONS_SNAPSHOT_DIR=self.snapshot_dir))
+        self.room.refresh_from_db()
+        # Spelled with an Arabic kaf and a zero-width non-joiner
+        self.shelf = self.room.add_child(
+            name="كتاب\u200cخانه", location_type="shelf", barcode="B-12"
+        )
+        LocationImage.objects.create(
+            location=self.shelf,
+            image=ContentFile(make_image_bytes(), name="shelf.png"),
+        )
+
+    def download(self, **headers):
+        response = self.client.get("/api/v1/locations/snapshot.sqlite", headers=headers)
+        if response.status_code != status.HTTP_200_OK:
+            return response, None
+        fd, path = tempfile.mkstemp(suffix=".sqlite", dir=self.media_root)
+        with open(fd, "wb") as fh:
+            fh.write(b"".join(response.streaming_content))
+        return response, sqlite3.connect(path)
+
+    def test_snapshot_download(self):
+        """Test that the snapshot is a queryable database with a search index"""
+        response, db = self.download()
+        self.addCleanup(db.close)
+        self.assertEqual(response["Content-Type"], snapshot.CONTENT_TYPE)
+        self.assertEqual(response["Change-Seq"], str(changes.current_seq()))
+        self.assertEqual(
+            db.execute(
+                "SELECT id, parent_id, breadcrumb FROM locations ORDER BY path"
+            ).fetchall(),
+            [
+                (self.house.id, None, "House"),
+                (self.room.id, self.house.id, "House > Kitchen"),
+                (self.shelf.id, self.room.id, "House > Kitchen > كتاب\u200cخانه"),
+            ],
+        )
+        [(location_id, url)] = db.execute("SELECT location_id, image FROM images")
+        self.assertEqual(location_id, self.shelf.id)
+        self.assertTrue(url.startswith("/media/location_images/"))
+
+        query = text.normalize("کتاب")
+        matches = db.execute(
+            "SELECT rowid FROM locations_fts WHERE locations_fts MATCH ?",
+            [f'"{query}"'],
+        ).fetchall()
+        self.assertEqual(matches, [(self.shelf.id,)])
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+        self.assertEqual(meta["tree_version"], str(get_tree_version()))
+
+        # Validated without reading the file, and shared by downloads
+        response, _ = self.download(if_none_match=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with mock.patch.object(snapshot, "write_snapshot") as write:
+            self.download()
+        write.assert_not_called()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.refresh_from_db()
+            self.room.add_child(name="Drawer", location_type="drawer")
+        _, db = self.download()
+        self.addCleanup(db.close)
+        self.assertEqual(db.execute("SELECT count(*) FROM locations").fetchone(), (4,))
+        self.assertEqual(
+            os.listdir(self.snapshot_dir), [f"snapshot-{get_tree_version()}.sqlite"]
+        )
+
+    def test_export_snapshot_command(self):
+        path = os.path.join(self.media_root, "inventory.sqlite")
+        out = io.StringIO()
+        call_command("export_snapshot", path, stdout=out)
+        self.assertIn("Wrote", out.getvalue())
+        db = sqlite3.connect(path)
+        self.addCleanup(db.close)
+        self.assertEqual(db.execute("SELECT count(*) FROM locations").fetchone(), (3,))
+        with self.assertRaises(CommandError):
+            call_command("export_snapshot", path)
+
+
+class BackupTestCase(LocationAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.backup_dir = os.path.join(self.media_root, "backups")
+        self.room.refresh_from_db()
+        self.shelf = self.room.add_child(
+            name="Shelf", location_type="shelf", value=Decimal("12.50")
+        )
+        self.image = LocationImage(location=self.shelf, is_primary=True)
+        self.image.image.save("shelf.png", ContentFile(make_image_bytes()))
+
+    def digests(self):
+        return {
+            name: backup.table_digest(model) for name, model in backup.MODELS.items()
+        }
+
+    def test_backup_and_restore(self):
+        """Test that a restore brings back the rows and files of a backup"""
+        out = io.StringIO()
+        call_command("backup_inventory", output=self.backup_dir, stdout=out)
+        self.assertIn("Backup at change seq", out.getvalue())
+        expected = self.digests()
+        image_path = self.image.image.path
+
+        self.shelf.delete()
+        os.remove(image_path)
+        self.house.refresh_from_db()
+        self.house.name = "Flat"
+        self.house.save()
+        User.objects.create_user(username="other", password="pass")
+
+        path = backup.latest_backup(self.backup_dir)
+        with self.assertRaises(CommandError):
+            call_command("restore_inventory", path, stdout=io.StringIO())
+        seq = changes.current_seq()
+        call_command("restore_inventory", path, replace=True, stdout=io.StringIO())
+
+        self.assertEqual(self.digests(), expected)
+        self.assertTrue(os.path.exists(image_path))
+        self.assertFalse(User.objects.filter(username="other").exists())
+        # Delta sync clients are told about the restored rows
+        self.assertEqual(
+            set(
+                changes.latest_changes(seq).values_list(
+                    "kind", "object_id", "operation"
+                )
+            ),
+            {
+                ("location", self.house.id, "create"),
+                ("location", self.room.id, "create"),
+                ("location", self.shelf.id, "create"),
+                ("image", self.image.id, "create"),
+            },
+        )
+        # New rows don't collide with the restored ids
+        self.room.refresh_from_db()
+        drawer = self.room.add_child(name="Drawer", location_type="drawer")
+        self.assertGreater(drawer.id, self.shelf.id)
+
+    def test_incremental_backup(self):
+        """Test that a restore applies the incremental backups on top"""
+        call_command("backup_inventory", output=self.backup_dir, stdout=io.StringIO())
+
+        self.house.refresh_from_db()
+        garage = self.house.add_child(name="Garage", location_type="room")
+        self.room.refresh_from_db()
+        self.room.move(garage, "sorted-child")
+        self.image.delete()
+        call_command(
+            "backup_inventory",
+            output=self.backup_dir,
+            incremental=True,
+            media="tar",
+            stdout=io.StringIO(),
+        )
+        self.shelf.refresh_from_db()
+        self.shelf.description = "Top shelf"
+        self.shelf.save()
+        LocationImage.objects.create(
+            location=self.shelf,
+            image=ContentFile(make_image_bytes("blue"), name="top.png"),
+        )
+        out = io.StringIO()
+        call_command(
+            "backup_inventory",
+            output=self.backup_dir,
+            incremental=True,
+            stdout=out,
+        )
+        self.assertIn("Incremental backup", out.getvalue())
+        path = backup.latest_backup(self.backup_dir)
+        manifest = backup.read_manifest(path)
+        self.assertEqual(manifest["files"]["locations"]["rows"], 1)
+        self.assertEqual(manifest["files"]["tree"]["rows"], 4)
+        expected = self.digests()
+
+        self.shelf.refresh_from_db()
+        self.shelf.delete()
+        garage.refresh_from_db()
+        garage.add_child(name="Bike", location_type="item")
+        call_command("restore_inventory", path, replace=True, stdout=io.StringIO())
+        self.assertEqual(self.digests(), expected)
+
+    def test_corrupt_backup(self):
+        call_command("backup_inventory", output=self.backup_dir, stdout=io.StringIO())
+        path = backup.latest_backup(self.backup_dir)
+        with gzip.open(os.path.join(path, "locations.ndjson.gz"), "ab") as fh:
+            fh.write(b"[]\n")
+        expected = self.digests()
+        with self.assertRaises(CommandError):
+            call_command("restore_inventory", path, replace=True, stdout=io.StringIO())
+        self.assertEqual(self.digests(), expected)
+
+    def test_archive(self):
+        """Test that an exported archive imports back with its image files"""
+        response = self.client.get("/api/v1/locations/export/", {"format": "zip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        data = b"".join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(data)) as contents:
+            self.assertEqual(
+                contents.namelist(),
+                [
+                    "locations.ndjson",
+                    "images.ndjson",
+                    f"media/{self.image.image.name}",
+                    "manifest.json",
+                ],
+            )
+        path = os.path.join(self.media_root, "inventory.zip")
+        with open(path, "wb") as fh:
+            fh.write(data)
+        expected = {
+            name: backup.table_digest(model) for name, model in archive.TABLES.items()
+        }
+        image_path = self.image.image.path
+
+        self.shelf.delete()
+        os.remove(image_path)
+        with self.assertRaises(CommandError):
+            call_command("import_archive", path, stdout=io.StringIO())
+        out = io.StringIO()
+        call_command("import_archive", path, replace=True, stdout=out)
+        self.assertIn("Imported the archive", out.getvalue())
+        self.assertEqual(
+            {
+                name: backup.table_digest(model)
+                for name, model in archive.TABLES.items()
+            },
+            expected,
+        )
+        self.assertTrue(os.path.exists(image_path))
+
+    def test_archive_without_primary_image(self):
+        """Test that a primary image deleted during an export is left out"""
+        write_table = archive.write_table
+
+        def delete_after_locations(archive, output, name, *args):
+            stats = yield from write_table(archive, output, name, *args)
+            if name == "locations":
+                self.image.delete()
+            return stats
+
+        with mock.patch.object(archive, "write_table", delete_after_locations):
+            response = self.client.get("/api/v1/locations/export/", {"format": "zip"})
+            data = b"".join(response.streaming_content)
+        path = os.path.join(self.media_root, "inventory.zip")
+        with open(path, "wb") as fh:
+            fh.write(data)
+
+        call_command("import_archive", path, replace=True, stdout=io.StringIO())
+        self.shelf.refresh_from_db()
+        self.assertIsNone(self.shelf.primary_image_id)
+        self.assertFalse(LocationImage.objects.exists())
+
+    def test_archive_errors_are_json(self):
+        """Test that responses other than archives aren't labelled as ZIP"""
+        response = self.client.get(
+            "/api/v1/locations/export/", {"format": "zip", "since": 0}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.client.credentials()
+        response = self.client.get("/api/v1/locations/export/", {"format": "zip"})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response["Content-Type"], "application/json")
+
+
+class RekeyTestCase(LocationAPITestCase):
+    def test_alphabet_in_database_order(self):
+        """Test that alphabets are checked in the collation of the paths"""
+        digits = "0123456789"
+        alphabet = digits + "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+        rekey.check_keying(4, alphabet)
+        with self.assertRaises(rekey.RekeyError):
+            rekey.check_keying(4, "10")
+        # Sorted without regard to case, as under most PostgreSQL collations
+        path = Location._meta.get_field("path")
+        with mock.patch.object(path, "db_collation", "NOCASE"):
+            rekey.check_keying(4, digits + "abcdefghijklmnopqrstuvwxyz")
+            with self.assertRaises(rekey.RekeyError):
+                rekey.check_keying(4, alphabet)
+
+    def test_rekey(self):
+        """Test that paths are re-keyed with the tree changing in between"""
+        for name in ("Bowl", "Drawer", "Fork"):
+            self.room.refresh_from_db()
+            self.room.add_child(name=name, location_type="item")
+        out = io.StringIO()
+        call_command("tree_capacity", stdout=out)
+        self.assertIn("steplen 4 with 36 digits: 3 of 63 levels", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command(
+                "tree_capacity", steplen=1, alphabet="012", prepare=True, stdout=out
+            )
+        self.assertEqual(rekey.prepare(5, "0123456789"), 5)
+
+        # Moved, added and deleted since the paths were staged
+        drawer = Location.objects.get(name="Drawer")
+        self.house.refresh_from_db()
+        drawer.move(self.house, pos="sorted-child")
+        drawer.add_child(name="Spoon", location_type="item")
+        Location.objects.get(name="Bowl").delete()
+        order = list(Location.objects.values_list("name", flat=True))
+
+        out = io.StringIO()
+        call_command(
+            "tree_capacity", steplen=5, alphabet="0123456789", switch=True, stdout=out
+        )
+        self.assertIn("Re-keyed 5 locations", out.getvalue())
+        self.assertFalse(LocationPathRekey.objects.exists())
+        self.assertEqual(
+            Location.objects.get(name="Spoon").path, "00001" "00001" "00001"
+        )
+        with mock.patch.multiple(Location, steplen=5, alphabet="0123456789"):
+            self.assertEqual(
+                list(Location.objects.values_list("name", flat=True)), order
+            )
+            self.assertEqual(Location.find_problems(), ([], [], [], [], []))
+            self.room.refresh_from_db()
+            self.assertEqual(
+                [child.name for child in self.room.get_children()], ["Fork"]
+            )
+            # Backups from before are keyed the old way
+            with self.assertRaises(backup.BackupError):
+                backup.check_keying({}, "backup")
@@ -0,0 +1,22 @@
+"""
+Normalized text: the form names and search text are compared in, by the
+offline snapshots' search index and by the sort_name of locations.
+"""
+
+import unicodedata
+
+# Arabic letters and digits typed on Arabic keyboards as their Persian and
+# ASCII counterparts, and zero-width non-joiners as spaces, so every
+# spelling of a name matches
+SEARCH_CHARACTERS = str.maketrans(
+    "يكۀة" "٠١٢٣٤٥٦٧٨٩" "۰۱۲۳۴۵۶۷۸۹" "\u200c",
+    "یکهه" "0123456789" "0123456789" " ",
+)
+
+
+def normalize(text):
+    """
+    The search form of ``text``: NFKC, case-folded, with the characters of
+    SEARCH_CHARACTERS unified. Clients normalize their queries the same way.
+    """
+    return unicodedata.normalize("NFKC", text).casefold().translate(SEARCH_CHARACTERS)
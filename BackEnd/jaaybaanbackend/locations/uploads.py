@@ -0,0 +1,159 @@
+"""
+Chunked, resumable image uploads.
+
+Chunks are streamed straight from the request body into a partial file on
+disk, so neither DRF's multipart parser nor Django's in-memory upload handler
+ever holds the image. Once every byte has arrived, the partial file is handed
+to the storage backend, which moves it into place instead of copying it.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from PIL import Image
+
+from .models import ImageUpload, LocationImage
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """Raised when a chunk or a finalize request cannot be accepted"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AssembledUpload(File):
+    """
+    A finished partial file. Exposing ``temporary_file_path`` lets
+    FileSystemStorage move the file into MEDIA_ROOT rather than copy it.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def start_upload(location, filename, size, description=None, is_primary=False):
+    """Create an upload session and its (empty) partial file"""
+    if size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError(
+            f"File is too large, maximum size is {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes",
+            status_code=413,
+        )
+
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    upload = ImageUpload.objects.create(
+        location=location,
+        filename=os.path.basename(filename),
+        size=size,
+        description=description,
+        is_primary=is_primary,
+    )
+    open(upload.temp_path, "wb").close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Write ``length`` bytes from ``stream`` into the partial file at ``offset``.
+
+    Re-sending bytes that were already received is allowed (the client may not
+    have seen our last response), but leaving a gap is not. Returns the new
+    number of bytes received.
+    """
+    if upload.is_expired():
+        raise UploadError("Upload has expired, please start a new one", 410)
+    if offset > upload.offset:
+        raise UploadError(
+            f"Offset {offset} is past the received data ({upload.offset} bytes)",
+            status_code=409,
+        )
+    if length > settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError(
+            f"Chunk is too large, maximum chunk size is {settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE} bytes",
+            status_code=413,
+        )
+    end = offset + length
+    if end > upload.size:
+        raise UploadError("Chunk extends past the declared file size")
+
+    try:
+        destination = open(upload.temp_path, "r+b")
+    except FileNotFoundError:
+        raise UploadError("Upload data is no longer available", 410)
+
+    written = 0
+    with destination:
+        destination.seek(offset)
+        while written < length:
+            block = stream.read(min(READ_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            destination.write(block)
+            written += len(block)
+
+    # A dropped connection leaves a short chunk; keep what arrived so the
+    # client can resume from there.
+    ImageUpload.objects.filter(pk=upload.pk).update(
+        offset=Greatest(F("offset"), offset + written)
+    )
+    upload.refresh_from_db(fields=["offset", "updated_at"])
+    return upload.offset
+
+
+def finish_upload(upload):
+    """Verify the received file and turn it into a LocationImage"""
+    if upload.is_expired():
+        raise UploadError("Upload has expired, please start a new one", 410)
+    if not upload.is_complete:
+        raise UploadError(
+            f"Upload is incomplete, received {upload.offset} of {upload.size} bytes",
+            status_code=409,
+        )
+
+    try:
+        with Image.open(upload.temp_path) as img:
+            img.verify()
+    except FileNotFoundError:
+        raise UploadError("Upload data is no longer available", 410)
+    except Exception:
+        raise UploadError("Uploaded file is not a valid image")
+
+    with transaction.atomic():
+        # A concurrent finalize or media_gc may have taken the upload since
+        upload = ImageUpload.objects.select_for_update().filter(pk=upload.pk).first()
+        if upload is None:
+            raise UploadError("Upload not found", 404)
+        if upload.is_expired():
+            raise UploadError("Upload has expired, please start a new one", 410)
+
+        image = LocationImage(
+            location=upload.location,
+            description=upload.description,
+            is_primary=upload.is_primary,
+        )
+        try:
+            fh = open(upload.temp_path, "rb")
+        except FileNotFoundError:
+            raise UploadError("Upload data is no longer available", 410)
+        with fh:
+            image.image.save(upload.filename, AssembledUpload(fh), save=False)
+        image.save()
+        upload.delete()
+
+    discard_upload_file(upload)
+    return image
+
+
+def discard_upload_file(upload):
+    """Remove the partial file of an upload, if it is still there"""
+    try:
+        os.remove(upload.temp_path)
+    except FileNotFoundError:
+        pass
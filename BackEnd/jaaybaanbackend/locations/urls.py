@@ -1,28 +1,63 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+
+def reads(async_view, view):
+    """``view``, with GET served by ``async_view`` if LOCATIONS_ASYNC_VIEWS"""
+    if settings.LOCATIONS_ASYNC_VIEWS:
+        return async_views.with_async_reads(async_view, view)
+    return view
+
 
 urlpatterns = [
     # Location CRUD
-    path("", views.LocationListCreateView.as_view(), name="location-list-create"),
-    path("<int:pk>/", views.LocationDetailView.as_view(), name="location-detail"),
+    path(
+        "",
+        reads(async_views.location_list, views.LocationListCreateView.as_view()),
+        name="location-list-create",
+    ),
+    path(
+        "<int:pk>/",
+        reads(async_views.location_detail, views.LocationDetailView.as_view()),
+        name="location-detail",
+    ),
     # Location tree and navigation
-    path("tree/", views.location_tree, name="location-tree"),
+    path(
+        "tree/",
+        reads(async_views.location_tree, views.location_tree),
+        name="location-tree",
+    ),
     path("<int:pk>/breadcrumb/", views.location_breadcrumb, name="location-breadcrumb"),
+    path("<int:pk>/page/", views.location_page, name="location-page"),
     # Location operations
     path("<int:pk>/move/", views.location_move, name="location-move"),
+    path(
+        "<int:pk>/children/bulk/",
+        views.location_children_bulk,
+        name="location-children-bulk",
+    ),
     path(
         "<int:pk>/mark-cleaned/",
         views.location_mark_cleaned,
         name="location-mark-cleaned",
     ),
     # Search and filtering
-    path("search/", views.location_search, name="location-search"),
+    path(
+        "search/",
+        reads(async_views.location_search, views.location_search),
+        name="location-search",
+    ),
     path(
         "needing-cleaning/",
         views.locations_needing_cleaning,
         name="locations-needing-cleaning",
     ),
-    path("statistics/", views.location_statistics, name="location-statistics"),
+    path(
+        "statistics/",
+        reads(async_views.location_statistics, views.location_statistics),
+        name="location-statistics",
+    ),
     path(
         "bulk-operations/",
         views.location_bulk_operations,
@@ -30,6 +65,9 @@ urlpatterns = [
     ),
     # Data management
     path("export/", views.location_export, name="location-export"),
+    path("changes/", views.location_changes, name="location-changes"),
+    path("snapshot.sqlite", views.location_snapshot, name="location-snapshot"),
+    path("events/", async_views.location_events, name="location-events"),
     # Location images
     path(
         "<int:location_id>/images/",
@@ -41,4 +79,25 @@ urlpatterns = [
         views.LocationImageDetailView.as_view(),
         name="location-image-detail",
     ),
+    path(
+        "images/duplicates/",
+        views.location_image_duplicates,
+        name="location-image-duplicates",
+    ),
+    # Chunked, resumable image uploads
+    path(
+        "<int:location_id>/images/uploads/",
+        views.location_image_upload_create,
+        name="location-image-upload-create",
+    ),
+    path(
+        "<int:location_id>/images/uploads/<uuid:upload_id>/",
+        views.location_image_upload_detail,
+        name="location-image-upload-detail",
+    ),
+    path(
+        "<int:location_id>/images/uploads/<uuid:upload_id>/complete/",
+        views.location_image_upload_complete,
+        name="location-image-upload-complete",
+    ),
 ]
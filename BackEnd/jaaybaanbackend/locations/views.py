@@ -1,19 +1,59 @@
+import os
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
 from rest_framework import generics, status, permissions, serializers
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
-from django.db.models import Q
+from rest_framework.settings import api_settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import F, Q
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.utils import timezone
-from .models import Location, LocationImage
+from django.utils.http import content_disposition_header
+from treebeard.exceptions import PathOverflow
+from jaaybaanbackend.renderers import NDJSONRenderer, ZipRenderer
+from .models import Location, LocationChange, LocationImage, ImageUpload
 from .serializers import (
     LocationSerializer,
-    LocationTreeSerializer,
     LocationBreadcrumbSerializer,
     LocationMoveSerializer,
     LocationSearchSerializer,
     LocationImageSerializer,
-    LocationExportSerializer,
+    ImageUploadSerializer,
+    LocationImageDuplicateSerializer,
+    BatchSerializer,
+    LocationChangesSerializer,
+    LocationBulkUpdateSerializer,
+    LocationBulkChildrenSerializer,
+    LocationExportSinceSerializer,
+    column_maximum,
+)
+from . import (
+    archive,
+    batch,
+    changes,
+    fast_serializers,
+    perceptual_hash,
+    snapshot,
+    uploads,
+)
+from .cache import (
+    cleaning_epoch,
+    get_or_compute,
+    get_tree_version,
+    schedule_tree_version_bump,
+)
+from .conditional import (
+    check_if_match,
+    location_etag,
+    not_modified,
+    set_etag,
+    tree_etag,
 )
 
 
@@ -30,10 +70,12 @@ class LocationListCreateView(generics.ListCreateAPIView):
 
     def get_queryset(self):
         queryset = Location.objects.all()
+        order = ["path"]
         parent_id = self.request.query_params.get("parent_id")
         location_type = self.request.query_params.get("location_type")
 
         if parent_id:
+            order = Location.sibling_order()
             if parent_id == "root":
                 queryset = Location.get_root_nodes()
             else:
@@ -43,7 +85,21 @@ class LocationListCreateView(generics.ListCreateAPIView):
         if location_type:
             queryset = queryset.filter(location_type=location_type)
 
-        return queryset.order_by("path")
+        return queryset.select_related("primary_image").order_by(*order)
+
+    def list(self, request, *args, **kwargs):
+        # Same output as LocationSerializer, built from plain rows
+        fields = LocationSerializer.select_fields(request.query_params)
+        queryset = fast_serializers.location_rows(
+            self.filter_queryset(self.get_queryset()),
+            fast_serializers.location_columns(fields),
+        )
+        context = self.get_serializer_context()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            data = fast_serializers.serialize_locations(page, context, fields)
+            return self.get_paginated_response(data)
+        return Response(fast_serializers.serialize_locations(queryset, context, fields))
 
     def perform_create(self, serializer):
         parent_id = self.request.data.get("parent_id")
@@ -66,10 +122,32 @@ class LocationListCreateView(generics.ListCreateAPIView):
 
 
 class LocationDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Location.objects.all()
+    queryset = Location.objects.select_related("primary_image")
     serializer_class = LocationSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def retrieve(self, request, *args, **kwargs):
+        fields = LocationSerializer.select_fields(request.query_params)
+        version = get_tree_version()
+        instance = self.get_object()
+        etag = location_etag(instance, version)
+        response = not_modified(request, etag)
+        if response is None:
+            response = Response(self.get_serializer(instance, fields=fields).data)
+        return set_etag(response, etag)
+
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        return set_etag(response, self.etag)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            check_if_match(self.request, serializer.instance)
+            serializer.save()
+        # Read after the commit bumped the version, before the response
+        # data is serialized
+        self.etag = location_etag(serializer.instance, get_tree_version())
+
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
 
@@ -96,25 +174,65 @@ class LocationDetailView(generics.RetrieveUpdateDestroyAPIView):
 def location_tree(request):
     """Get complete location tree or subtree"""
     parent_id = request.query_params.get("parent_id")
+    etag = tree_etag("tree", parent_id or "root")
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    response = Response(
+        get_or_compute("tree", lambda: build_tree(parent_id), parent_id or "root")
+    )
+    return set_etag(response, etag)
 
-    if parent_id:
-        parent = get_object_or_404(Location, id=parent_id)
-        locations = [parent]
-    else:
-        locations = Location.get_root_nodes()
 
-    serializer = LocationTreeSerializer(locations, many=True)
-    return Response(serializer.data)
+def build_tree(parent_id=None):
+    parent = get_object_or_404(Location, id=parent_id) if parent_id else None
+    return fast_serializers.build_tree(**fast_serializers.fetch_tree(parent))
 
 
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
 def location_breadcrumb(request, pk):
     """Get breadcrumb for a specific location"""
-    location = get_object_or_404(Location, id=pk)
-    ancestors = list(location.get_ancestors()) + [location]
-    serializer = LocationBreadcrumbSerializer(ancestors, many=True)
-    return Response(serializer.data)
+    etag = tree_etag("breadcrumb", pk)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    def compute():
+        location = get_object_or_404(Location, id=pk)
+        ancestors = list(location.get_ancestors()) + [location]
+        return LocationBreadcrumbSerializer(ancestors, many=True).data
+
+    return set_etag(Response(get_or_compute("breadcrumb", compute, pk)), etag)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def location_page(request, pk):
+    """
+    Get everything the location screen shows: the location with its images,
+    breadcrumb, first page of children and subtree counts
+    """
+    page_size = LocationPagination().get_page_size(request)
+    etag = tree_etag("page", pk, page_size, cleaning_epoch())
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    page = fast_serializers.fetch_page(pk, page_size)
+    if page is None:
+        raise Http404("No Location matches the given query.")
+    next_url = None
+    if page["location"]["numchild"] > page_size:
+        query = urlencode({"parent_id": pk, "page": 2, "page_size": page_size})
+        next_url = request.build_absolute_uri(
+            f"{reverse('location-list-create')}?{query}"
+        )
+    data = fast_serializers.build_page(
+        **page, context={"request": request}, next_url=next_url
+    )
+    return set_etag(Response(data), etag)
 
 
 @api_view(["POST"])
@@ -172,6 +290,7 @@ def location_move(request, pk):
 @permission_classes([permissions.IsAuthenticated])
 def location_search(request):
     """Search locations with various filters"""
+    fields = LocationSerializer.select_fields(request.query_params)
     serializer = LocationSearchSerializer(data=request.query_params)
 
     if serializer.is_valid():
@@ -230,15 +349,17 @@ def location_search(request):
             queryset = Location.objects.filter(id__in=location_ids)
 
         # Paginate results
+        queryset = fast_serializers.location_rows(
+            queryset, fast_serializers.location_columns(fields)
+        )
         paginator = LocationPagination()
         page = paginator.paginate_queryset(queryset, request)
 
         if page is not None:
-            serializer = LocationSerializer(page, many=True)
-            return paginator.get_paginated_response(serializer.data)
+            data = fast_serializers.serialize_locations(page, fields=fields)
+            return paginator.get_paginated_response(data)
 
-        serializer = LocationSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return Response(fast_serializers.serialize_locations(queryset, fields=fields))
 
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -259,28 +380,41 @@ def location_mark_cleaned(request, pk):
 @permission_classes([permissions.IsAuthenticated])
 def locations_needing_cleaning(request):
     """Get all locations that need cleaning"""
+    fields = LocationSerializer.select_fields(request.query_params)
     all_locations = Location.objects.all()
     locations_needing_cleaning = [loc for loc in all_locations if loc.needs_cleaning()]
 
     # Convert to queryset for pagination
     location_ids = [loc.id for loc in locations_needing_cleaning]
-    queryset = Location.objects.filter(id__in=location_ids)
+    queryset = fast_serializers.location_rows(
+        Location.objects.filter(id__in=location_ids),
+        fast_serializers.location_columns(fields),
+    )
 
     paginator = LocationPagination()
     page = paginator.paginate_queryset(queryset, request)
 
     if page is not None:
-        serializer = LocationSerializer(page, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        data = fast_serializers.serialize_locations(page, fields=fields)
+        return paginator.get_paginated_response(data)
 
-    serializer = LocationSerializer(queryset, many=True)
-    return Response(serializer.data)
+    return Response(fast_serializers.serialize_locations(queryset, fields=fields))
 
 
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
 def location_statistics(request):
     """Get overall system statistics"""
+    epoch = cleaning_epoch()
+    etag = tree_etag("statistics", epoch)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    stats = get_or_compute("statistics", compute_statistics, epoch)
+    return set_etag(Response(stats), etag)
+
+
+def compute_statistics():
     all_locations = Location.objects.all()
 
     stats = {
@@ -307,7 +441,7 @@ def location_statistics(request):
             "count": all_locations.filter(location_type=type_code).count(),
         }
 
-    return Response(stats)
+    return stats
 
 
 @api_view(["POST"])
@@ -416,6 +550,54 @@ def location_bulk_operations(request):
                     {"id": location.id, "name": location.name, "error": str(e)}
                 )
 
+    elif operation == "update_fields":
+        serializer = LocationBulkUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        values = serializer.validated_data.get("set", {})
+        increments = serializer.validated_data.get("add", {})
+
+        # The rules a save would check, as conditions on the rows
+        rules = []
+        if values.get("is_container") is False:
+            rules.append(
+                (
+                    Q(numchild__gt=0),
+                    "Cannot make a location non-container if it has children",
+                )
+            )
+        for name, amount in increments.items():
+            if amount < 0:
+                rules.append(
+                    (Q(**{f"{name}__lt": -amount}), f"{name} cannot be negative")
+                )
+            elif amount > 0:
+                maximum = column_maximum(name)
+                rules.append(
+                    (
+                        Q(**{f"{name}__gt": maximum - amount}),
+                        f"{name} cannot be more than {maximum}",
+                    )
+                )
+
+        with transaction.atomic():
+            # Locked, so children can't be added between the checks and the update
+            targets = locations.select_for_update()
+            for condition, error in rules:
+                for location in targets.filter(condition).values("id", "name"):
+                    results["failed"].append({**location, "error": error})
+                targets = targets.exclude(condition)
+            ids = list(targets.values_list("id", flat=True))
+            results["processed"] = Location.objects.filter(id__in=ids).update(
+                **values,
+                **{name: F(name) + amount for name, amount in increments.items()},
+                updated_at=timezone.now(),
+            )
+            changes.record_changes(
+                LocationChange.LOCATION, ids, LocationChange.UPDATE, publish=True
+            )
+            schedule_tree_version_bump()
+
     else:
         return Response(
             {"error": f"Unknown operation: {operation}"},
@@ -428,20 +610,203 @@ def location_bulk_operations(request):
     return Response(results)
 
 
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+def location_children_bulk(request, pk):
+    """Create many children of a location at once, in one transaction"""
+    parent = get_object_or_404(Location, pk=pk)
+    if not parent.is_container:
+        return Response(
+            {"error": "Cannot add items to a non-container location"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    serializer = LocationBulkChildrenSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        children = parent.add_children(serializer.validated_data["children"])
+    except PathOverflow:
+        return Response(
+            {"error": "The location has too many children"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return Response(
+        {"count": len(children), "ids": [child.id for child in children]},
+        status=status.HTTP_201_CREATED,
+    )
+
+
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+def location_batch(request):
+    """Run several locations API requests in one transaction"""
+    serializer = BatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    key = request.headers.get("Idempotency-Key")
+    digest = batch.request_hash(request.data)
+    if key:
+        stored = batch.stored_response(request.user, key)
+        if stored is not None:
+            if stored.request_hash != digest:
+                return Response(
+                    {"error": "Idempotency-Key was already used for another request"},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            response = Response(stored.response, status=stored.status_code)
+            response["Idempotent-Replayed"] = "true"
+            return response
+
+    # The change log entries of the operations are written together at the
+    # end, after the rows of every operation are locked
+    with transaction.atomic(), changes.deferred():
+        results, success = batch.run_batch(
+            request, serializer.validated_data["operations"]
+        )
+        data = {"success": success, "results": results}
+        if not success:
+            transaction.set_rollback(True)
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        if key and not batch.store_response(
+            request.user, key, digest, status.HTTP_200_OK, data
+        ):
+            transaction.set_rollback(True)
+            return Response(
+                {"error": "A request with this Idempotency-Key is in progress"},
+                status=status.HTTP_409_CONFLICT,
+            )
+    return Response(data)
+
+
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
+@renderer_classes([*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, ZipRenderer])
 def location_export(request):
-    """Export all locations data"""
-    queryset = Location.objects.all().order_by("path")
-    serializer = LocationExportSerializer(queryset, many=True)
+    """
+    Export all locations data, as JSON or streamed as NDJSON; with ``since``,
+    only the locations created, updated or deleted since. As ZIP, stream an
+    archive of the locations and images with the image files.
+    """
+    serializer = LocationExportSinceSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    since = serializer.validated_data.get("since")
+
+    if isinstance(request.accepted_renderer, ZipRenderer):
+        if since is not None:
+            return Response(
+                {"since": ["Archives always hold the whole inventory."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        response = streaming_response(
+            request, archive.stream_archive(), archive.CONTENT_TYPE
+        )
+        response["Content-Disposition"] = content_disposition_header(
+            True, f"jaaybaan-{timezone.now():%Y%m%d-%H%M%S}.zip"
+        )
+        return response
 
-    return Response(
-        {
-            "count": queryset.count(),
-            "data": serializer.data,
-            "exported_at": timezone.now(),
-        }
+    # Read before the data, so syncing from it can only repeat changes
+    seq = changes.current_seq()
+    if since is None:
+        batches = fast_serializers.stream_export()
+    else:
+        batches = changes.stream_export_changes(since)
+    if isinstance(request.accepted_renderer, NDJSONRenderer):
+        renderer = request.accepted_renderer
+        response = streaming_response(
+            request,
+            (renderer.render_lines(rows) for rows in batches),
+            renderer.media_type,
+        )
+    elif since is None:
+        response = Response(build_export())
+    else:
+        data = [row for rows in batches for row in rows]
+        response = Response(
+            {"count": len(data), "data": data, "exported_at": timezone.now()}
+        )
+    response["Change-Seq"] = str(seq)
+    return response
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+@renderer_classes([NDJSONRenderer])
+def location_changes(request):
+    """
+    Stream the changes after ``since`` as NDJSON, one line per changed
+    location or image
+    """
+    serializer = LocationChangesSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    seq = changes.current_seq()
+    renderer = request.accepted_renderer
+    lines = changes.stream_changes(
+        serializer.validated_data["since"], context={"request": request}
+    )
+    response = streaming_response(
+        request, (renderer.render_lines(batch) for batch in lines), renderer.media_type
     )
+    response["Change-Seq"] = str(seq)
+    return response
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def location_snapshot(request):
+    """
+    Download the whole inventory as a SQLite database, for offline clients.
+    The file is written once per tree version and shared by the downloads.
+    """
+    etag = tree_etag("snapshot")
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    file, meta = snapshot.open_snapshot()
+    response = streaming_response(
+        request, snapshot.read_blocks(file), snapshot.CONTENT_TYPE
+    )
+    response["Content-Length"] = str(os.fstat(file.fileno()).st_size)
+    response["Content-Disposition"] = content_disposition_header(
+        True, f"jaaybaan-{meta['tree_version']}.sqlite"
+    )
+    response["Change-Seq"] = meta["change_seq"]
+    return set_etag(response, etag)
+
+
+async def aiterate(iterator):
+    """Iterate a sync iterator from async code, an item at a time in a thread"""
+    sentinel = object()
+    next_item = sync_to_async(next)
+    while (item := await next_item(iterator, sentinel)) is not sentinel:
+        yield item
+
+
+def streaming_response(request, chunks, content_type):
+    """
+    A StreamingHttpResponse of the ``chunks`` iterator. Under ASGI, Django
+    reads a sync iterator to the end before sending anything, so it is
+    iterated asynchronously instead: chunks are still produced as the
+    client reads them, and a slow client doesn't hold a thread.
+    """
+    if isinstance(request._request, ASGIRequest):
+        chunks = aiterate(chunks)
+    return StreamingHttpResponse(chunks, content_type=content_type)
+
+
+def build_export():
+    data = fast_serializers.build_export(**fast_serializers.fetch_export())
+    return {
+        "count": len(data),
+        "data": data,
+        "exported_at": timezone.now(),
+    }
 
 
 # Location Images Views
@@ -451,7 +816,9 @@ class LocationImageListCreateView(generics.ListCreateAPIView):
 
     def get_queryset(self):
         location_id = self.kwargs["location_id"]
-        return LocationImage.objects.filter(location_id=location_id)
+        return LocationImage.objects.filter(location_id=location_id).select_related(
+            "location"
+        )
 
     def perform_create(self, serializer):
         location_id = self.kwargs["location_id"]
@@ -465,4 +832,177 @@ class LocationImageDetailView(generics.RetrieveUpdateDestroyAPIView):
 
     def get_queryset(self):
         location_id = self.kwargs["location_id"]
-        return LocationImage.objects.filter(location_id=location_id)
+        return LocationImage.objects.filter(location_id=location_id).select_related(
+            "location"
+        )
+
+
+DEFAULT_DUPLICATE_DISTANCE = 3
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def location_image_duplicates(request):
+    """
+    Find near-duplicate images by perceptual hash.
+
+    With ``image_id``, returns the images within ``max_distance`` bits of that
+    image. Without it, returns every cluster of near-duplicate images.
+    """
+    try:
+        max_distance = int(
+            request.query_params.get("max_distance", DEFAULT_DUPLICATE_DISTANCE)
+        )
+    except ValueError:
+        max_distance = -1
+    if not 0 <= max_distance <= perceptual_hash.MAX_DISTANCE:
+        return Response(
+            {
+                "error": f"max_distance must be between 0 and {perceptual_hash.MAX_DISTANCE}"
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    context = {"request": request}
+    image_id = request.query_params.get("image_id")
+    if image_id:
+        image = get_object_or_404(LocationImage, id=image_id)
+        value = image.perceptual_hash
+        if value is None:
+            return Response(
+                {"error": "Image has no perceptual hash"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        candidates = (
+            LocationImage.objects.filter(
+                perceptual_hash.candidate_filter(value, max_distance)
+            )
+            .exclude(pk=image.pk)
+            .select_related("location")
+        )
+        duplicates = []
+        for candidate in candidates:
+            candidate.distance = perceptual_hash.hamming(
+                value, candidate.perceptual_hash
+            )
+            if candidate.distance <= max_distance:
+                duplicates.append(candidate)
+        duplicates.sort(key=lambda candidate: (candidate.distance, candidate.pk))
+
+        serializer = LocationImageDuplicateSerializer(
+            duplicates, many=True, context=context
+        )
+        return Response(
+            {
+                "image_id": image.id,
+                "max_distance": max_distance,
+                "duplicates": serializer.data,
+            }
+        )
+
+    rows = (
+        LocationImage.objects.filter(phash__isnull=False)
+        .values_list("id", "phash")
+        .iterator(chunk_size=2000)
+    )
+    clusters = perceptual_hash.find_clusters(
+        ((pk, perceptual_hash.to_unsigned(value)) for pk, value in rows),
+        max_distance,
+    )
+    images = LocationImage.objects.select_related("location").in_bulk(
+        [pk for cluster in clusters for pk in cluster]
+    )
+
+    return Response(
+        {
+            "max_distance": max_distance,
+            "count": len(clusters),
+            "clusters": [
+                LocationImageDuplicateSerializer(
+                    [images[pk] for pk in cluster], many=True, context=context
+                ).data
+                for cluster in clusters
+            ],
+        }
+    )
+
+
+# Chunked image uploads
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+def location_image_upload_create(request, location_id):
+    """Start a resumable, chunked image upload"""
+    location = get_object_or_404(Location, id=location_id)
+    serializer = ImageUploadSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    try:
+        upload = uploads.start_upload(location, **serializer.validated_data)
+    except uploads.UploadError as e:
+        return Response({"error": str(e)}, status=e.status_code)
+
+    return Response(ImageUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(["GET", "HEAD", "PATCH", "DELETE"])
+@permission_classes([permissions.IsAuthenticated])
+def location_image_upload_detail(request, location_id, upload_id):
+    """
+    Get the status of an upload (GET/HEAD), send a chunk (PATCH) or abort it
+    (DELETE).
+
+    Chunks are sent as the raw request body with the byte position in the
+    ``Upload-Offset`` header (or ``?offset=``). To resume an interrupted
+    upload, GET it and continue from the returned ``offset``.
+    """
+    upload = get_object_or_404(ImageUpload, id=upload_id, location_id=location_id)
+
+    if request.method == "DELETE":
+        uploads.discard_upload_file(upload)
+        upload.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    if request.method == "PATCH":
+        offset = request.headers.get(
+            "Upload-Offset", request.query_params.get("offset")
+        )
+        try:
+            offset = int(offset)
+            length = int(request.headers.get("Content-Length") or 0)
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "Upload-Offset and Content-Length headers are required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            # Read the raw stream; request.data would run the body through
+            # the parsers and buffer it.
+            uploads.write_chunk(upload, offset, request.stream, length)
+        except uploads.UploadError as e:
+            return Response(
+                {"error": str(e), "offset": upload.offset}, status=e.status_code
+            )
+
+    response = Response(ImageUploadSerializer(upload).data)
+    response["Upload-Offset"] = str(upload.offset)
+    response["Upload-Length"] = str(upload.size)
+    return response
+
+
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+def location_image_upload_complete(request, location_id, upload_id):
+    """Assemble a fully received upload into a location image"""
+    upload = get_object_or_404(ImageUpload, id=upload_id, location_id=location_id)
+
+    try:
+        image = uploads.finish_upload(upload)
+    except uploads.UploadError as e:
+        return Response(
+            {"error": str(e), "offset": upload.offset}, status=e.status_code
+        )
+
+    serializer = LocationImageSerializer(image, context={"request": request})
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -114,6 +114,25 @@ else:
     print("Sample data already exists")
 EOF
 
+# SERVER_MODE=asgi runs the ASGI app in uvicorn workers: reads of the
+# locations API go through the async views, and live events are served
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    export ASYNC_VIEWS=${ASYNC_VIEWS:-true}
+    echo "Starting Gunicorn with uvicorn workers..."
+    exec gunicorn jaaybaanbackend.asgi:application \
+        --bind 0.0.0.0:8000 \
+        --workers 3 \
+        --worker-class uvicorn_worker.UvicornWorker \
+        --max-requests 1000 \
+        --max-requests-jitter 100 \
+        --timeout 60 \
+        --keep-alive 5 \
+        --access-logfile - \
+        --error-logfile - \
+        --log-level info \
+        --capture-output
+fi
+
 # Start Gunicorn with optimized settings for local deployment
 echo "Starting Gunicorn..."
 exec gunicorn jaaybaanbackend.wsgi:application \
@@ -429,6 +429,7 @@ services:
       - SUPERUSER_PASSWORD=${SUPERUSER_PASSWORD}
     volumes:
       - media_data:/app/media
+      - ./backups/inventory:/app/backups
     ports:
       - "0.0.0.0:8000:8000"
     depends_on: